@@ -0,0 +1,123 @@
+""" ApFeatures.py: Features of apnea records and reports.
+
+Vectorized versions of the calculations that DoubleClassify.py uses
+to classify whole records and to summarize minute by minute
+classifications, and a reader for the reports that it writes.
+"""
+Copyright = '''Copyright 2013 Andrew M. Fraser and Los Alamos National
+Laboroatory
+
+This file is part of hmmds3.
+
+Hmmds3 is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+Hmmds3 is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+for more details.
+
+See the file gpl.txt in the root directory of the hmmds3 distribution
+or see <http://www.gnu.org/licenses/>.
+'''
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+SamPerMin = 10 # Samples per minute
+MinPerHour = 60
+def peaks(lp, W=5):
+    '''Find local maxima of the low pass heart rate.
+
+    lp[t] is a peak if it is positive and lp[t-W:t+W].argmax() == W,
+    ie, it is the first maximum of the window.
+
+    Parameters
+    ----------
+    lp : array
+        Low pass heart rate time series
+    W : int, optional
+        Half width of windows
+
+    Returns
+    -------
+    values : array
+        Values of the peaks in time order
+
+    >>> peaks(np.array([0, 1, 3, 1, 0, -2, 0, 2, 2, 0, 1, 0]), W=2)
+    array([3, 2])
+    '''
+    lp = np.asarray(lp)
+    T = len(lp)
+    if T <= 2*W:
+        return lp[:0]
+    windows = sliding_window_view(lp, 2*W)[:T-2*W] # windows[i] = lp[i:i+2W]
+    middle = lp[W:T-W]
+    return middle[(windows.argmax(axis=1) == W) & (middle > 0)]
+def peak_ratio(lp, W=5, fraction=.74):
+    '''Return R, the value of the peak at the given fraction of the
+    sorted peaks divided by the average absolute value of lp.  R is
+    one of the two statistics for the first pass classification.
+    '''
+    values = np.sort(peaks(lp, W))
+    L1 = np.abs(lp).sum()/len(lp) # L1 norm of lp per sample
+    return values[int(fraction*len(values))]/L1
+def minute_marks(Cseq, sam_min=SamPerMin):
+    '''Return True for each minute with a positive sum of Cseq.
+
+    Follows the report format of DoubleClassify: There are
+    len(Cseq)//sam_min + 1 minutes, and the last minute is partial
+    or, if len(Cseq) is a multiple of sam_min, empty and False.
+
+    >>> minute_marks(np.array([1, 1, -1, -1, -1, 1]), 2)
+    array([ True, False, False, False])
+    '''
+    n_min = len(Cseq)//sam_min + 1
+    padded = np.zeros(n_min*sam_min)
+    padded[:len(Cseq)] = Cseq
+    return padded.reshape((n_min, sam_min)).sum(axis=1) > 0
+def hour_lines(marks, min_hour=MinPerHour):
+    '''Return a string of "A" (apnea) and "N" (normal) characters for
+    each hour of minute marks.
+    '''
+    chars = np.where(marks, 'A', 'N')
+    return [''.join(chars[h:h+min_hour])
+            for h in range(0, len(marks), min_hour)]
+def format_minutes(Cseq):
+    '''Return the text that DoubleClassify writes after the first line
+    for a record.  Cseq[t] is +1 for apnea and -1 for normal.
+    '''
+    return ''.join('\n%-2d   %s'%(h, line) for h, line in
+                   enumerate(hour_lines(minute_marks(Cseq)))) + '\n'
+def read_report(path):
+    '''Read the first line for each record in a report from
+    DoubleClassify.py, eg,
+
+        a01 # High   stat=  4.777 llr=  4.427 R=  2.563
+
+    Returns
+    -------
+    rv : list
+        A dict for each record with keys 'record', 'group', 'stat',
+        'llr' and 'R'
+    '''
+    rv = []
+    for line in open(path, 'r'):
+        parts = line.split()
+        if len(parts) < 9 or parts[1] != '#':
+            continue # Minute by minute classifications
+        rv.append({'record':parts[0], 'group':parts[2],
+                   'stat':float(parts[4]), 'llr':float(parts[6]),
+                   'R':float(parts[8])})
+    return rv
+
+def _test():
+    import doctest
+    doctest.testmod()
+
+if __name__ == "__main__":
+    _test()
+#Local Variables:
+#mode:python
+#End:
@@ -46,37 +46,64 @@ or see <http://www.gnu.org/licenses/>.
 '''
 small = 1e-25
 SamPerMin = 10 # Samples per minute.
+cache_dir = '.cache' # Subdirectory of each data directory in which
+                     # read_data keeps binary copies.  None disables
 
 from hmm.Scalar import Discrete_Observations # join method gets used
 from hmm.Scalar import Class_y
-from hmm.Scalar import initialize
+from hmm.Scalar import initialize, LaggedContext
+from hmm.VARG import weighted_gram, solve_normal
+import cinc2000
 import numpy as np
 import math
+import os
+import hashlib
+import tempfile
 import numpy.linalg as LA
 LAI = LA.inv
 
 mark_dict = {'N':0,'A':1}
+_summaries = {} # Results of read_summary keyed by _cache_path
+def read_summary(Annotations):
+    """Return a dict that maps each record name in the file of expert
+    markings to an int8 array with one sample per minute, 1 for apnea
+    and 0 for normal.
+
+    The text is parsed once, and a binary copy is kept like those of
+    read_data.  Results are also kept in memory, so that looking up
+    many records reads the file only once.
+
+    """
+    key = _cache_path(Annotations, '.npz') or os.path.abspath(Annotations)
+    if key in _summaries:
+        return _summaries[key]
+    rv = None
+    if key.endswith('.npz') and os.path.exists(key):
+        try:
+            with np.load(key) as archive:
+                rv = dict(archive.items())
+        except (OSError, ValueError):
+            pass # Corrupt copy.  Parse the text and replace it
+    if rv is None:
+        codes = np.zeros(256, np.int8) - 1
+        for letter, mark in mark_dict.items():
+            codes[ord(letter)] = mark
+        rv = {}
+        for name, letters in cinc2000.parse_summary(Annotations).items():
+            notes = codes[np.frombuffer(letters.encode(), np.uint8)]
+            if (notes < 0).any():
+                raise RuntimeError('Bad mark in %s for record %s'%(
+                    Annotations, name))
+            rv[name] = notes
+        if key.endswith('.npz'):
+            _write_cache(key, rv)
+    _summaries[key] = rv
+    return rv
 def fetch_ann(Annotations, name):
     """Does the work of fetch_annotations.  Only one sample per minute.
 
     """
-    F = open(Annotations,'r')
-    parts = F.readline().split()
-    while len(parts) is 0 or parts[0] != name:
-        parts = F.readline().split()
-    hour = 0
-    letters = []
-    for line in F:
-        parts = line.split()
-        if len(parts) != 2:
-            break
-        assert (int(parts[0]) == hour),'parts=%s\nhour=%d'%(parts, hour)
-        hour += 1
-        letters += parts[1]
-    notes = []
-    for t in range(len(letters)):
-        notes.append(mark_dict[letters[t]])
-    return np.array(notes, np.bool)
+    return read_summary(Annotations)[name].astype(bool)
 
 def fetch_annotations(Annotations,name):
     ''' Get apnea/normal annotations
@@ -103,12 +130,64 @@ def read_expert(path, arg=None):
     fetch_annotations('../raw_data/apnea/summary_of_training', 'a01')
 
     '''
-    import os.path
     return [fetch_annotations(*os.path.split(path))]
 
+def _cache_path(data_file, suffix='.npy'):
+    '''Return the path of the binary copy of data_file or None if
+    caching is disabled.  The name includes a hash of the absolute
+    path, size and modification time of data_file, so that a changed
+    file gets a new copy.
+    '''
+    if cache_dir is None:
+        return None
+    stat = os.stat(data_file)
+    key = '%s %d %d'%(os.path.abspath(data_file), stat.st_size,
+                      stat.st_mtime_ns)
+    name = '%s.%s%s'%(os.path.basename(data_file),
+                      hashlib.sha1(key.encode()).hexdigest()[:16], suffix)
+    return os.path.join(os.path.dirname(data_file), cache_dir, name)
+def _write_cache(path, data):
+    '''Write data, an array or for a .npz path a dict of arrays, to
+    path atomically, so that concurrent readers never see a partial
+    file, and remove stale copies of the same data file.  Failures,
+    eg, for a read only data directory or a full disk, only disable
+    the cache and don't leave a temporary file behind.  Return True
+    if path was written.
+    '''
+    directory, name = os.path.split(path)
+    base, suffix = name.rsplit('.', 2)[0], name[name.rindex('.'):]
+    tmp = None
+    try:
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            if suffix == '.npz':
+                np.savez(f, **data)
+            else:
+                np.save(f, data)
+        os.replace(tmp, path)
+        tmp = None
+        for old in os.listdir(directory):
+            if old.endswith(suffix) and old.rsplit('.', 2)[0] == base \
+               and old != name:
+                os.remove(os.path.join(directory, old))
+    except OSError:
+        if tmp is not None:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+        return False
+    return True
 def read_data(data_file):
     '''Read in "data_file" as a 2-d array
 
+    The first call for a file parses the text and saves a binary copy
+    in the cache_dir subdirectory.  Every call, including the first,
+    returns that copy mapped into memory read only, so that concurrent
+    processes share pages.  If there is no copy the result is an
+    ordinary array, but it is also read only.
+
     Parameters
     ----------
     data_file : path
@@ -119,16 +198,29 @@ def read_data(data_file):
         data[i,j] is the jth number on the ith line
 
     '''
+    path = _cache_path(data_file)
+    if path is not None and os.path.exists(path):
+        try:
+            return np.load(path, mmap_mode='r')
+        except (OSError, ValueError):
+            pass # Corrupt copy.  Parse the text and replace it
     data = [[float(x) for x in line.split()] for line in open(data_file, 'r')]
-    return np.array(data).T
+    data = np.ascontiguousarray(np.array(data).T)
+    if path is not None and _write_cache(path, data):
+        try:
+            return np.load(path, mmap_mode='r')
+        except (OSError, ValueError):
+            pass
+    data.setflags(write=False)
+    return data
 
 def read_lphr(path, AR):
     """ Read a file and create observation list for class Heart_Rate
 
     Notes for context: context[t, 0] = 1.0, context[1] = hr[t-1],
-    context[t, AR] = hr[t-AR]
-
-    FixMe: test this function
+    context[t, AR] = hr[t-AR], and hr[0] stands in for times before
+    the start.  context is a LaggedContext view of hr rather than a
+    dense array.
 
     Parameters
     ----------
@@ -141,27 +233,14 @@ def read_lphr(path, AR):
     -------
     hr : array
         hr[t] is the scaled low pass heart rate at time t (6 second intervals)
-    context : array
+    context : LaggedContext
         context[t, 0] = 1, and context[t, s] = hr[t-s] for s in [1,AR]
 
     """
     raw = read_data(path)[2]
-    n_y = len(raw)
-    hr = np.empty(n_y)
-    context = np.empty((n_y,AR+1))
-    for t in range(AR+2):
-        context[t, :] = raw[0]  # No real data before t=0.  Is this OK?
-        context[t, 0:min(AR+1,t+1)] = raw[:t+1][::-1][0:min(AR+1,t+1)]
-        hr[t] = raw[t]
-    for t in range(AR+2, n_y):
-        context[t,1:] = raw[t-1:t-AR-1:-1]
-        hr[t] = raw[t]
-    raw.sort()
-    scale = 2.0/raw[int(n_y*.8)]
-    hr *= scale
-    context *= scale
-    context[:,0] = 1
-    return hr, context
+    scale = 2.0/np.sort(raw)[int(len(raw)*.8)] # raw may be read only
+    hr = raw*scale
+    return hr, LaggedContext(hr, AR)
 
 def read_resp(path, arg=None):
     """ Read respiration data and create observation list for class Resp
@@ -287,7 +366,7 @@ class Resp(Discrete_Observations):
             rv += ' norm = %f\n'%self.norm[i]
         np.set_printoptions(save)
         return rv
-    def calc(self, y_):
+    def calc(self, y_, work=None):
         """
         Calculate and return likelihoods: self.P_Y[t,i] = P(y(t)|s(t)=i)
 
@@ -295,6 +374,8 @@ class Resp(Discrete_Observations):
         ----------
         y_ : (y,)
             A sequence of vector observations.  y.shape = (n_y, 3)
+        work : Workspace, optional
+            Source of reusable memory for the result
 
         Returns
         -------
@@ -302,18 +383,49 @@ class Resp(Discrete_Observations):
             P_Y.shape = (n_y, n_states)
 
         """
-        y = y_[0]
-        n_y = len(y)
-        self.P_Y = initialize(self.P_Y, (n_y, self.n_states))
-        for t in range(n_y):
-            for i in range(self.n_states):
-                d = (y[t]-self.mu[i])
-                dQd = np.dot(d, np.dot(self.Icov[i], d))
-                if dQd > 300: # Underflow
-                    self.P_Y[t,i] = 0
-                else:
-                    self.P_Y[t,i] = self.norm[i]*math.exp(-dQd/2)
-        return self.P_Y
+        n_y = len(y_[0])
+        self.P_Y = initialize(self.P_Y, (n_y, self.n_states), np.float64,
+                              work, (id(self), 'P_Y'))
+        return self.calc_block(y_, 0, n_y, self.P_Y)
+    def calc_block(self, y_, t0, t1, out):
+        """
+        Assign and return out[t-t0,i] = P(y(t)|s(t)=i) for t0 <= t < t1
+        """
+        self.log_calc_block(y_, t0, t1, out)
+        return np.exp(out, out=out)
+    def log_calc(self, y_, work=None):
+        """
+        Calculate and return log likelihoods: log P(y(t)|s(t)=i)
+        """
+        n_y = len(y_[0])
+        self.P_Y = initialize(self.P_Y, (n_y, self.n_states), np.float64,
+                              work, (id(self), 'P_Y'))
+        return self.log_calc_block(y_, 0, n_y, self.P_Y)
+    def log_calc_block(self, y_, t0, t1, out):
+        """
+        Assign and return out[t-t0,i] = log P(y(t)|s(t)=i) for t0 <= t < t1
+
+        With Icov[i] = L[i] L[i]^T, the Mahalanobis term is the squared
+        length of the whitened residual d L[i].
+        """
+        out[:] = self._log_P([y_[0][t0:t1]])
+        return out
+    def _log_P(self, y_, states=slice(None)):
+        """
+        Return log P(y(t)|s(t)=i) for each t in y_ and each state i
+        in states
+        """
+        y = np.asarray(y_[0])
+        L = LA.cholesky(self.Icov[states])     # L[i] L[i]^T = Icov[i]
+        d = y[:, np.newaxis, :] - self.mu[states] # d[t,i,:] = y[t] - mu[i]
+        z = np.einsum('tij,ijk->tik', d, L)    # Whitened residuals
+        dQd = np.einsum('tik,tik->ti', z, z)
+        return np.log(self.norm[states]) - dQd/2
+    def calc_states(self, y_, t, states):
+        """
+        Return P[k,j] = P(y(t[k])|s(t[k])=states[j])
+        """
+        return np.exp(self._log_P([np.asarray(z)[t] for z in y_], states))
     def reestimate(self, # Resp instance
                    w,    # w[t,i] = prob s(t) = i
                    y_):
@@ -326,16 +438,16 @@ class Resp(Discrete_Observations):
         # Inverse Wishart prior parameters.  Without data sigma_sq = b/a
         a = 4
         b = 0.1
+        rrsum = np.empty((self.n_states, Dim, Dim))
         for i in range(self.n_states):
-            rrsum = np.zeros((Dim,Dim))
-            for t in range(n_y):
-                r = y[t]-self.mu[i]
-                rrsum += w[t,i]*np.outer(r, r)
-            cov = (b*np.eye(Dim) + rrsum)/(a + wsum[i])
-            det = LA.det(cov)
-            assert (det > 0.0)
-            self.Icov[i,:,:] = LAI(cov)
-            self.norm[i] = 1.0/(math.sqrt((2*math.pi)**Dim*det))
+            r = y - self.mu[i]
+            rrsum[i] = np.dot((r*w[:, i:i+1]).T, r) # Weighted scatter
+        cov = (b*np.eye(Dim) + rrsum)/(a + wsum).reshape((-1, 1, 1))
+        det = LA.det(cov)
+        assert (det > 0.0).all()
+        self.Icov = LAI(cov)
+        self.norm = 1.0/np.sqrt((2*math.pi)**Dim*det)
+        self.bump_version()
         return
 class Heart_Rate(Resp):
     """ Autoregressive observation model for heart rate signal.
@@ -363,45 +475,118 @@ class Heart_Rate(Resp):
             rv += ' norm = %f\n'%self.norm[i]
         np.set_printoptions(save)
         return rv
-    def calc(self, y):
-        hr = y[0]
-        context = y[1]
-        n_y = len(hr)
-        self.P_Y = initialize(self.P_Y, (n_y, self.n_states))
-        d =  hr - np.inner(self.A,context)
-        for i in range(self.n_states):
-            z = np.minimum(d[i]*d[i]/(2*self.Var[i]),300.0)
-            # Cap z to stop underflow
-            self.P_Y[:,i] = np.exp(-z)*self.norm[i]
-        return self.P_Y
-    def reestimate(self, # Heart_Rate instance
+    def calc(self, y, work=None):
+        n_y = len(y[0])
+        self.P_Y = initialize(self.P_Y, (n_y, self.n_states), np.float64,
+                              work, (id(self), 'P_Y'))
+        return self.calc_block(y, 0, n_y, self.P_Y)
+    def calc_block(self, y, t0, t1, out):
+        """
+        Assign and return out[t-t0,i] = P(y(t)|s(t)=i) for t0 <= t < t1
+        """
+        self.log_calc_block(y, t0, t1, out)
+        # Cap the exponent at 300 to stop underflow
+        np.maximum(out, np.log(self.norm) - 300.0, out=out)
+        return np.exp(out, out=out)
+    def log_calc_block(self, y, t0, t1, out):
+        """
+        Assign and return out[t-t0,i] = log P(y(t)|s(t)=i) for t0 <= t < t1
+        """
+        out[:] = self._log_P([y[0][t0:t1], y[1][t0:t1]])
+        return out
+    def _log_P(self, y, states=slice(None)):
+        """
+        Return log P(y(t)|s(t)=i) for each t in y and each state i
+        in states
+        """
+        hr, context = y[:2]
+        d = hr - np.inner(self.A[states], context) # d[i,t]
+        return np.log(self.norm[states]) - (d*d).T/(2*self.Var[states])
+    def calc_states(self, y, t, states):
+        """
+        Return P[k,j] = P(y(t[k])|s(t[k])=states[j]) with the same
+        cap as calc_block
+        """
+        log_P = self._log_P([np.asarray(y[0])[t], y[1][t]], states)
+        np.maximum(log_P, np.log(self.norm[states]) - 300.0, out=log_P)
+        return np.exp(log_P, out=log_P)
+    def statistics(self, # Heart_Rate instance
                    w,    # w[t,i] = prob s(t) = i
                    y):
-        hr = y[0]
-        context = y[1]
-        n_y, dim = context.shape
+        r'''Calculate sufficient statistics for reestimate.  Statistics
+        from different records may be added elementwise and passed to
+        update().
+
+        Returns
+        -------
+        wsum : array
+            wsum[i] = \sum_t w[t,i]
+        G : array
+            Weighted Gram matrices.  G[i] = \sum_t w[t,i] c[t] c[t]^T
+            where c[t] = context[t]
+        g : array
+            g[i] = \sum_t w[t,i] c[t] hr[t]
+        h : array
+            h[i] = \sum_t w[t,i] hr[t]^2
+        '''
+        hr = np.asarray(y[0])
+        context = np.asarray(y[1])
         mask = w >= small    # Small weights confuse the residual
                              # calculation in least_squares()
         w2 = mask*w
         wsum = w2.sum(axis=0)
-        w1 = np.sqrt(w2)      # n_y x n_states array of weights
+        G = weighted_gram(w2, context, context)
+        g = np.dot(w2.T, context*hr.reshape((-1, 1)))
+        h = np.dot(hr*hr, w2)
+        return wsum, G, g, h
+    def update(self, # Heart_Rate instance
+               stats):
+        '''Assign A, Var and norm from the sufficient statistics
+        (wsum, G, g, h) of statistics().  Solve the normal equations
+        G[i] A[i] = g[i] for all states together, and use lstsq for
+        states with ill-conditioned G[i].
+        '''
+        wsum, G, g, h = stats
         # Inverse Wishart prior parameters.  Without data, sigma = b/a
         a = 4
         b = 16
-        for i in range(self.n_states):
-            w_hr = w1.T[i] * hr           # Tx1
-            w_context = (w1.T[i] * context.T).T # Tx(Dim-1)
-            A,resids,rank,s = LA.lstsq(w_context, w_hr)
-            z = w_hr - np.inner(w_context,A) # z[t] is a number
-            zz = float(np.inner(z,z))  # zz is a number
-            self.Var[i] = (b+zz)/(a+wsum[i])
-            self.A[i,:] = A
-            self.norm[i] = 1/math.sqrt(2*math.pi*self.Var[i])
+        A = solve_normal(G, g[..., np.newaxis])[..., 0]
+        # zz[i] = \sum_t w[t,i] (hr[t] - A[i] c[t])^2
+        zz = h - 2*np.einsum('ij,ij->i', A, g) + np.einsum(
+            'ij,ijk,ik->i', A, G, A)
+        zz = np.maximum(zz, 0)
+        self.A = A
+        self.Var = (b+zz)/(a+wsum)
+        self.norm = 1/np.sqrt(2*math.pi*self.Var)
+        self.bump_version()
         return
+    def reestimate(self, # Heart_Rate instance
+                   w,    # w[t,i] = prob s(t) = i
+                   y):
+        self.update(self.statistics(w, y))
+        return
+    def reestimate_states(self, # Heart_Rate instance
+                          parts, y):
+        '''Like reestimate, but with weights in blocks as described in
+        Scalar.Discrete_Observations.reestimate_states.  The
+        statistics of the states in each block come from the times of
+        that block only.
+        '''
+        hr, context = y[:2]
+        stats = None
+        for t, states, w in parts:
+            part = self.statistics(w, (np.asarray(hr)[t], context[t]))
+            if stats is None:
+                stats = [np.zeros((self.n_states,) + x.shape[1:])
+                         for x in part]
+            for x, p in zip(stats, part):
+                x[states] = p
+        self.update(stats)
 class Both(Resp):
     """ Observe both heart rate and respiration signals
     y = (hr, context, resp)
     """
+    P_Y = None
     def __init__(self, params):
         hr_params, resp_params = params
         self.hr_mod = Heart_Rate(hr_params)
@@ -416,11 +601,53 @@ class Both(Resp):
 and Respiration component:
 %s'''%(self.__class__,self.hr_mod, self.resp_mod)
     def calc(self,  # Both instance
-             y
+             y,
+             work=None
              ):
         hr, context, resp = y
-        self.P_Y = self.hr_mod.calc((hr, context)) * self.resp_mod.calc((resp,))
+        self.P_Y = initialize(self.P_Y, (len(hr), self.n_states), np.float64,
+                              work, (id(self), 'P_Y'))
+        np.multiply(self.hr_mod.calc((hr, context), work),
+                    self.resp_mod.calc((resp,), work), out=self.P_Y)
         return self.P_Y
+    def calc_block(self,  # Both instance
+                   y, t0, t1, out):
+        """
+        Assign and return out[t-t0,i] = P(y(t)|s(t)=i) for t0 <= t < t1
+        """
+        hr, context, resp = y
+        self.hr_mod.calc_block((hr, context), t0, t1, out)
+        out *= self.resp_mod.calc_block((resp,), t0, t1, np.empty_like(out))
+        return out
+    def log_calc(self,  # Both instance
+                 y,
+                 work=None
+                 ):
+        hr, context, resp = y
+        self.P_Y = initialize(self.P_Y, (len(hr), self.n_states), np.float64,
+                              work, (id(self), 'P_Y'))
+        np.add(self.hr_mod.log_calc((hr, context), work),
+               self.resp_mod.log_calc((resp,), work), out=self.P_Y)
+        return self.P_Y
+    def log_calc_block(self,  # Both instance
+                       y, t0, t1, out):
+        """
+        Assign and return out[t-t0,i] = log P(y(t)|s(t)=i) for t0 <= t < t1
+        """
+        hr, context, resp = y
+        self.hr_mod.log_calc_block((hr, context), t0, t1, out)
+        out += self.resp_mod.log_calc_block((resp,), t0, t1,
+                                            np.empty_like(out))
+        return out
+    def calc_states(self,  # Both instance
+                    y, t, states):
+        """
+        Return P[k,j] = P(y(t[k])|s(t[k])=states[j])
+        """
+        hr, context, resp = y
+        P = self.hr_mod.calc_states((hr, context), t, states)
+        P *= self.resp_mod.calc_states((resp,), t, states)
+        return P
     def reestimate(self, # Both instance
                    w,    # w[t,i] = prob s(t) = i
                    y):
@@ -428,6 +655,12 @@ and Respiration component:
         self.hr_mod.reestimate(w,(hr, context))
         self.resp_mod.reestimate(w,(resp,))
         return
+    def reestimate_states(self, # Both instance
+                          parts, y):
+        hr, context, resp = y
+        self.hr_mod.reestimate_states(parts, (hr, context))
+        self.resp_mod.reestimate_states(parts, (resp,))
+        return
 
 
 class fudge_pow(Both):
@@ -447,15 +680,74 @@ class fudge_pow(Both):
         self.pow = pow_
         self.s2c = s2c
     def calc(self,  # fudge_pow instance
-             y
+             y,
+             work=None
              ):
         hr, context, resp = y
-        self.P_Y = self.hr_mod.calc((hr, context))**self.pow
-        self.P_Y *= self.resp_mod.calc((resp,))
+        self.P_Y = initialize(self.P_Y, (len(hr), self.n_states), np.float64,
+                              work, (id(self), 'P_Y'))
+        np.power(self.hr_mod.calc((hr, context), work), self.pow, out=self.P_Y)
+        self.P_Y *= self.resp_mod.calc((resp,), work)
         for s in range(self.n_states):
             if self.s2c[s] == 0:
                 self.P_Y[:, s] *= self.fudge
         return self.P_Y
+    def calc_block(self,  # fudge_pow instance
+                   y, t0, t1, out):
+        """
+        Assign and return out[t-t0,i] = P(y(t)|s(t)=i) for t0 <= t < t1
+        """
+        hr, context, resp = y
+        self.hr_mod.calc_block((hr, context), t0, t1, out)
+        out **= self.pow
+        out *= self.resp_mod.calc_block((resp,), t0, t1, np.empty_like(out))
+        for s in range(self.n_states):
+            if self.s2c[s] == 0:
+                out[:, s] *= self.fudge
+        return out
+    def _log_fudge(self # fudge_pow instance
+                   ):
+        '''Return the log of the factor for each state
+        '''
+        return np.where(np.asarray(self.s2c) == 0, np.log(self.fudge), 0.0)
+    def log_calc(self,  # fudge_pow instance
+                 y,
+                 work=None
+                 ):
+        """
+        In the log domain the power is a multiplication and fudge is
+        an addition.
+        """
+        hr, context, resp = y
+        self.P_Y = initialize(self.P_Y, (len(hr), self.n_states), np.float64,
+                              work, (id(self), 'P_Y'))
+        np.multiply(self.hr_mod.log_calc((hr, context), work), self.pow,
+                    out=self.P_Y)
+        self.P_Y += self.resp_mod.log_calc((resp,), work)
+        self.P_Y += self._log_fudge()
+        return self.P_Y
+    def log_calc_block(self,  # fudge_pow instance
+                       y, t0, t1, out):
+        """
+        Assign and return out[t-t0,i] = log P(y(t)|s(t)=i) for t0 <= t < t1
+        """
+        hr, context, resp = y
+        self.hr_mod.log_calc_block((hr, context), t0, t1, out)
+        out *= self.pow
+        out += self.resp_mod.log_calc_block((resp,), t0, t1,
+                                            np.empty_like(out))
+        out += self._log_fudge()
+        return out
+    def calc_states(self,  # fudge_pow instance
+                    y, t, states):
+        """
+        Return P[k,j] = P(y(t[k])|s(t[k])=states[j])
+        """
+        hr, context, resp = y
+        P = self.hr_mod.calc_states((hr, context), t, states)**self.pow
+        P *= self.resp_mod.calc_states((resp,), t, states)
+        P *= np.where(np.asarray(self.s2c)[states] == 0, self.fudge, 1.0)
+        return P
 
 #Local Variables:
 #mode:python
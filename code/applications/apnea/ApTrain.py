@@ -63,9 +63,12 @@ def main(argv=None):
         args.record = PFsurvey.read_records(args.pass1)
     import pickle
     import ApOb
+    from hmm.Scalar import Class_y
     mod = pickle.load(open(args.mod_in, 'rb'))
     data_dict = ApOb.build_data(mod.y_mod, args)
-    mod.multi_train(list(data_dict.values()), args.iterations)
+    # Models with classified data only need the states of each class
+    mod.multi_train(list(data_dict.values()), args.iterations,
+                    gated=mod.y_mod.__class__ is Class_y)
     pickle.dump(mod, open(args.mod_out, 'wb'))
     return 0
 
@@ -5,6 +5,9 @@ borderline, or normal) for the entire record, then classify (normal or
 apnea) each minute in the record.
 
 Or if --Single, just do the first pass.
+
+With --processes, records are classified in parallel by a pool of
+worker processes that each load the models once.
 """
 Copyright = '''Copyright 2003, 2007, 2008, 2012 Andrew M. Fraser, and 2013
 Andrew M. Fraser and Los Alamos National Laboroatory
@@ -39,6 +42,64 @@ def load(name, fudge, power):
     s2c = model.y_mod.s2c
     model.y_mod.y_mod = ApOb.fudge_pow(y_mod_0, fudge, power, s2c)
     return model
+_worker = {} # Arguments and models of each worker process set by _init()
+def _init(args):
+    '''Load the models once in each worker process
+    '''
+    import pickle
+    _worker['args'] = args
+    _worker['Amod'] = pickle.load(open(args.Amodel, 'rb'))
+    _worker['BCmod'] = pickle.load(open(args.BCmodel, 'rb'))
+    if not args.Single:
+        _worker['Lmod'] = load(*args.Lmodel)
+        _worker['Mmod'] = load(*args.Mmodel)
+        _worker['Hmod'] = load(*args.Hmodel)
+def classify(record):
+    '''Classify one record and return its text for the report.  The
+    first line ends with the time in seconds spent on the record.
+    '''
+    import copy
+    import time
+    import numpy as np
+    import ApOb
+    import ApFeatures
+    from hmm.bank import ModelBank
+
+    t_start = time.time()
+    args = copy.copy(_worker['args'])
+    args.record = [record]
+    Amod = _worker['Amod']
+    BCmod = _worker['BCmod']
+    data = ApOb.build_data(Amod.y_mod, args)[record] # [hr, context, resp]
+    lp = data[0]              # Scalar low pass heart rate time series
+    T = len(lp)
+    R = ApFeatures.peak_ratio(lp, W=5, fraction=.74)
+    # Calculate the log likelihood ratio
+    A, BC = ModelBank([Amod, BCmod]).log_likelihoods([data])[:, 0]
+    llr = (A - BC)/T
+
+    stat = R + .5*llr           # Was 0.5
+    if stat < args.low_line:    # Was 2.39
+        Name = 'Low'
+        if not args.Single:
+            model = _worker['Lmod']
+    elif stat > args.high_line: # Was 2.55
+        Name = 'High'
+        if not args.Single:
+            model = _worker['Hmod']
+            # Need build_data for Hmod because its AR order is different
+            data = ApOb.build_data(model.y_mod, args, use_class=False)[record]
+    else:
+        Name = 'Medium'
+        if not args.Single:
+            model = _worker['Mmod']
+    head = '%3s # %-6s stat= %6.3f llr= %6.3f R= %6.3f'%(
+        record, Name, stat, llr, R)
+    if args.Single:
+        return '%s time= %7.2f\n'%(head, time.time() - t_start)
+    Cseq = (np.array(model.class_decode(data)) - 0.5)*2.0 # +/- 1
+    body = ApFeatures.format_minutes(Cseq)
+    return '%s time= %7.2f%s'%(head, time.time() - t_start, body)
 def main(argv=None):
     
     import argparse
@@ -73,87 +134,23 @@ def main(argv=None):
         help='(name, fudge, power) model for records that have high score')
     parser.add_argument('--expert', type=str,
                        help='Path to file of expert annotations')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='Number of worker processes for records')
     parser.add_argument('record', type=str, nargs='*',
                        help='Record names, eg, a01 a02 ... c09')
     args = parser.parse_args(argv)
 
-    import numpy as np
-    import ApOb
-    import pickle
+    import multiprocessing
 
+    if args.processes > 1:
+        with multiprocessing.Pool(args.processes, _init, (args,)) as pool:
+            texts = pool.map(classify, args.record, chunksize=1)
+    else:
+        _init(args)
+        texts = map(classify, args.record)
     report = open(args.report, 'w')
-    Amod = pickle.load(open(args.Amodel, 'rb'))
-    BCmod = pickle.load(open(args.BCmodel, 'rb'))
-    if not args.Single:
-        Lmod = load(*args.Lmodel)
-        Mmod = load(*args.Mmodel)
-        Hmod = load(*args.Hmodel)
-    data_dict = ApOb.build_data(Amod.y_mod, args) # data [hr, context, resp]
-    # Need h_data because AR order for Hmod is different
-    if not args.Single:
-        h_data = ApOb.build_data(Hmod.y_mod, args, use_class=False)
-    for record in args.record:
-        data = data_dict[record]
-        lp = data[0]              # Scalar low pass heart rate time series
-        T = len(lp)
-        peaks = []
-        L1 = np.abs(lp).sum()/T      # L1 norm of lp per sample
-        W = 5                        # Window size for peaks
-        #peaks = lp[scipy.signal.argrelmax(lp, order=W)]
-        peaks = []
-        for t in range(W,T-W):
-            s = lp[t-W:t+W].argmax()
-            if s == W and lp[t] > 0:
-                peaks.append(lp[t])
-        peaks.sort()
-        R = peaks[int(.74*len(peaks))]/L1
-        # Calculate the log likelihood ratio
-        Amod.P_Y_calc(data)
-        A = Amod.forward()
-        BCmod.P_Y_calc(data)
-        BC = BCmod.forward()
-        llr = (A - BC)/T
-
-        stat = R + .5*llr           # Was 0.5
-        if stat < args.low_line:    # Was 2.39
-            Name = 'Low'
-            if not args.Single:
-                model = Lmod
-        elif stat > args.high_line: # Was 2.55
-            Name = 'High'
-            if not args.Single:
-                model = Hmod
-                data = h_data[record]
-        else:
-            Name = 'Medium'
-            if not args.Single:
-                model = Mmod
-        print('%3s # %-6s stat= %6.3f llr= %6.3f R= %6.3f'%(
-            record, Name, stat, llr, R), end='', file=report)
-        if args.Single:
-            print('', file=report)
-            continue
-        Cseq = (np.array(model.class_decode(data)) - 0.5)*2.0 # +/- 1
-        sam_min = 10  # Samples per minute
-        min_hour = 60
-        sam_hour = 60*sam_min
-        for h in range(0, len(Cseq)//sam_hour+1):
-            print('\n%-2d   '%h, end='', file=report)
-            for m in range(0, 60):
-                tot = 0
-                for d in range(sam_min):
-                    t = d + sam_min * m + sam_hour * h
-                    if t >= len(Cseq):
-                        break
-                    tot += Cseq[t] 
-                if t > len(Cseq):
-                    break
-                if tot > 0:
-                    print('A',end='', file=report)
-                else:
-                    print('N',end='', file=report)
-        print('\n',end='', file=report)
-
+    for text in texts: # In the order of args.record
+        print(text, end='', file=report)
     return 0
         
 if __name__ == "__main__":
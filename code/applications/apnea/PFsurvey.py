@@ -1,6 +1,8 @@
 """ PFsurvey.py
 
-Takes 49 minutes per point
+Takes 49 minutes per point.  The heart rate and respiration
+likelihoods are calculated once, and --processes workers evaluate the
+points of the power x fudge grid in parallel.
 
 This file is part of HMM_DS_Code you can redistribute it and/or modify it under
 the terms of the GNU General Public License as published by the Free Software
@@ -34,20 +36,60 @@ def read_records(report):
     report[1] and that have classification data (no "x" files).
 
     '''
-    records = []
-    for line in open(report[0], 'r'):
-        parts = line.split()
-        if parts[2] != report[1]:
-            continue
-        if parts[0].startswith('x'):
-            continue
-        records.append(parts[0])
+    import ApFeatures
+    records = [r['record'] for r in ApFeatures.read_report(report[0])
+               if r['group'] == report[1] and not r['record'].startswith('x')]
     records.sort() # For easier reading and debugging
     return records
+class Survey_Observations:
+    '''Stands in for ApOb.fudge_pow in HMM.class_decode.  Rather than
+    evaluating the heart rate and respiration models, calc derives
+    P_Y = hr**power * resp * (fudge for normal states) from cached
+    logs of the component likelihoods.
+
+    '''
+    def __init__(self, log_hr, log_resp, fudge, power, s2c):
+        self.log_hr = log_hr
+        self.log_resp = log_resp
+        self.fudge = fudge
+        self.power = power
+        self.s2c = s2c
+    def calc(self, y, work=None):
+        import numpy as np
+        P_Y = self.power*self.log_hr
+        P_Y += self.log_resp
+        P_Y[:, self.s2c == 0] += np.log(self.fudge)
+        return np.exp(P_Y, out=P_Y)
+def log_components(y_mod, y):
+    '''Return logs of the heart rate and respiration likelihoods of
+    the ApOb.Both instance y_mod for data y = (hr, context, resp).
+    '''
+    import numpy as np
+    hr, context, resp = y
+    with np.errstate(divide='ignore'):
+        return (np.log(y_mod.hr_mod.calc((hr, context))),
+                np.log(y_mod.resp_mod.calc((resp,))))
+_survey = {} # State of each worker process set by _init()
+def _init(model, data_class, log_hr, log_resp):
+    _survey.update(model=model, data_class=data_class, log_hr=log_hr,
+                   log_resp=log_resp)
+def _point(power_fudge):
+    '''Return the fraction of correctly classified samples for one
+    point of the grid
+    '''
+    power, fudge = power_fudge
+    model = _survey['model']
+    data_class = _survey['data_class']
+    model.y_mod.y_mod = Survey_Observations(
+        _survey['log_hr'], _survey['log_resp'], fudge, power,
+        model.y_mod.s2c)
+    errors = model.class_decode(data_class[1:]) ^ data_class[0]
+    return 1.0 - errors.sum()/len(data_class[0])
 def main(argv=None):
     
     import argparse
     import pickle
+    import multiprocessing
     import numpy as np
     import ApOb
     if argv is None:                    # Usual case
@@ -70,6 +112,8 @@ def main(argv=None):
               help='from, to, step for study.  Suggest 0.8 1.61 .05')
     parser.add_argument('out', type=str,
                         help='Location to put result')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='Number of worker processes.  Default: all CPUs')
     args = parser.parse_args(argv)
 
     args.record = read_records(args.report)
@@ -77,17 +121,16 @@ def main(argv=None):
     y_mod_0 = model.y_mod.y_mod
     n_seg, segs, data_class = model.y_mod.join(list(ApOb.build_data(
         model.y_mod, args).values()))
-    n_y = len(data_class[0])
-    data = data_class[1:]
-    # data [class, hr, context, resp]
-    s2c = model.y_mod.s2c
+    # data_class [class, hr, context, resp]
+    log_hr, log_resp = log_components(y_mod_0, data_class[1:])
+    grid = [(power, fudge) for power in np.arange(*args.power)
+            for fudge in np.arange(*args.fudge)]
+    with multiprocessing.Pool(args.processes, _init,
+                              (model, data_class, log_hr, log_resp)) as pool:
+        results = pool.map(_point, grid)
     out = open(args.out, 'w')
-    for power in np.arange(*args.power):
-        for fudge in np.arange(*args.fudge):
-            model.y_mod.y_mod = ApOb.fudge_pow(y_mod_0, fudge, power, s2c)
-            errors = model.class_decode(data) ^ data_class[0]
-            frac_right = 1.0 - errors.sum()/n_y
-            print('%5.3f  %5.3f  %6.4f'%(power,fudge,frac_right), file=out)
+    for (power, fudge), frac_right in zip(grid, results):
+        print('%5.3f  %5.3f  %6.4f'%(power,fudge,frac_right), file=out)
     return 0
         
 if __name__ == "__main__":
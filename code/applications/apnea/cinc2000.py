@@ -22,43 +22,32 @@ See the file gpl.txt in the root directory of the hmmds3 distribution
 or see <http://www.gnu.org/licenses/>.
 '''
 import numpy as N
-#Returns dictionary.  Keys are wfdb record names, eg, 'a01' and values
-#are strings, eg, 'NNNNNNNNNNNNNAAAAA...AAAAAAAAA'
-def ReadIn(FileName):
-    fp = open(FileName)
+def parse_summary(FileName):
+    """Parse an expert summary file, eg, summary_of_training, in one
+    pass.  Text after '#' is a comment.  A line with one word starts
+    a record, and each line with two words, an hour and a string of
+    'A' (apnea) and 'N' (normal) characters for its minutes, extends
+    the current record.  Other lines are ignored.
+
+    Returns a dictionary.  Keys are wfdb record names, eg, 'a01' and
+    values are strings, eg, 'NNNNNNNNNNNNNAAAAA...AAAAAAAAA'
+    """
     d = {}
-    # Get first record name by finding a line with len(parts) == 1
-    line = fp.readline()
-    for i in range(len(line)):
-        if line[i] == '#': # drop comments, ie ' # words ...'
-            line = line[:i]
-            break
-    parts = line.split()
-    while not len(parts) == 1:
-        line = fp.readline()
-        parts = line.split()
-    key = parts[0]
-    value = []
-    # Read rest of the file
-    lines = fp.readlines()
-    if len(lines) < 4:
-        raise RuntimeError("Less than 4 lines after record in file: %s"%
-                           FileName)
-    for line in lines:
-        for i in range(len(line)):
-            if line[i] == '#': # drop comments, ie ' # words ...'
-                line = line[:i]
-                break
-        parts = line.split()
-        if len(parts) == 0: # Empty line
-            continue
-        if len(parts) == 2: # Classification data for current record
-            value += parts[1]
+    value = None
+    for line in open(FileName):
+        parts = line.split('#', 1)[0].split()
         if len(parts) == 1: # New record name
-            d[key] = value
-            key = parts[0]
-            value = []
-    d[key] = value
+            value = d[parts[0]] = []
+        elif len(parts) == 2 and value is not None:
+            value.append(parts[1])
+    return dict((key, ''.join(value)) for key, value in d.items())
+def ReadIn(FileName):
+    """Returns dictionary.  Keys are wfdb record names, eg, 'a01' and
+    values are strings, eg, 'NNNNNNNNNNNNNAAAAA...AAAAAAAAA'
+    """
+    d = parse_summary(FileName)
+    if len(d) == 0:
+        raise RuntimeError("No records in file: %s"%FileName)
     return d
 
 def As_Ns_2_Nums(AN,S_min=10,val_A=1,val_N=0):
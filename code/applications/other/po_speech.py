@@ -76,16 +76,21 @@ def all2words(all):
     return words, merge, word_list
 
 def random_hmm(Card_Y, N_states):
-    '''
+    '''Make an HMM with random parameters.  Every state can emit
+    every word, since reestimation never makes a zero of P(y|s)
+    nonzero.  Sparse_Discrete_Observations stores P(y|s) in its
+    compact form and drops entries as they vanish in training.
     '''
 
     from hmm.C import HMM
     from hmm.Scalar import make_random as random
+    from hmm.Scalar import Sparse_Discrete_Observations
     P_S0 = random((1,N_states))[0]
     P_S0_ergodic = random((1,N_states))[0]
     P_ScS = random((N_states,N_states))
     P_YcS = random((N_states,Card_Y))
-    return HMM(P_S0, P_S0_ergodic, P_YcS, P_ScS)
+    return HMM(P_S0, P_S0_ergodic, P_YcS, P_ScS,
+               Sparse_Discrete_Observations)
 
 def main(argv=None):
     if argv is None:                    # Usual case
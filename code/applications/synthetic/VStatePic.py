@@ -41,6 +41,7 @@ def main(argv=None):
     '''
     from os.path import join
     from MakeModel import skip_header
+    from hmm.Scalar import LaggedContext
 
     if argv is None:                    # Usual case
         argv = sys.argv[1:]
@@ -56,9 +57,9 @@ def main(argv=None):
     N_states = 12
 
     data = vectors[1:, :]
-    context = np.empty((n_y, Cdim))
-    context[:,:-1] = vectors[:-1,:]
-    context[:,-1] = 1
+    # VARG uses every row of the context in each calc and reestimate,
+    # so build the dense array once rather than once per use
+    context = np.asarray(LaggedContext(vectors, 1, bias='last')[1:])
     Y = [data, context]
 
     states = np.array(# Read in time series of states
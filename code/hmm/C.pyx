@@ -33,100 +33,294 @@ warnings.simplefilter('ignore', SS.SparseEfficiencyWarning)
 # Imitate http://docs.cython.org/src/tutorial/numpy.html
 # http://docs.cython.org/src/userguide/memoryviews.html
 cimport cython, numpy as np
+cimport openmp
+from cython.parallel cimport prange, threadid
+from cython cimport floating
+from libc.math cimport log
 DTYPE = np.float64
 ITYPE = np.int32
 ctypedef np.float64_t DTYPE_t
 ctypedef np.int32_t ITYPE_t
-class HMM(base.HMM):
-    '''A Cython subclass of HMM that implments methods forward, backward
-    and reestimate-s for speed'''
-
-    @cython.boundscheck(False)
-    def forward(self # HMM
-    ):
-        # Ensure allocation and size of alpha and gamma
-        self.alpha = Scalar.initialize(self.alpha,(self.n_y,self.n_states))
-        self.gamma = Scalar.initialize(self.gamma,(self.n_y,))
-
-        # Make views of numpy arrays
-        cdef DTYPE_t [:] gamma = self.gamma
-        cdef DTYPE_t [:,:] alpha = self.alpha
-        cdef DTYPE_t [:,:] P_SS = self.P_SS
-        cdef DTYPE_t [:,:] P_Y = self.P_Y
-
-        # Make double buffer for calculations
-        cdef double *_next, *_last
-        scratch = np.empty((2,self.n_states))
-        scratch[0,:] = self.P_S0
-        cdef DTYPE_t [:, :] next_last = scratch
-
-        cdef int t, i, j
-        cdef int N = self.n_states
-        cdef int T = self.n_y
-
-        # iterate
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef double _forward(
+        floating [:,:] P_Y,   # P_Y[t,i] = Prob(y(t)|s(t)=i)
+        DTYPE_t [:,:] P_SS,   # P_SS[i,j] = Prob(s(t+1)=j|s(t)=i)
+        DTYPE_t [:] P_S0,     # Initial distribution of states
+        floating [:,:] alpha, # Output
+        DTYPE_t [:] gamma,    # Output
+        DTYPE_t [:,:] scratch # Double buffer with shape (2,N)
+        ) nogil:
+    """Forward recursion without the GIL.  Returns the log likelihood.
+
+    P_Y and alpha may be either float32 or float64.  The recursion
+    itself runs in double precision.
+    """
+    cdef double *_next
+    cdef double *_last
+    cdef int t, i, j
+    cdef int N = P_SS.shape[0]
+    cdef int T = P_Y.shape[0]
+    cdef double LL = 0
+    for i in range(N):
+        scratch[0,i] = P_S0[i]
+    for t in range(T):
+        _last = &scratch[t%2,0]
+        _next = &scratch[(t+1)%2,0]
+        for i in range(N):
+            _last[i] = _last[i]*P_Y[t,i]
+        gamma[t] = 0
+        for i in range(N):
+            gamma[t] += _last[i]
+        for i in range(N):
+            _last[i] /= gamma[t]
+            alpha[t,i] = _last[i]
+        for i in range(N):
+            _next[i] = 0
+            for j in range(N):
+                _next[i] += _last[j] * P_SS[j,i]
+        LL += log(gamma[t])
+    return LL
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef int _backward(
+        floating [:,:] P_Y,
+        DTYPE_t [:,:] P_SS,
+        DTYPE_t [:] gamma,
+        DTYPE_t [:] last,     # beta[T-1]
+        floating [:,:] beta,  # Output
+        DTYPE_t [:,:] scratch # Double buffer with shape (2,N)
+        ) nogil:
+    """Backward recursion without the GIL.  Returns 0.  On return
+    scratch[1] holds beta for the time before the block.
+    """
+    cdef double *_next
+    cdef double *_last
+    cdef int t, i, j
+    cdef int N = P_SS.shape[0]
+    cdef int T = P_Y.shape[0]
+    for i in range(N):
+        scratch[(T-1)%2,i] = last[i]
+    for t in range(T-1,-1,-1):
+        _last = &scratch[t%2,0]
+        _next = &scratch[(t+1)%2,0]
+        for i in range(N):
+            beta[t,i] = _last[i]
+            _last[i] *= P_Y[t,i]/gamma[t]
+        for i in range(N):
+            _next[i] = 0
+            for j in range(N):
+                _next[i] += P_SS[i,j] * _last[j]
+    return 0
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef double _log_likelihood(
+        floating [:,:] P_Y,   # P_Y[t,i] = Prob(y(t)|s(t)=i)
+        DTYPE_t [:,:] P_SS,   # P_SS[i,j] = Prob(s(t+1)=j|s(t)=i)
+        DTYPE_t [:] last,     # State distribution.  Updated in place
+        DTYPE_t [:] scratch   # Shape (N,)
+        ) nogil:
+    """Forward recursion that keeps only the current state
+    distribution and returns the sum of log(gamma[t]).
+    """
+    cdef int t, i, j
+    cdef int N = P_SS.shape[0]
+    cdef int T = P_Y.shape[0]
+    cdef double gamma, LL = 0
+    for t in range(T):
+        gamma = 0
+        for i in range(N):
+            last[i] = last[i]*P_Y[t,i]
+            gamma += last[i]
+        for i in range(N):
+            last[i] /= gamma
+        LL += log(gamma)
+        for i in range(N):
+            scratch[i] = 0
+            for j in range(N):
+                scratch[i] += last[j] * P_SS[j,i]
+        for i in range(N):
+            last[i] = scratch[i]
+    return LL
+def _ll_kernel(floating [:,:] P_Y, DTYPE_t [:,:] P_SS, DTYPE_t [:] last):
+    cdef DTYPE_t [:] scratch = np.empty(P_SS.shape[0])
+    cdef double LL
+    with nogil:
+        LL = _log_likelihood(P_Y, P_SS, last, scratch)
+    return LL
+def _forward_kernel(floating [:,:] P_Y, DTYPE_t [:,:] P_SS,
+                    DTYPE_t [:] P_S0, floating [:,:] alpha, DTYPE_t [:] gamma):
+    """Returns the state distribution for the time after the block.
+    """
+    scratch = np.empty((2,P_SS.shape[0]))
+    cdef DTYPE_t [:, :] _scratch = scratch
+    with nogil:
+        _forward(P_Y, P_SS, P_S0, alpha, gamma, _scratch)
+    return scratch[P_Y.shape[0]%2]
+def _backward_kernel(floating [:,:] P_Y, DTYPE_t [:,:] P_SS,
+                     DTYPE_t [:] gamma, DTYPE_t [:] last, floating [:,:] beta):
+    """Returns beta for the time before the block.
+    """
+    scratch = np.empty((2,P_SS.shape[0]))
+    cdef DTYPE_t [:, :] _scratch = scratch
+    with nogil:
+        _backward(P_Y, P_SS, gamma, last, beta, _scratch)
+    return scratch[1]
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _segments_kernel(
+        floating [:,:] P_Y, DTYPE_t [:,:] P_SS, ITYPE_t [:] bounds,
+        floating [:,:] alpha, floating [:,:] beta, DTYPE_t [:] gamma,
+        DTYPE_t [:,:] P_S0, DTYPE_t [:] LL):
+    """Forward and backward passes on each segment in OpenMP threads.
+    Each thread has its own scratch buffer and writes to disjoint
+    slices of the arrays.
+    """
+    cdef DTYPE_t [:,:,:] scratch = np.empty(
+        (openmp.omp_get_max_threads(), 2, P_SS.shape[0]))
+    cdef DTYPE_t [:] ones = np.ones(P_SS.shape[0])
+    cdef int seg, i, b0, b1, tid
+    cdef int N = P_SS.shape[0]
+    cdef int n = bounds.shape[0] - 1
+    for seg in prange(n, nogil=True, schedule='dynamic'):
+        tid = threadid()
+        b0 = bounds[seg]
+        b1 = bounds[seg+1]
+        LL[seg] = _forward(P_Y[b0:b1], P_SS, P_S0[seg], alpha[b0:b1],
+                           gamma[b0:b1], scratch[tid])
+        _backward(P_Y[b0:b1], P_SS, gamma[b0:b1], ones, beta[b0:b1],
+                  scratch[tid])
+        for i in range(N):
+            P_S0[seg,i] = alpha[b0,i] * beta[b0,i]
+        gamma[b0] = -1 # Don't fit transitions between segments
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _reestimate_kernel(
+        floating [:,:] P_Y, floating [:,:] alpha, floating [:,:] beta,
+        DTYPE_t [:] gamma, DTYPE_t [:,:] wsum, DTYPE_t [:,:,:] usum):
+    """Accumulate the sums over time for reestimate() in OpenMP
+    threads.  Thread tid accumulates in wsum[tid] and usum[tid].
+    Replaces alpha by alpha*beta.
+    """
+    cdef int t, i, j, tid
+    cdef int N = alpha.shape[1]
+    cdef int T = alpha.shape[0]
+    for t in prange(T-1, nogil=True, schedule='static'):
+        tid = threadid()
+        for i in range(N):
+            if gamma[t+1] > 0: # Skip over segment boundaries
+                for j in range(N):
+                    usum[tid,i,j] += (alpha[t,i]*beta[t+1,j]*P_Y[t+1,j]
+                                      /gamma[t+1])
+            alpha[t,i] *= beta[t,i]
+            wsum[tid,i] += alpha[t,i]
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _gated_forward_kernel(
+        DTYPE_t [:,:] P_Yc, ITYPE_t [:] c, DTYPE_t [:,:,:,:] sub,
+        DTYPE_t [:] last, DTYPE_t [:,:] alpha, DTYPE_t [:] gamma):
+    """Forward recursion over the states of class c[t] at each time.
+    See base.HMM._gates for the compact arrays.  Overwrites last.
+    """
+    cdef DTYPE_t [:] _next = np.empty(P_Yc.shape[1])
+    cdef int t, i, j, a, b
+    cdef int n = P_Yc.shape[1]
+    cdef int T = P_Yc.shape[0]
+    with nogil:
         for t in range(T):
-            _last = &next_last[t%2,0]
-            _next = &next_last[(t+1)%2,0]
-            for i in range(N):
-                _last[i] = _last[i]*P_Y[t,i]
+            if t > 0:
+                a = c[t-1]
+                b = c[t]
+                for j in range(n):
+                    _next[j] = 0
+                for i in range(n):
+                    if last[i] == 0:
+                        continue
+                    for j in range(n):
+                        _next[j] += last[i] * sub[a,b,i,j]
+                for j in range(n):
+                    last[j] = _next[j]
             gamma[t] = 0
-            for i in range(N):
-                gamma[t] += _last[i]
-            for i in range(N):
-                _last[i] /= gamma[t]
-                alpha[t,i] = _last[i]
-            for i in range(N):
-                _next[i] = 0
-                for j in range(N):
-                    _next[i] += _last[j] * P_SS[j,i]
-        return (np.log(self.gamma)).sum() # End of forward()
-    @cython.boundscheck(False)
-    def backward(self # HMM
-    ):
-        # Ensure allocation and size of beta
-        self.beta = Scalar.initialize(self.beta,(self.n_y,self.n_states))
-
-        # Make views of numpy arrays
-        cdef DTYPE_t [:] gamma = self.gamma
-        cdef DTYPE_t [:,:] beta = self.beta
-        cdef DTYPE_t [:,:] P_SS = self.P_SS
-        cdef DTYPE_t [:,:] P_Y = self.P_Y
-
-        # Make double buffer for calculations
-        cdef double *_next, *_last
-        scratch = np.ones((2,self.n_states))
-        cdef DTYPE_t [:, :] next_last = scratch
-
-        cdef int t,i,j
-        cdef int N = self.n_states
-        cdef int T = self.n_y
+            for i in range(n):
+                last[i] *= P_Yc[t,i]
+                gamma[t] += last[i]
+            for i in range(n):
+                last[i] /= gamma[t]
+                alpha[t,i] = last[i]
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _gated_backward_kernel(
+        DTYPE_t [:,:] P_Yc, ITYPE_t [:] c, DTYPE_t [:,:,:,:] sub,
+        DTYPE_t [:] gamma, DTYPE_t [:,:] beta):
+    """Backward recursion over the states of class c[t] at each time.
+    """
+    cdef DTYPE_t [:] last = np.ones(P_Yc.shape[1])
+    cdef DTYPE_t [:] _w = np.empty(P_Yc.shape[1])
+    cdef int t, i, j, a, b
+    cdef int n = P_Yc.shape[1]
+    cdef int T = P_Yc.shape[0]
+    with nogil:
+        for t in range(T-1, -1, -1):
+            for i in range(n):
+                beta[t,i] = last[i]
+                _w[i] = last[i]*P_Yc[t,i]/gamma[t]
+            if t > 0:
+                a = c[t-1]
+                b = c[t]
+                for i in range(n):
+                    last[i] = 0
+                    for j in range(n):
+                        last[i] += sub[a,b,i,j] * _w[j]
+class HMM(base.HMM):
+    '''A Cython subclass of HMM that implments methods forward, backward
+    and reestimate-s for speed.  Like base.HMM it supports
+    dtype=np.float32.'''
+
+    def _forward_block(self, # HMM
+                       P_Y, last, alpha, gamma):
+        return _forward_kernel(P_Y, self.P_SS, last, alpha, gamma)
+    def _backward_block(self, # HMM
+                        P_Y, last, beta, gamma):
+        return _backward_kernel(P_Y, self.P_SS, gamma, last, beta)
+    def _ll_block(self, # HMM
+                  P_Y, last):
+        return _ll_kernel(P_Y, self.P_SS, last)
+    def _forward_gated_block(self, # HMM
+                             P_Yc, c, sub, last, alpha_c, gamma):
+        _gated_forward_kernel(P_Yc, c, sub, np.array(last, DTYPE), alpha_c,
+                              gamma)
+    def _backward_gated_block(self, # HMM
+                              P_Yc, c, sub, gamma, beta_c):
+        _gated_backward_kernel(P_Yc, c, sub, gamma, beta_c)
+    def multi_forward_backward(
+            self,      # HMM
+            P_Y_all, t_seg, alpha_all, beta_all, gamma_all, P_S0_all):
+        """Like base.HMM.multi_forward_backward, but the segments are
+        processed by OpenMP threads without the GIL.
 
-        # iterate
-        for t in range(T-1,-1,-1):
-            _last = &next_last[t%2,0]
-            _next = &next_last[(t+1)%2,0]
-            for i in range(N):
-                beta[t,i] = _last[i]
-                _last[i] *= P_Y[t,i]/gamma[t]
-            for i in range(N):
-                _next[i] = 0
-                for j in range(N):
-                    _next[i] += P_SS[i,j] * _last[j]
-        return # End of backward()
-    @cython.boundscheck(False)
+        """
+        LL = np.empty(len(t_seg) - 1)
+        _segments_kernel(P_Y_all, self.P_SS, np.array(t_seg, ITYPE),
+                         alpha_all, beta_all, gamma_all, P_S0_all, LL)
+        if self.log_shift is not None:
+            LL += np.add.reduceat(self.log_shift, t_seg[:-1])
+        return LL
     def reestimate(self, # HMM
-                   y):
+                   y, u_sum=None):
         """Reestimate state transition probabilities and initial
         state probabilities.
 
         Given the observation probabilities, ie, self.state[s].P_Y[t],
         given alpha, beta, gamma, and Py, these calcuations are
-        independent of the observation model calculations.
+        independent of the observation model calculations.  The sums
+        over time are split among OpenMP threads that accumulate into
+        their own rows of wsum and usum in double precision.
 
         Parameters
         ----------
         y : sequence
+        u_sum : array, optional
+            Sums for reestimating P_SS from backward_fused
 
         Returns
         -------
@@ -134,39 +328,24 @@ class HMM(base.HMM):
             State probabilities given all observations
 
         """
-
-        cdef np.ndarray[DTYPE_t, ndim=1] wsum = np.zeros(
-            self.n_states, np.float64)
-        cdef np.ndarray[DTYPE_t, ndim=2] usum = np.zeros(
-            (self.n_states,self.n_states),np.float64)
-
-        # Make views of numpy arrays
-        cdef DTYPE_t [:] gamma = self.gamma
-        cdef DTYPE_t [:,:] alpha = self.alpha
-        cdef DTYPE_t [:,:] beta = self.beta
-        cdef DTYPE_t [:,:] P_Y = self.P_Y
-        cdef DTYPE_t [:] _wsum = wsum
-        cdef DTYPE_t [:,:] _usum = usum
-
-        cdef int t,i,j
-        cdef int N = self.n_states
-        cdef int T = self.n_y
-
-        for t in range(T-1):
-            if gamma[t] == 0:
-                continue       # Skip over segment boundaries
-            for i in range(N):
-                for j in range(N):
-                    _usum[i,j] += alpha[t,i]*beta[t+1,j]*P_Y[t+1,j]/gamma[t+1]
-                alpha[t,i] *= beta[t,i]
-                _wsum[i] += alpha[t,i]
-        #Alpha[T-1,:] *= Beta[T-1,:] but Beta[T-1,:] = 1
-        wsum += self.alpha[T-1]
+        if u_sum is None:
+            n_threads = openmp.omp_get_max_threads()
+            wsum = np.zeros((n_threads, self.n_states), np.float64)
+            usum = np.zeros((n_threads, self.n_states, self.n_states),
+                            np.float64)
+            _reestimate_kernel(self.P_Y, self.alpha, self.beta, self.gamma,
+                               wsum, usum)
+            #Alpha[T-1,:] *= Beta[T-1,:] but Beta[T-1,:] = 1
+            wsum = wsum.sum(axis=0) + self.alpha[self.n_y-1]
+            u_sum = usum.sum(axis=0)
+        else:
+            self.alpha *= self.beta
+            wsum = self.alpha.sum(axis=0, dtype=np.float64)
         self.P_S0_ergodic = np.copy(wsum)
-        self.P_S0 = np.copy(self.alpha[0])
+        self.P_S0 = np.array(self.alpha[0], np.float64)
         for x in (self.P_S0_ergodic, self.P_S0):
             x /= x.sum()
-        self.P_SS.inplace_elementwise_multiply(usum)
+        self.P_SS.inplace_elementwise_multiply(u_sum)
         self.P_SS.normalize()
         self.y_mod.reestimate(self.alpha, y)
         return # End of reestimate()
@@ -348,7 +527,8 @@ class Discrete_Observations(Scalar.Discrete_Observations):
     @cython.boundscheck(False)
     def calc(
         self,    # Discrete_Observations instance
-        y_       # A list with a sequence of integer observations
+        y_,      # A list with a sequence of integer observations
+        work=None # Optional Workspace for self.P_Y
         ):
         """
         Allocate self.P_Y and assign values self.P_Y[t,i] = P(y(t)|s(t)=i)
@@ -357,6 +537,8 @@ class Discrete_Observations(Scalar.Discrete_Observations):
         ----------
         y : array
             A sequence of integer observations
+        work : Workspace, optional
+            Source of reusable memory for the result
 
         Returns
         -------
@@ -367,8 +549,9 @@ class Discrete_Observations(Scalar.Discrete_Observations):
         y = y_[0]
         n_y = len(y)
         n_states = self.P_YS.shape[0]
-        self.P_Y = np.zeros((n_y, n_states), dtype=DTYPE)
-        #Scalar.initialize(self.P_Y, (n_y, n_states))#Causes occasional failure
+        self.P_Y = Scalar.initialize(self.P_Y, (n_y, n_states), DTYPE, work,
+                                     (id(self), 'P_Y'))
+        self.P_Y.fill(0)
 
         cdef DTYPE_t [:,:] P_Y = self.P_Y
         cdef ITYPE_t [:] Y = y
@@ -384,6 +567,7 @@ class Discrete_Observations(Scalar.Discrete_Observations):
                 J = indices[j]
                 P_Y[t,J] = data[j]
         return self.P_Y # End of p_y_calc()
+    @cython.boundscheck(False)
     def reestimate(self, # Discrete_Observations
                  w,y_):
         """
@@ -406,10 +590,38 @@ class Discrete_Observations(Scalar.Discrete_Observations):
         if not type(y) == np.ndarray:
             y = np.array(y, np.int32)
         assert(y.dtype == np.int32 and y.shape == (n_y,))
-        for yi in range(self.P_YS.shape[1]):
-            self.P_YS.assign_col(
-                yi, w.take(np.where(y==yi)[0], axis=0).sum(axis=0))
+        assert n_y == 0 or y.max() < self.P_YS.shape[1]
+        # Accumulate w[t,J] directly into the stored entries of column
+        # y[t].  Normally w[t,J] is zero unless P_YS[J,y[t]] is stored
+        # and the sparsity pattern does not change.
+        cdef DTYPE_t [:,:] W = np.asarray(w, DTYPE)
+        cdef ITYPE_t [:] Y = y
+        cdef DTYPE_t [:] data = self.P_YS.data
+        cdef ITYPE_t [:] indices = self.P_YS.indices
+        cdef ITYPE_t [:] indptr = self.P_YS.indptr
+        cdef int T = n_y
+        cdef int N = self.P_YS.shape[0]
+        cdef int t,i,j,J
+        cdef long missed = 0 # Nonzero weights outside of the pattern
+        data[:] = 0
+        for t in range(T):
+            i = Y[t]
+            for J in range(N):
+                if W[t,J] != 0:
+                    missed += 1
+            for j in range(indptr[i],indptr[i+1]):
+                if W[t,indices[j]] != 0:
+                    missed -= 1
+                data[j] += W[t,indices[j]]
+        if missed > 0: # Rebuild the pattern from the nonzero weights
+            t_, s_ = np.nonzero(w)
+            new = SS.csc_matrix((np.asarray(w, DTYPE)[t_, s_], (s_, y[t_])),
+                                shape=self.P_YS.shape)
+            self.P_YS.data = new.data
+            self.P_YS.indices = new.indices.astype(ITYPE)
+            self.P_YS.indptr = new.indptr.astype(ITYPE)
         self.P_YS.normalize()
+        self.bump_version()
         return
 class HMM_SPARSE(base.HMM):
     '''HMM code that uses sparse matrices for state to state and state to
@@ -423,6 +635,38 @@ class HMM_SPARSE(base.HMM):
         base.HMM.__init__(self, P_S0, P_S0_ergodic, P_YS, P_SS, y_class, prob)
 
     @cython.boundscheck(False)
+    def _ll_block(self, # HMM_SPARSE
+                  P_Y_, last_):
+        """Like base.HMM._ll_block except that self.P_SS is sparse.
+        """
+        cdef DTYPE_t [:,:] P_Y = np.asarray(P_Y_, DTYPE)
+        cdef DTYPE_t [:] last = last_
+        cdef DTYPE_t [:] data = self.P_SS.data
+        cdef ITYPE_t [:] indices = self.P_SS.indices
+        cdef ITYPE_t [:] indptr = self.P_SS.indptr
+        cdef DTYPE_t [:] scratch = np.empty(self.n_states)
+
+        cdef int t, i, j, J
+        cdef int N = self.n_states
+        cdef int T = P_Y.shape[0]
+        cdef double gamma, LL = 0
+        for t in range(T):
+            gamma = 0
+            for i in range(N):
+                last[i] = last[i]*P_Y[t,i]
+                gamma += last[i]
+            for i in range(N):
+                last[i] /= gamma
+            LL += log(gamma)
+            for i in range(N):
+                scratch[i] = 0
+                for j in range(indptr[i],indptr[i+1]):
+                    J = indices[j]
+                    scratch[i] += data[j]*last[J]
+            for i in range(N):
+                last[i] = scratch[i]
+        return LL
+    @cython.boundscheck(False)
     def forward(self # HMM_SPARSE
     ):
         """
@@ -465,8 +709,10 @@ class HMM_SPARSE(base.HMM):
 
         """
         # Ensure allocation and size of alpha and gamma
-        self.alpha = Scalar.initialize(self.alpha,(self.n_y,self.n_states))
-        self.gamma = Scalar.initialize(self.gamma,(self.n_y,))
+        self.alpha = Scalar.initialize(self.alpha, (self.n_y,self.n_states),
+                                       DTYPE, self.work, 'alpha')
+        self.gamma = Scalar.initialize(
+            self.gamma, (self.n_y,), DTYPE, self.work, 'gamma')
 
         # Make views of numpy arrays
         cdef DTYPE_t [:] gamma = self.gamma
@@ -503,7 +749,7 @@ class HMM_SPARSE(base.HMM):
                 for j in range(indptr[i],indptr[i+1]):
                     J = indices[j]
                     _next[i] += data[j]*_last[J]
-        return (np.log(self.gamma)).sum() # End of forward()
+        return (np.log(self.gamma)).sum() + self._shift_sum()
 
     @cython.boundscheck(False)
     def backward(self # HMM_SPARSE
@@ -540,7 +786,8 @@ class HMM_SPARSE(base.HMM):
 
         """
         # Ensure allocation and size of beta
-        self.beta = Scalar.initialize(self.beta,(self.n_y,self.n_states))
+        self.beta = Scalar.initialize(self.beta, (self.n_y,self.n_states),
+                                      DTYPE, self.work, 'beta')
 
         # Make views of numpy arrays
         cdef DTYPE_t [:] gamma = self.gamma
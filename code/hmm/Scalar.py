@@ -20,16 +20,257 @@ for more details.
 See the file gpl.txt in the root directory of the hmmds3 distribution
 or see <http://www.gnu.org/licenses/>.
 '''
+import itertools
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 
-def initialize(x, shape, dtype=np.float64):
-    '''Service fuction.  If x has right shape return it, otherwise
-    allocate array of correct shape and type.
+_stamps = itertools.count(1) # Source of unique parameter version stamps
+def initialize(x, shape, dtype=np.float64, work=None, key=None):
+    '''Service fuction.  If x has right shape and type return it,
+    otherwise get an array of correct shape and type from the
+    Workspace work, or if work is None allocate one.
 
     '''
-    if x == None or x.shape != shape:
-        return np.empty(shape, dtype)
-    return x
+    if x is not None and x.shape == shape and x.dtype == dtype:
+        return x
+    if work is not None:
+        return work.get(key, shape, dtype)
+    return np.empty(shape, dtype)
+class Workspace:
+    '''Pool of reusable arrays.
+
+    An HMM owns a Workspace and passes it through the call chain, eg,
+    to the calc methods of observation models, so that training
+    iterations, segments and records of different lengths reuse the
+    same memory rather than allocating fresh T x N arrays.  Each key
+    owns one flat buffer that only grows.  A request for a smaller
+    array gets a view of the beginning of the buffer.
+
+    Observation models use (id(self), name) as keys so that the
+    components of a composite model do not collide.
+
+    '''
+    def __init__(self # Workspace instance
+    ):
+        self.buffers = {}
+    def get(self, # Workspace instance
+            key, shape, dtype=np.float64):
+        '''Return an array of given shape and type that uses the buffer
+        for key.  The contents are undefined.
+
+        Parameters
+        ----------
+        key : hashable
+            Name of the buffer
+        shape : tuple
+        dtype : numpy dtype, optional
+
+        Returns
+        -------
+        x : array
+        '''
+        n = int(np.prod(shape))
+        buf = self.buffers.get(key)
+        if buf is None or buf.dtype != dtype or buf.size < n:
+            buf = np.empty(n, dtype)
+            self.buffers[key] = buf
+        return buf[:n].reshape(shape)
+    def nbytes(self # Workspace instance
+    ):
+        '''Return total size of the buffers in bytes
+        '''
+        return sum(buf.nbytes for buf in self.buffers.values())
+    def clear(self # Workspace instance
+    ):
+        '''Release all of the buffers
+        '''
+        self.buffers = {}
+    def __getstate__(self):
+        '''Don't pickle the contents of the buffers
+        '''
+        return {'buffers':{}}
+class SequenceSet:
+    '''Observation sequences of several records in contiguous arrays.
+
+    Holds one array for each observation component, eg, (class, hr,
+    context, resp), with the records end to end, and an array of
+    offsets.  Record i is offsets[i]:offsets[i+1] of each component.
+    An instance acts as the list of concatenated components that
+    calc, HMM.P_Y_calc and reestimate take, and join and
+    HMM.multi_train take it in place of a list of records without
+    copying.
+
+    Parameters
+    ----------
+    dtypes : list
+        Type of each component
+    capacity : int, optional
+        Initial number of samples to allocate.  Storage doubles when
+        append needs more.
+
+    >>> ys = SequenceSet([np.int32, np.float64], capacity=2)
+    >>> ys.append([[0, 1, 1], [.5, .5, 2]])
+    >>> ys.append([[1], [3]])
+    >>> ys.offsets, ys[0]
+    (array([0, 3, 4]), array([0, 1, 1, 1], dtype=int32))
+    >>> ys.record(1)[1].tolist()
+    [3.0]
+    '''
+    def __init__(self, # SequenceSet instance
+                 dtypes, capacity=1024):
+        self.dtypes = list(dtypes)
+        self.capacity = capacity
+        self.buffers = None # Allocated by the first append
+        self.components = [np.empty(0, dtype) for dtype in self.dtypes]
+        self._offsets = np.zeros(16, np.int64)
+        self.n_seg = 0
+    @classmethod
+    def from_records(cls, records, dtypes):
+        '''Make a SequenceSet with just enough room for records, a
+        list of sequences of observation components
+        '''
+        records = list(records)
+        rv = cls(dtypes, max(1, sum(len(record[0]) for record in records)))
+        for record in records:
+            rv.append(record)
+        return rv
+    @property
+    def offsets(self):
+        '''Boundaries of the records
+        '''
+        return self._offsets[:self.n_seg+1]
+    def append(self, # SequenceSet instance
+               record):
+        '''Copy record, a sequence of observation components, to the
+        end.
+        '''
+        assert len(record) == len(self.dtypes)
+        record = [np.asarray(z, dtype) for z, dtype in
+                  zip(record, self.dtypes)]
+        t0 = self._offsets[self.n_seg]
+        t1 = t0 + len(record[0])
+        if self.buffers is None:
+            self.buffers = [np.empty((max(self.capacity, t1),) + z.shape[1:],
+                                     z.dtype) for z in record]
+        elif t1 > len(self.buffers[0]):
+            size = max(t1, 2*len(self.buffers[0]))
+            for i, buf in enumerate(self.buffers):
+                self.buffers[i] = np.empty((size,) + buf.shape[1:], buf.dtype)
+                self.buffers[i][:t0] = buf[:t0]
+        for buf, z in zip(self.buffers, record):
+            assert len(z) == t1 - t0
+            buf[t0:t1] = z
+        if self.n_seg + 2 > len(self._offsets):
+            self._offsets = np.concatenate(
+                (self._offsets, np.zeros_like(self._offsets)))
+        self.n_seg += 1
+        self._offsets[self.n_seg] = t1
+        # New views, so that HMM.P_Y_calc doesn't find stale results
+        # in its cache
+        self.components = [buf[:t1] for buf in self.buffers]
+    def record(self, # SequenceSet instance
+               i):
+        '''Return the components of record i as views
+        '''
+        t0, t1 = self._offsets[i:i+2]
+        return [z[t0:t1] for z in self.components]
+    def records(self # SequenceSet instance
+    ):
+        '''Return a list of all of the records as views
+        '''
+        return [self.record(i) for i in range(self.n_seg)]
+    def __len__(self):
+        return len(self.components)
+    def __getitem__(self, i):
+        return self.components[i]
+    def __iter__(self):
+        return iter(self.components)
+    def __getstate__(self):
+        '''Pickle only the filled part of the buffers and not the
+        components, which are views of them
+        '''
+        state = self.__dict__.copy()
+        del state['components']
+        if self.buffers is not None:
+            t1 = self._offsets[self.n_seg]
+            state['buffers'] = [buf[:t1] for buf in self.buffers]
+        state['_offsets'] = self.offsets
+        return state
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.buffers is None:
+            self.components = [np.empty(0, dtype) for dtype in self.dtypes]
+        else:
+            self.components = list(self.buffers)
+class LaggedContext:
+    '''Autoregressive context of a time series as a read only view.
+
+    Acts like the dense array c with c[t] = (1, x[t-1], ..., x[t-order])
+    (or with the 1 last if bias is 'last' or absent if bias is None)
+    where samples before the start are replaced by x[0].  For vector
+    x, the lags are concatenated.  Storage is a copy of x padded with
+    order samples, and sliding_window_view makes rows on demand.
+    Slices of times are LaggedContext views, and other indices and
+    np.asarray() give dense arrays, so that observation models
+    materialize only the blocks they work on.
+
+    Parameters
+    ----------
+    x : array_like
+        Time series.  x.shape = (T,) or (T, d)
+    order : int
+        Number of lags
+    bias : str or None, optional
+        Position of the constant 1: 'first', 'last' or None
+
+    >>> c = LaggedContext([1., 2, 3, 4], 2)
+    >>> np.asarray(c[1:]).tolist()
+    [[1.0, 1.0, 1.0], [1.0, 2.0, 1.0], [1.0, 3.0, 2.0]]
+    '''
+    def __init__(self, # LaggedContext instance
+                 x, order, bias='first'):
+        assert bias in ('first', 'last', None)
+        x = np.asarray(x, np.float64)
+        padded = np.concatenate((np.repeat(x[:1], order, axis=0), x))
+        # window[t, ..., j] = padded[t+j] = x[max(t+j-order, 0)]
+        self.window = sliding_window_view(padded, order, axis=0)[:len(x)]
+        self.order = order
+        self.bias = bias
+        self.shape = (len(x), order*int(np.prod(x.shape[1:]))
+                      + (bias is not None))
+    def _dense(self, # LaggedContext instance
+               window):
+        '''Return the rows of the context for a slice of self.window
+        '''
+        n = len(window)
+        lags = np.moveaxis(window[..., ::-1], -1, 1).reshape((n, -1))
+        if self.bias is None:
+            return np.array(lags)
+        rv = np.empty((n, self.shape[1]))
+        if self.bias == 'first':
+            rv[:, 0] = 1
+            rv[:, 1:] = lags
+        else:
+            rv[:, :-1] = lags
+            rv[:, -1] = 1
+        return rv
+    def __len__(self):
+        return self.shape[0]
+    def __getitem__(self, key):
+        if isinstance(key, slice) and key.step in (None, 1):
+            rv = object.__new__(self.__class__)
+            rv.__dict__.update(self.__dict__)
+            rv.window = self.window[key]
+            rv.shape = (len(rv.window), self.shape[1])
+            return rv
+        index = np.asarray(np.arange(len(self))[key])
+        rows = self._dense(self.window[index.reshape(-1)])
+        return rows.reshape(index.shape + (self.shape[1],))
+    def __array__(self, dtype=None, copy=None):
+        rv = self._dense(self.window)
+        if dtype is not None:
+            rv = rv.astype(dtype, copy=False)
+        return rv
 ## ----------------------------------------------------------------------
 class Prob(np.ndarray):
     '''Subclass of ndarray for probability matrices.  P[a,b] is the
@@ -183,6 +424,123 @@ def make_random(shape):
         P = make_prob(random(shape))
         P.normalize()
         return P
+class Kron_Prob:
+    '''Replacement for Prob for factorial state spaces.  The transition
+    matrix is the Kronecker product of smaller factor matrices,
+    P = kron(P_0, kron(P_1, ...)), so that state s of the product space
+    is the C-ordered multi-index (s_0, s_1, ...) of the factor states.
+
+    The dense N x N matrix is never stored.  step_forward and
+    step_back apply one small factor at a time (a mode product) which
+    costs O(N*sum(n_i)) rather than O(N^2).
+
+    Parameters
+    ----------
+    factors : sequence of array_like
+        factors[k][a,b] is the probability of b given a for factor k
+
+    '''
+    def __init__(self, # Kron_Prob instance
+                 factors):
+        self.factors = [make_prob(f) for f in factors]
+        self.dims = tuple(f.shape[0] for f in self.factors)
+        for f in self.factors:
+            assert f.shape[0] == f.shape[1], 'factor shape=%s'%(f.shape,)
+        N = int(np.prod(self.dims))
+        self.shape = (N, N)
+    def values(self # Kron_Prob instance
+    ):
+        ''' Return dense version of matrix.  Only for printing,
+        simulation and small problems.
+        '''
+        v = np.ones((1, 1))
+        for f in self.factors:
+            v = np.kron(v, f)
+        return v
+    def normalize(self # Kron_Prob instance
+    ):
+        '''Make each row of each factor a probability.  Then each row of
+        the product is also a probability.
+
+        '''
+        for f in self.factors:
+            f.normalize()
+    def assign_col(self, i, col):
+        raise RuntimeError('assign_col() not implemented for %s'%
+                           self.__class__)
+    def likelihoods(self, v):
+        '''Likelihoods for vector of data.  See Prob.likelihoods.
+        '''
+        return self.values()[:, v].T
+    def cost(self, nu, py):
+        ''' Calculate np.outer(nu, py)*self (where * is element-wise).
+        Used in Viterbi decoding.
+        '''
+        return (self.values().T*nu).T*py
+    def _mode(self, a, transpose):
+        '''Apply each factor along its own axis of a reshaped to self.dims
+        '''
+        x = a.reshape(self.dims)
+        for k, f in enumerate(self.factors):
+            if transpose:
+                f = f.T
+            x = np.moveaxis(np.tensordot(x, f, axes=([k], [0])), -1, k)
+        return x.reshape(-1)
+    def step_forward(self, a):
+        '''
+        Replace values of argument a with matrix product a*self
+        '''
+        a[:] = self._mode(a, False)
+    def step_back(self, a):
+        '''
+        Replace values of argument a with matrix product self*a
+        '''
+        a[:] = self._mode(a, True)
+    def inplace_elementwise_multiply(self, a):
+        '''Project the transition statistics onto the factors.
+
+        base.HMM.reestimate calls this method with u_sum[a,b]
+        proportional to the expected number of a->b transitions divided
+        by self[a,b].  Each factor is replaced by the expected counts of
+        its own transitions, ie, the corresponding marginal of
+        self*u_sum.  Since log(self) is a sum of the logs of the
+        factors, the subsequent normalize() yields the maximum
+        likelihood factors.
+
+        Parameters
+        ----------
+        a : array
+            a.shape = self.shape
+
+        Returns
+        -------
+        None
+        '''
+        K = len(self.dims)
+        # Reshape to (a_0, a_1, ..., b_0, b_1, ...)
+        counts = np.asarray(a).reshape(self.dims + self.dims).copy()
+        for k, f in enumerate(self.factors):
+            shape = [1]*(2*K)
+            shape[k] = shape[K+k] = self.dims[k]
+            counts *= np.asarray(f).reshape(shape)
+        for k, f in enumerate(self.factors):
+            axes = tuple(j for j in range(2*K) if j not in (k, K+k))
+            f[:, :] = counts.sum(axis=axes)
+def make_kron_prob(factors):
+    '''Make a Kron_Prob instance.  Pass as the "prob" argument of
+    base.HMM.__init__ with a list of factor matrices in place of P_SS.
+
+    Parameters
+    ----------
+    factors : sequence of array_like
+        Conditional probabilities for each factor of the state space
+
+    Returns
+    -------
+    p : Kron_Prob instance
+
+    '''
+    return Kron_Prob(factors)
 class Discrete_Observations:
     '''The simplest observation model: A finite set of integers.
 
@@ -192,6 +550,8 @@ class Discrete_Observations:
         Conditional probabilites P_YS[s,y]
 
     '''
+    P_Y = None # Subclasses that don't assign P_Y in __init__ rely on this
+    version = 0 # Stamp of the current parameters.  See param_version
     def __init__(self,  # Discrete_Observations instance
                  P_YS):
         self.P_YS = make_prob(P_YS)
@@ -201,6 +561,32 @@ class Discrete_Observations:
         return
     def __str__(self):
         return 'P_YS =\n%s'%(self.P_YS,)
+    def bump_version(self # Discrete_Observations instance
+    ):
+        '''Give self a new parameter version stamp.  Methods that
+        change parameters call this, and other code that changes
+        parameters in place must call it too.
+        '''
+        self.version = next(_stamps)
+    def param_version(self # Discrete_Observations instance
+    ):
+        '''Return a key that changes whenever the parameters of self or
+        of its component observation models change.  HMM.P_Y_calc
+        uses it to look up cached results.
+
+        Stamps are unique within a process, so a model that replaces
+        another never gets the key of the old one.  A copy shares the
+        key of the original until either changes.
+
+        Returns
+        -------
+        key : tuple
+        '''
+        if self.version == 0: # Never stamped
+            self.bump_version()
+        return (self.version,) + tuple(
+            value.param_version() for value in vars(self).values()
+            if isinstance(value, Discrete_Observations))
     def random_out(self, # Discrete_Observations instance
                    s):
         ''' For simulation, draw a random observation given state s
@@ -219,7 +605,7 @@ class Discrete_Observations:
         import random
         return  (np.searchsorted(self.cum_y[s],random.random()),)
     def calc(self, # Discrete_Observations instance
-             y_):
+             y_, work=None):
         """
         Calculate and return likelihoods: self.P_Y[t,i] = P(y(t)|s(t)=i)
 
@@ -227,6 +613,8 @@ class Discrete_Observations:
         ----------
         y_ : list
             Has one element which is a sequence of integer observations
+        work : Workspace, optional
+            Source of reusable memory for the result
 
         Returns
         -------
@@ -236,9 +624,125 @@ class Discrete_Observations:
         y = y_[0]
         n_y = len(y)
         n_states = len(self.P_YS)
-        self.P_Y = initialize(self.P_Y, (n_y, n_states))
+        self.P_Y = initialize(self.P_Y, (n_y, n_states), np.float64, work,
+                              (id(self), 'P_Y'))
         self.P_Y[:, :] = self.P_YS.likelihoods(y)
         return self.P_Y
+    def calc_block(self, # Discrete_Observations instance
+                   y, t0, t1, out):
+        """
+        Assign and return likelihoods out[t-t0,i] = P(y(t)|s(t)=i)
+        for t0 <= t < t1.
+
+        Unlike calc, it does not modify self, so that threads may fill
+        disjoint blocks of one array concurrently.  Subclasses that
+        override calc must override calc_block too.
+
+        Parameters
+        ----------
+        y : list
+            Sequences of observation components
+        t0, t1 : int
+            Limits of the block
+        out : array
+            out.shape = (t1-t0, n_states)
+
+        Returns
+        -------
+        out : array
+
+        """
+        out[:] = self.P_YS.likelihoods(y[0][t0:t1])
+        return out
+    def log_calc(self, # Discrete_Observations instance
+                 y, work=None):
+        """
+        Calculate and return log likelihoods: log P(y(t)|s(t)=i)
+
+        HMM.P_Y_calc uses this method if HMM.log_domain.  This default
+        takes the log of calc.  Models that can evaluate log densities
+        directly, without underflow, override log_calc and
+        log_calc_block.
+
+        Parameters
+        ----------
+        y : list
+            Sequences of observation components
+        work : Workspace, optional
+            Source of reusable memory for the result
+
+        Returns
+        -------
+        log_P_Y : array, floats
+
+        """
+        P_Y = self.calc(y, work)
+        with np.errstate(divide='ignore'):
+            return np.log(P_Y, out=P_Y)
+    def log_calc_block(self, # Discrete_Observations instance
+                       y, t0, t1, out):
+        """
+        Assign and return out[t-t0,i] = log P(y(t)|s(t)=i) for t0 <= t < t1
+        """
+        self.calc_block(y, t0, t1, out)
+        with np.errstate(divide='ignore'):
+            return np.log(out, out=out)
+    def calc_states(self, # Discrete_Observations instance
+                    y, t, states):
+        """
+        Return P[k,j] = P(y(t[k])|s(t[k])=states[j])
+
+        Class_y.calc_gated uses this method to skip states that a
+        classification rules out.  This default evaluates all states
+        at the times t and selects columns.  Models that can evaluate
+        a subset of states directly override it.
+
+        Parameters
+        ----------
+        y : list
+            Sequences of observation components
+        t : array
+            Indices of times
+        states : array
+            Indices of states
+
+        Returns
+        -------
+        P : array
+            P.shape = (len(t), len(states))
+
+        """
+        return self.calc([np.asarray(z)[t] for z in y])[:, states]
+    def reestimate_states(self, # Discrete_Observations instance
+                          parts, y):
+        """
+        Estimate new model parameters from weights given in blocks.
+
+        Class_y.reestimate_gated uses this method.  The blocks in parts
+        cover each time and each state exactly once, and weights
+        outside of them are zero.  This default assembles the full
+        array of weights for reestimate.  Models whose statistics for
+        a state depend only on the weights of that state can work on
+        the blocks directly and override it.
+
+        Parameters
+        ----------
+        parts : list
+            Elements (t, states, w) with w[k,j] = Prob(state[t[k]] =
+            states[j]) given data and old model
+        y : list
+            Sequences of observation components
+
+        Returns
+        -------
+        None
+        """
+        n_y = sum(len(t) for t, states, w in parts)
+        n_states = sum(len(states) for t, states, w in parts)
+        full = np.zeros((n_y, n_states))
+        for t, states, w in parts:
+            full[np.ix_(t, states)] = w
+        self.reestimate(full, y)
     def join(self, # Discrete_Observations instance
              ys):
         """Concatenate and return multiple y sequences.
@@ -249,32 +753,24 @@ class Discrete_Observations:
 
         Parameters
         ----------
-        ys : list
+        ys : list or SequenceSet
             A list of observation sequences.  Default int, but must match
-            method self.P_Y() if subclassed
+            method self.P_Y() if subclassed.  A SequenceSet is
+            returned as y_all without copying
 
         Returns
         -------
         n_seg : int
             Number of component segments
-        t_seg : list
-            List of ints specifying endpoints of segments within y_all
-        y_all : list
-            Concatenated list of observations
-
-        """
-        t_seg = [0] # List of segment boundaries in concatenated ys
-        y_all = []
-        n_components = len(ys[0])
-        for i in range(n_components):
-            y_all.append([])
-        for seg in ys:
-            for i in range(n_components):
-                y_all[i] += list(seg[i])
-            t_seg.append(len(y_all[0]))
-        for i in range(n_components):
-            y_all[i] = np.array(y_all[i], self.dtype[i])
-        return len(t_seg)-1, t_seg, y_all
+        t_seg : array
+            Endpoints of segments within y_all
+        y_all : SequenceSet
+            Concatenated observations
+
+        """
+        if not isinstance(ys, SequenceSet):
+            ys = SequenceSet.from_records(ys, self.dtype)
+        return ys.n_seg, ys.offsets, ys
     def reestimate(self,      # Discrete_Observations instance
                    w,         # Weights
                    y_,        # Observations
@@ -304,11 +800,17 @@ class Discrete_Observations:
                 print('Warning: reformatted y in reestimate')
         assert(y.dtype == np.int32 and y.shape == (n_y,)),'''
                 y.dtype=%s, y.shape=%s'''%(y.dtype, y.shape)
-        for yi in range(self.P_YS.shape[1]):
-            self.P_YS.assign_col(
-                yi, w.take(np.where(y==yi)[0], axis=0).sum(axis=0))
+        n_states, n_symbols = self.P_YS.shape
+        assert n_y == 0 or y.max() < n_symbols, \
+            'y.max()=%d but there are only %d symbols'%(y.max(), n_symbols)
+        # One O(n_y) scatter add per state instead of a search over y
+        # for each symbol
+        for s in range(n_states):
+            self.P_YS[s, :] = np.bincount(y, weights=w[:, s],
+                                          minlength=n_symbols)
         self.P_YS.normalize()
         self.cum_y = np.cumsum(self.P_YS, axis=1)
+        self.bump_version()
         return
 
 class Gauss(Discrete_Observations):
@@ -355,7 +857,7 @@ class Gauss(Discrete_Observations):
         import random
         return  (random.gauss(self.mu[s], self.sigma[s]),)
     def calc(self, # Gauss observation model instance 
-             y_
+             y_, work=None
          ):
         """
         Calculate and return likelihoods: self.P_Y[t,i] = P(y(t)|s(t)=i)
@@ -364,16 +866,55 @@ class Gauss(Discrete_Observations):
         ----------
         y_ : list
             Has one element which is a sequence of float observations
+        work : Workspace, optional
+            Source of reusable memory for the result
 
         Returns
         -------
         P_Y : array, floats
 
         """
-        y = np.array(y_[0])
-        d = self.mu - y.reshape((-1, 1))
-        self.P_Y = np.exp(-d*d/(2*self.sigma2))*self.norm
-        return self.P_Y
+        n_y = len(y_[0])
+        self.P_Y = initialize(self.P_Y, (n_y, len(self.mu)), np.float64,
+                              work, (id(self), 'P_Y'))
+        return self.calc_block(y_, 0, n_y, self.P_Y)
+    def calc_block(self, # Gauss observation model instance
+                   y_, t0, t1, out):
+        """
+        Assign and return out[t-t0,i] = P(y(t)|s(t)=i) for t0 <= t < t1
+        """
+        self.log_calc_block(y_, t0, t1, out)
+        return np.exp(out, out=out)
+    def log_calc(self, # Gauss observation model instance
+                 y_, work=None):
+        """
+        Calculate and return log likelihoods: log P(y(t)|s(t)=i)
+        """
+        n_y = len(y_[0])
+        self.P_Y = initialize(self.P_Y, (n_y, len(self.mu)), np.float64,
+                              work, (id(self), 'P_Y'))
+        return self.log_calc_block(y_, 0, n_y, self.P_Y)
+    def log_calc_block(self, # Gauss observation model instance
+                       y_, t0, t1, out):
+        """
+        Assign and return out[t-t0,i] = log P(y(t)|s(t)=i) for t0 <= t < t1
+        """
+        y = np.asarray(y_[0][t0:t1])
+        d = out  # Calculate in place
+        np.subtract(self.mu, y.reshape((-1, 1)), out=d)
+        d *= d
+        d /= -2*self.sigma2
+        d += np.log(self.norm)
+        return out
+    def calc_states(self, # Gauss observation model instance
+                    y_, t, states):
+        """
+        Return P[k,j] = P(y(t[k])|s(t[k])=states[j])
+        """
+        d = np.asarray(y_[0])[t].reshape((-1, 1)) - self.mu[states]
+        d *= d
+        d /= -2*self.sigma2[states]
+        return np.exp(d, out=d)*self.norm[states]
     def reestimate(self,      # Gauss observation model instance 
                    w,         # Weights
                    y_,        # Observations
@@ -394,12 +935,13 @@ class Gauss(Discrete_Observations):
         None
         """
         y = y_[0]
-        wsum = w.sum(axis=0)
+        wsum = w.sum(axis=0, dtype=np.float64)
         self.mu = (w.T * y).sum(axis=1)/wsum
         d = (self.mu - y.reshape((-1, 1)))*np.sqrt(w)
         self.sigma2 = (d*d).sum(axis=0)/wsum
         self.sigma = np.sqrt(self.sigma2)
         self.norm = 1/np.sqrt(2*np.pi*self.sigma2)
+        self.bump_version()
         return
 class Class_y(Discrete_Observations):
     '''Observation model with classification
@@ -463,7 +1005,7 @@ class Class_y(Discrete_Observations):
         '''
         return self.s2c[s], self.y_mod.random_out(s)[0]
     def calc(self, # Class_y instance
-             cy):
+             cy, work=None):
         """
         Calculate and return likelihoods: P_Y[t,i] = P(y(t)|s(t)=i)*g(s,c[t])
 
@@ -474,6 +1016,8 @@ class Class_y(Discrete_Observations):
         ----------
         yc : array_like
             A sequence of y,c pairs.  y[t] = yc[t][0] and c[t] = yc[t][1]
+        work : Workspace, optional
+            Source of reusable memory for the result and the gate
 
         Returns
         -------
@@ -484,10 +1028,83 @@ class Class_y(Discrete_Observations):
         y = cy[1:]
         n_y = len(c)
         n_class, n_states = self.c2s.shape
-        self.g = initialize(self.g,(n_y, n_states),np.bool)
-        self.g[:,:] = self.c2s[c,:]
-        self.P_Y = self.y_mod.calc(y) * self.g
+        self.g = initialize(self.g, (n_y, n_states), np.bool, work,
+                            (id(self), 'g'))
+        np.take(self.c2s, c, axis=0, out=self.g)
+        self.P_Y = initialize(self.P_Y, (n_y, n_states), np.float64, work,
+                              (id(self), 'P_Y'))
+        np.multiply(self.y_mod.calc(y, work), self.g, out=self.P_Y)
         return self.P_Y
+    def calc_block(self, # Class_y instance
+                   cy, t0, t1, out):
+        """
+        Assign and return out[t-t0,i] = P(y(t)|s(t)=i)*g(s,c[t]) for
+        t0 <= t < t1
+        """
+        self.y_mod.calc_block(cy[1:], t0, t1, out)
+        out *= self.c2s[cy[0][t0:t1]]
+        return out
+    def log_calc(self, # Class_y instance
+                 cy, work=None):
+        """
+        Calculate and return log likelihoods: log P(y(t)|s(t)=i) where
+        g(s,c[t]) is one and -inf elsewhere
+        """
+        c = cy[0]
+        n_y = len(c)
+        n_class, n_states = self.c2s.shape
+        self.g = initialize(self.g, (n_y, n_states), np.bool, work,
+                            (id(self), 'g'))
+        np.take(self.c2s, c, axis=0, out=self.g)
+        self.P_Y = initialize(self.P_Y, (n_y, n_states), np.float64, work,
+                              (id(self), 'P_Y'))
+        self.P_Y.fill(-np.inf)
+        np.copyto(self.P_Y, self.y_mod.log_calc(cy[1:], work), where=self.g)
+        return self.P_Y
+    def log_calc_block(self, # Class_y instance
+                       cy, t0, t1, out):
+        """
+        Assign and return out[t-t0,i] = log(P(y(t)|s(t)=i)*g(s,c[t]))
+        for t0 <= t < t1
+        """
+        self.y_mod.log_calc_block(cy[1:], t0, t1, out)
+        out[~self.c2s[cy[0][t0:t1]]] = -np.inf
+        return out
+    def class_states(self # Class_y instance
+    ):
+        '''Return a list with an array for each class of the indices
+        of the states in the class
+        '''
+        return [np.where(row)[0] for row in self.c2s]
+    def calc_gated(self, # Class_y instance
+                   cy, out):
+        """
+        Calculate likelihoods of only the states that the class
+        sequence allows.  With states = self.class_states(), assign
+        out[t,j] = P(y(t)|s(t)=states[c[t]][j]) for j <
+        len(states[c[t]]) and zero for larger j.  HMM.P_Y_gated uses
+        this method.
+
+        Parameters
+        ----------
+        cy : list
+            c,y = cy[0], cy[1:]
+        out : array
+            out.shape = (n_y, max_c len(states[c]))
+
+        Returns
+        -------
+        out : array
+
+        """
+        c = np.asarray(cy[0])
+        y = cy[1:]
+        out[:] = 0
+        for k, states in enumerate(self.class_states()):
+            t = np.where(c == k)[0]
+            if len(t) > 0:
+                out[t, :len(states)] = self.y_mod.calc_states(y, t, states)
+        return out
     def reestimate(self,  # Class_y instance
                    w, cy):
         """
@@ -506,6 +1123,232 @@ class Class_y(Discrete_Observations):
         """
         self.y_mod.reestimate(w, cy[1:])
         return
+    def reestimate_gated(self, # Class_y instance
+                         w_c, index, cy):
+        """
+        Like reestimate, but with the compact weights of
+        HMM.reestimate_gated.  w_c[t,j] is the weight of state
+        index[c[t],j].  Passes the weights of each class to
+        self.y_mod.reestimate_states.
+        """
+        c = np.asarray(cy[0])
+        parts = []
+        for k, states in enumerate(self.class_states()):
+            t = np.where(c == k)[0]
+            parts.append((t, states, w_c[t, :len(states)]))
+        self.y_mod.reestimate_states(parts, cy[1:])
+        return
+def alias_table(p):
+    '''Make Walker's alias table for drawing from the distribution p
+    with one uniform index and one uniform number.
+
+    Parameters
+    ----------
+    p : array
+        Probabilities or weights of n outcomes
+
+    Returns
+    -------
+    q, alias : array, array
+        To draw: pick k uniformly from range(n), then return k with
+        probability q[k] and alias[k] otherwise
+
+    >>> q, alias = alias_table(np.array([.1, .2, .3, .4]))
+    >>> P = q.copy()
+    >>> np.add.at(P, alias, 1 - q)
+    >>> np.round(P/4, 10).tolist()
+    [0.1, 0.2, 0.3, 0.4]
+    '''
+    n = len(p)
+    q = np.asarray(p, np.float64)*n/np.sum(p)
+    alias = np.arange(n)
+    small = list(np.nonzero(q < 1)[0])
+    large = list(np.nonzero(q >= 1)[0])
+    while small and large:
+        l = small.pop()
+        g = large.pop()
+        alias[l] = g
+        q[g] -= 1 - q[l]
+        if q[g] < 1:
+            small.append(g)
+        else:
+            large.append(g)
+    q[small + large] = 1 # Remainders differ from 1 only by round off
+    return q, alias
+class Sparse_Discrete_Observations(Discrete_Observations):
+    '''Discrete observation model for large alphabets, eg, the words
+    of a book.  Only the nonzero P(y|s) are stored, sorted by symbol,
+    so that gathering the likelihoods of a sequence takes time
+    proportional to its length rather than to the size of the
+    alphabet.  Reestimation keeps the sparsity pattern: it updates the
+    stored values and drops those that become zero.  Random_out uses
+    alias tables.
+
+    Parameters
+    ----------
+    P_YS : array_like or sparse matrix
+        Conditional probabilites P_YS[s,y].  An argument with a tocoo
+        method, eg, a scipy.sparse matrix, is not made dense.
+
+    '''
+    def __init__(self,  # Sparse_Discrete_Observations instance
+                 P_YS):
+        if hasattr(P_YS, 'tocoo'):
+            coo = P_YS.tocoo()
+            states, symbols, probs = coo.row, coo.col, coo.data
+        else:
+            P_YS = np.asarray(P_YS, np.float64)
+            states, symbols = np.nonzero(P_YS)
+            probs = P_YS[states, symbols]
+        self.n_states, self.n_symbols = P_YS.shape
+        self._assign(states, symbols, probs)
+        self.P_Y = None
+        self.dtype = [np.int32]
+        return
+    def _assign(self, # Sparse_Discrete_Observations instance
+                states, symbols, probs):
+        '''Store the nonzero entries sorted by symbol, and normalize
+        '''
+        keep = probs > 0
+        order = np.lexsort((states[keep], symbols[keep]))
+        self.states = states[keep][order].astype(np.int32)
+        self.probs = np.array(probs[keep][order], np.float64)
+        # Entries for symbol y are indptr[y]:indptr[y+1]
+        self.indptr = np.zeros(self.n_symbols + 1, np.int64)
+        np.cumsum(np.bincount(symbols[keep], minlength=self.n_symbols),
+                  out=self.indptr[1:])
+        sums = np.bincount(self.states, weights=self.probs,
+                           minlength=self.n_states)
+        self.probs /= sums[self.states]
+        self.alias = None # Built by random_out when needed
+        self.bump_version()
+        return
+    def __str__(self):
+        return '%s with %d states, %d symbols and %d nonzero P(y|s)'%(
+            self.__class__.__name__, self.n_states, self.n_symbols,
+            len(self.probs))
+    def symbols(self # Sparse_Discrete_Observations instance
+    ):
+        '''Return the symbol of each stored entry
+        '''
+        return np.repeat(np.arange(self.n_symbols, dtype=np.int32),
+                         np.diff(self.indptr))
+    def values(self # Sparse_Discrete_Observations instance
+    ):
+        '''Return a dense copy of P_YS.  Only for small alphabets.
+        '''
+        P_YS = np.zeros((self.n_states, self.n_symbols))
+        P_YS[self.states, self.symbols()] = self.probs
+        return P_YS
+    def _gather(self, # Sparse_Discrete_Observations instance
+                y):
+        '''Return t, k with an element for each stored entry k
+        for symbol y[t]
+        '''
+        start = self.indptr[y]
+        counts = self.indptr[np.asarray(y) + 1] - start
+        t = np.repeat(np.arange(len(y)), counts)
+        offsets = np.cumsum(counts) - counts # Position of t's first entry
+        k = np.arange(len(t)) + np.repeat(start - offsets, counts)
+        return t, k
+    def random_out(self, # Sparse_Discrete_Observations instance
+                   s):
+        ''' For simulation, draw a random observation given state s
+
+        Parameters
+        ----------
+        s : int
+            Index of state
+
+        Returns
+        -------
+        y : int
+            Random observation drawn from distribution conditioned on state s
+
+        '''
+        import random
+        if self.alias is None:
+            # Arrange entries by state and make an alias table for each
+            order = np.argsort(self.states, kind='stable')
+            ptr = np.zeros(self.n_states + 1, np.int64)
+            np.cumsum(np.bincount(self.states, minlength=self.n_states),
+                      out=ptr[1:])
+            q = np.empty(len(order))
+            alias = np.empty(len(order), np.int64)
+            for i in range(self.n_states):
+                q[ptr[i]:ptr[i+1]], alias[ptr[i]:ptr[i+1]] = alias_table(
+                    self.probs[order[ptr[i]:ptr[i+1]]])
+            self.alias = (ptr, self.symbols()[order], q, alias)
+        ptr, symbols, q, alias = self.alias
+        if ptr[s+1] == ptr[s]:
+            raise RuntimeError('State %d has no nonzero P(y|s)'%s)
+        k = int(random.random()*(ptr[s+1] - ptr[s]))
+        if random.random() >= q[ptr[s] + k]:
+            k = alias[ptr[s] + k]
+        return (symbols[ptr[s] + k],)
+    def calc(self, # Sparse_Discrete_Observations instance
+             y_, work=None):
+        """
+        Calculate and return likelihoods: self.P_Y[t,i] = P(y(t)|s(t)=i)
+
+        Parameters
+        ----------
+        y_ : list
+            Has one element which is a sequence of integer observations
+        work : Workspace, optional
+            Source of reusable memory for the result
+
+        Returns
+        -------
+        P_Y : array, floats
+
+        """
+        n_y = len(y_[0])
+        self.P_Y = initialize(self.P_Y, (n_y, self.n_states), np.float64,
+                              work, (id(self), 'P_Y'))
+        return self.calc_block(y_, 0, n_y, self.P_Y)
+    def calc_block(self, # Sparse_Discrete_Observations instance
+                   y, t0, t1, out):
+        """
+        Assign and return out[t-t0,i] = P(y(t)|s(t)=i) for t0 <= t < t1
+        """
+        t, k = self._gather(y[0][t0:t1])
+        out.fill(0)
+        out[t, self.states[k]] = self.probs[k]
+        return out
+    def reestimate(self,      # Sparse_Discrete_Observations instance
+                   w,         # Weights
+                   y_,        # Observations
+                   warn=True
+                   ):
+        """
+        Estimate new model parameters.  Weights w[t,s] for which
+        P(y(t)|s) is not stored are ignored.  They are zero when w
+        comes from the forward backward algorithm.
+
+        Parameters
+        ----------
+        w : array
+            w[t,s] = Prob(state[t]=s) given data and old model
+        y : list
+            y[0] is a sequence of integer observations
+        warn : bool
+            If True and y[0].dtype != np.int32, print warning
+
+        Returns
+        -------
+        None
+        """
+        y = y_[0]
+        if not (type(y) == np.ndarray and y.dtype == np.int32):
+            y = np.array(y, np.int32)
+            if warn:
+                print('Warning: reformatted y in reestimate')
+        t, k = self._gather(y)
+        counts = np.bincount(k, weights=w[t, self.states[k]],
+                             minlength=len(self.probs))
+        self._assign(self.states, self.symbols(), counts)
+        return
 def _test():
     import base
     P_S0 = [0.67, 0.33]
@@ -5,7 +5,8 @@ This file implements "Vector AutoRegressive Gaussian" observation
 models.  y is a list of lists
 
 y[0][t] is a numpy.array containing the observation vector
-y[1][t] is a numpy.array containing the context vector
+y[1][t] is a numpy.array containing the context vector.  y[1] may be a
+    Scalar.LaggedContext rather than a dense array
 
 P(y|s) = Normal(mu(s,y[1]),cov[s])_y[0] where mu(s,v) = A[s]*v
 
@@ -40,6 +41,46 @@ import numpy.linalg as LA
 small = 1e-20
 big = 1e+20
 
+def weighted_gram(w, a, b):
+    r'''Return G with G[i] = \sum_t w[t,i] a[t] b[t]^T for all states i.
+
+    Parameters
+    ----------
+    w : array
+        w[t,i] is the weight of state i at time t
+    a, b : array
+        Sequences of vectors.  a.shape = (T, dim_a)
+
+    Returns
+    -------
+    G : array
+        G.shape = (n_states, dim_a, dim_b)
+    '''
+    return np.einsum('ti,tj,tk->ijk', w, a, b, optimize=True)
+def solve_normal(G, B):
+    '''Solve the normal equations G[i] X[i] = B[i] for all states i
+    together, but use lstsq for states with ill conditioned G[i].
+
+    Parameters
+    ----------
+    G : array
+        Gram matrices.  G.shape = (n_states, dim, dim)
+    B : array
+        B.shape = (n_states, dim, m)
+
+    Returns
+    -------
+    X : array
+        X.shape = (n_states, dim, m)
+    '''
+    good = np.linalg.cond(G) < 1e12
+    X = np.empty(B.shape)
+    if good.any():
+        X[good] = LA.solve(G[good], B[good])
+    for i in np.where(~good)[0]:
+        X[i] = LA.lstsq(G[i], B[i], rcond=None)[0]
+    return X
+
 #------------------------------------------------------------
 class VARG(Discrete_Observations):
     '''
@@ -85,26 +126,30 @@ class VARG(Discrete_Observations):
     def normalize(self):
         cr,cc = self.Icovs[0].shape
         assert cr == cc, 'Icovs[0]=%s'%(self.Icovs[0],)
-        self.evals = np.empty((self.n_states,cr))
-        self.evecs = np.empty((self.n_states,cr,cr))
-        self.norms = np.empty((self.n_states,))
-        for i in range(self.n_states):
-            self.evals[i,:],self.evecs[i,:,:] = LA.eigh(self.Icovs[i])
-            # Save sqrt eigenvalues of Cov not inverse Cov because they are
-            # only used in simulate()
-            self.evals[i] = 1/np.sqrt(self.evals[i])
-            if self.evals[i].min() < small:
-                raise RuntimeError('In normalize: Eigenvalue %f too small'%(
-                    self.evals[i].min()))
-            if self.evals[i].max() > big:
-                raise RuntimeError('In normalize: Eigenvalue %f too big'%(
-                    self.evals[i].max()))
-            d = LA.det(self.Icovs[i])
-            if d < small or d > big:
-                raise RuntimeError('extreme determinant %f'%d)
-            self.norms[i] = 1/np.sqrt((2*np.pi)**cr/d)
+        evals, self.evecs = LA.eigh(self.Icovs) # For all states at once
+        # Save sqrt eigenvalues of Cov not inverse Cov because they are
+        # only used in simulate()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.evals = 1/np.sqrt(evals)
+        if not evals.min() > 0:
+            raise RuntimeError('In normalize: Eigenvalue %f of Icov'%(
+                evals.min()))
+        if self.evals.min() < small:
+            raise RuntimeError('In normalize: Eigenvalue %f too small'%(
+                self.evals.min()))
+        if self.evals.max() > big:
+            raise RuntimeError('In normalize: Eigenvalue %f too big'%(
+                self.evals.max()))
+        # log det(Icov) from the Cholesky factors
+        L = LA.cholesky(self.Icovs)
+        log_d = 2*np.log(np.diagonal(L, axis1=1, axis2=2)).sum(axis=1)
+        if log_d.min() < np.log(small) or log_d.max() > np.log(big):
+            raise RuntimeError('extreme determinant %f'%np.exp(
+                log_d[np.abs(log_d).argmax()]))
+        self.norms = np.exp((log_d - cr*np.log(2*np.pi))/2)
+        self.bump_version()
         return
-    def calc(self, y):
+    def calc(self, y, work=None):
         """
         Calculate and return likelihoods: self.P_Y[t,i] = P(y(t)|s(t)=i)
 
@@ -112,6 +157,8 @@ class VARG(Discrete_Observations):
         ----------
         y_ : (y,)
             A sequence of vector observations and contexts
+        work : Workspace, optional
+            Source of reusable memory for the result
 
         Returns
         -------
@@ -120,39 +167,85 @@ class VARG(Discrete_Observations):
 
         """
         n_y = len(y[0])
-        self.P_Y = initialize(self.P_Y, (n_y, self.n_states))
-        for t in range(n_y):
-            for i in range(self.n_states):
-                d = y[0][t] - np.dot(self.As[i], y[1][t])
-                dQd = np.dot(d, np.dot(self.Icovs[i], d))
-                if dQd > 300: # Underflow
-                    self.P_Y[t,i] = 0
-                else:
-                    self.P_Y[t,i] = self.norms[i]*np.exp(-dQd/2)
-        return self.P_Y
-
-    def reestimate(self, # Resp instance
+        self.P_Y = initialize(self.P_Y, (n_y, self.n_states), np.float64,
+                              work, (id(self), 'P_Y'))
+        return self.calc_block(y, 0, n_y, self.P_Y)
+    def calc_block(self, y, t0, t1, out):
+        """
+        Assign and return out[t-t0,i] = P(y(t)|s(t)=i) for t0 <= t < t1
+        """
+        self.log_calc_block(y, t0, t1, out)
+        return np.exp(out, out=out)
+    def log_calc(self, y, work=None):
+        """
+        Calculate and return log likelihoods: log P(y(t)|s(t)=i)
+        """
+        n_y = len(y[0])
+        self.P_Y = initialize(self.P_Y, (n_y, self.n_states), np.float64,
+                              work, (id(self), 'P_Y'))
+        return self.log_calc_block(y, 0, n_y, self.P_Y)
+    def log_calc_block(self, y, t0, t1, out):
+        """
+        Assign and return out[t-t0,i] = log P(y(t)|s(t)=i) for t0 <= t < t1
+
+        The predictions As[i] x[t] for all states are stacked by
+        einsum, and with Icovs[i] = L[i] L[i]^T the Mahalanobis terms
+        are squared lengths of whitened residuals.
+        """
+        Y = np.asarray(y[0][t0:t1])
+        X = np.asarray(y[1][t0:t1])
+        L = LA.cholesky(self.Icovs)
+        d = Y[:, np.newaxis, :] - np.einsum('ijk,tk->tij', self.As, X)
+        z = np.einsum('tij,ijk->tik', d, L)
+        dQd = np.einsum('tik,tik->ti', z, z)
+        out[:] = np.log(self.norms) - dQd/2
+        return out
+    def statistics(self, # VARG instance
                    w,    # w[t,i] = prob s(t) = i
                    y):
-        n_y, dim_Y = y[0].shape
-        t, dim_X = y[1].shape
-        assert t == n_y
-        
-        root_w = np.sqrt(w)
-        sum_w = w.sum(axis=0)
-        for i in range(self.n_states):
-            wY = (root_w.T[i] * y[0].T).T
-            wX = (root_w.T[i] * y[1].T).T
-            AT,resids,rank,svals = LA.lstsq(wX, wY, rcond=1e-10)
-            self.As[i] = AT.T
-            if self.fixed_var:
-                continue
-            zT = wY - np.dot(wX,AT)
-            ZZT = np.dot(zT.T,zT)
+        r'''Calculate weighted Gram matrices for reestimate.  For
+        statistics of several records add the results elementwise.
+
+        Returns
+        -------
+        sum_w : array
+            sum_w[i] = \sum_t w[t,i]
+        Gxx, Gxy, Gyy : arrays
+            Gxx[i] = \sum_t w[t,i] x[t] x[t]^T, and similarly for the
+            other pairs where x is the context y[1] and y is y[0]
+        '''
+        Y = np.asarray(y[0])
+        X = np.asarray(y[1])
+        assert len(X) == len(Y)
+        return (w.sum(axis=0), weighted_gram(w, X, X), weighted_gram(w, X, Y),
+                weighted_gram(w, Y, Y))
+    def update(self, # VARG instance
+               stats):
+        '''Assign As and, unless the variance is frozen, Icovs from
+        the statistics from statistics().  Solve the stacked normal
+        equations, but use lstsq for ill conditioned states.
+        '''
+        sum_w, Gxx, Gxy, Gyy = stats
+        dim_Y = Gyy.shape[1]
+        AT = solve_normal(Gxx, Gxy)  # AT[i] = As[i].T
+        self.As = np.transpose(AT, (0, 2, 1)).copy()
+        if not self.fixed_var:
+            # ZZT[i] = \sum_t w[t,i] z[t] z[t]^T with z = y - A x
+            AGxy = np.einsum('ijk,ijl->ikl', AT, Gxy)
+            ZZT = (Gyy - AGxy - np.transpose(AGxy, (0, 2, 1)) +
+                   np.einsum('ijk,ijl,ilm->ikm', AT, Gxx, AT))
+            ZZT = (ZZT + np.transpose(ZZT, (0, 2, 1)))/2
             # MAP with an inverse Wishart prior
-            Cov = (self.b * np.eye(dim_Y) + ZZT)/(self.a + sum_w[i])
-            self.Icovs[i] = LA.inv(Cov)
+            Cov = (self.b * np.eye(dim_Y) + ZZT)/(
+                self.a + sum_w).reshape((-1, 1, 1))
+            self.Icovs = LA.inv(Cov)
         self.normalize()
+        return
+
+    def reestimate(self, # VARG instance
+                   w,    # w[t,i] = prob s(t) = i
+                   y):
+        self.update(self.statistics(w, y))
         return # End of reestimate()
     def __str__(self # VARG
                 ):
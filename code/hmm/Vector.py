@@ -0,0 +1,399 @@
+'''Vector.py: Observation models for vector observations.
+
+y[0][t] is a numpy array of length dim.  Gauss has a full covariance
+for each state, Diag_Gauss has a diagonal covariance for each state,
+and GMM has a mixture of Gaussians for each state.  Densities are
+calculated for all times and states at once from Cholesky factors of
+the covariances, and reestimation uses weighted sums of the
+deviations of y from the current means and of their outer products.
+A small inverse Wishart prior with parameters a and b, like the one in
+VARG, keeps the covariance of a state that collapses onto a few
+observations positive definite.
+
+'''
+Copyright = '''
+Copyright 2013 Andrew M. Fraser and Los Alamos National Laboroatory
+
+This file is part of hmmds3.
+
+Hmmds3 is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+Hmmds3 is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+for more details.
+
+See the file gpl.txt in the root directory of the hmmds3 distribution
+or see <http://www.gnu.org/licenses/>.
+'''
+import numpy as np
+import numpy.linalg as LA
+from hmm.Scalar import Discrete_Observations, initialize
+
+class Gauss(Discrete_Observations):
+    r'''Multivariate Gaussian observation model with a full covariance
+    for each state.
+
+    P(y|s) = Normal(mu[s], Sigma[s])_y
+
+    Parameters
+    ----------
+    pars : (mu, Sigma) or (mu, Sigma, a, b)
+    mu : array_like
+        mu.shape = (n_states, dim)
+    Sigma : array_like
+        Covariances.  Sigma.shape = (n_states, dim, dim)
+    a, b : float
+        Prior for reestimation.  The new covariance is (b I +
+        \sum_t w[t,i] (y[t]-mu[i])(y[t]-mu[i])^T)/(a + \sum_t w[t,i]).
+        a = b = 0 gives the maximum likelihood estimate.
+
+    '''
+    def __init__(self,  # Vector.Gauss instance
+                 pars):
+        if len(pars) == 2:
+            mu, Sigma = pars
+            self.a = 1e-3
+            self.b = 1e-6
+        else:
+            mu, Sigma, self.a, self.b = pars
+        self.mu = np.array(mu, np.float64)
+        self.n_states, self.dim = self.mu.shape
+        self.set_cov(np.array(Sigma, np.float64))
+        self.P_Y = None
+        self.dtype = [np.float64]
+        return
+    def set_cov(self, # Vector.Gauss instance
+                Sigma):
+        '''Assign the covariances and the quantities derived from their
+        Cholesky factors Sigma[s] = L[s] L[s]^T
+        '''
+        self.Sigma = Sigma
+        try:
+            self.L = LA.cholesky(Sigma)
+        except LA.LinAlgError:
+            raise RuntimeError('Covariance is not positive definite')
+        # Explicit inverses of the factors, so that _log_P whitens the
+        # deviations for all states with one einsum
+        self.Linv = LA.inv(self.L)
+        self.log_norm = -(self.dim*np.log(2*np.pi)/2 + np.log(
+            np.diagonal(self.L, axis1=1, axis2=2)).sum(axis=1))
+        self.bump_version()
+    def __str__(self):
+        return '    mu=\n%s\nSigma=\n%s '%(self.mu, self.Sigma)
+    def random_out(self, # Vector.Gauss instance
+                   s):
+        ''' For simulation, draw a random observation given state s
+
+        Parameters
+        ----------
+        s : int
+            Index of state
+
+        Returns
+        -------
+        y : array
+            Random observation drawn from distribution conditioned on state s
+
+        '''
+        import random
+        z = np.array([random.gauss(0, 1) for i in range(self.dim)])
+        return (self.mu[s] + np.dot(self.L[s], z),)
+    def _log_P(self, # Vector.Gauss instance
+               y):
+        '''Return log P(y[t]|s) for all t and s.  y is an array of vectors.
+        '''
+        d = np.asarray(y)[:, np.newaxis, :] - self.mu   # d[t,s,:]
+        z = np.einsum('sij,tsj->tsi', self.Linv, d)     # L[s] z = d
+        return self.log_norm - np.einsum('tsi,tsi->ts', z, z)/2
+    def calc(self, # Vector.Gauss instance
+             y_, work=None):
+        """
+        Calculate and return likelihoods: self.P_Y[t,i] = P(y(t)|s(t)=i)
+
+        Parameters
+        ----------
+        y_ : list
+            Has one element which is a sequence of vector observations
+        work : Workspace, optional
+            Source of reusable memory for the result
+
+        Returns
+        -------
+        P_Y : array, floats
+
+        """
+        n_y = len(y_[0])
+        self.P_Y = initialize(self.P_Y, (n_y, self.n_states), np.float64,
+                              work, (id(self), 'P_Y'))
+        return self.calc_block(y_, 0, n_y, self.P_Y)
+    def calc_block(self, # Vector.Gauss instance
+                   y, t0, t1, out):
+        """
+        Assign and return out[t-t0,i] = P(y(t)|s(t)=i) for t0 <= t < t1
+        """
+        np.exp(self._log_P(y[0][t0:t1]), out=out)
+        return out
+    def log_calc(self, # Vector.Gauss instance
+                 y_, work=None):
+        """
+        Calculate and return log likelihoods: log P(y(t)|s(t)=i)
+        """
+        n_y = len(y_[0])
+        self.P_Y = initialize(self.P_Y, (n_y, self.n_states), np.float64,
+                              work, (id(self), 'P_Y'))
+        return self.log_calc_block(y_, 0, n_y, self.P_Y)
+    def log_calc_block(self, # Vector.Gauss instance
+                       y, t0, t1, out):
+        """
+        Assign and return out[t-t0,i] = log P(y(t)|s(t)=i) for t0 <= t < t1
+        """
+        out[:] = self._log_P(y[0][t0:t1])
+        return out
+    def center(self, # Vector.Gauss instance
+               w, y):
+        '''Move mu to the weighted means of y so that the deviations
+        that statistics() accumulates are small.  Keep mu[i] for states
+        with no weight.
+        '''
+        y = np.asarray(y[0], np.float64)
+        wsum = w.sum(axis=0)
+        live = wsum > 0
+        mu = self.mu.copy()
+        mu[live] = np.dot(w.T, y)[live]/wsum[live].reshape((-1, 1))
+        self.mu = mu
+    def statistics(self, # Vector.Gauss instance
+                   w,    # w[t,i] = prob s(t) = i
+                   y):
+        r'''Calculate weighted sums of the deviations d[t,i] = y[t] -
+        mu[i] from the current means for reestimate.  Sums of
+        deviations rather than of y and y y^T avoid cancellation when
+        the means are large compared to the spread.  For statistics of
+        several records add the results elementwise.
+
+        Returns
+        -------
+        wsum, wd, wdd : arrays
+            wsum[i] = \sum_t w[t,i], wd[i] = \sum_t w[t,i] d[t,i] and
+            wdd[i] = \sum_t w[t,i] d[t,i] d[t,i]^T
+        '''
+        d = np.asarray(y[0], np.float64)[:, np.newaxis, :] - self.mu
+        return (w.sum(axis=0), np.einsum('ts,tsj->sj', w, d),
+                np.einsum('ts,tsj,tsk->sjk', w, d, d, optimize=True))
+    def _shift(self, # Vector.Gauss instance
+               wsum, wd):
+        '''Return the change of the means implied by statistics()
+        '''
+        delta = np.zeros(wd.shape)
+        live = wsum > 0
+        delta[live] = wd[live]/wsum[live].reshape((-1, 1))
+        return delta
+    def update(self, # Vector.Gauss instance
+               stats):
+        '''Assign mu and Sigma from the results of statistics()
+        '''
+        wsum, wd, wdd = stats
+        delta = self._shift(wsum, wd)
+        self.mu = self.mu + delta
+        # Scatter about the new means
+        S = wdd - wsum.reshape((-1, 1, 1))*np.einsum(
+            'sj,sk->sjk', delta, delta)
+        Sigma = (self.b*np.eye(self.dim) + S)/(
+            self.a + wsum).reshape((-1, 1, 1))
+        self.set_cov((Sigma + np.transpose(Sigma, (0, 2, 1)))/2)
+    def reestimate(self, # Vector.Gauss instance
+                   w,    # Weights
+                   y):   # Observations
+        """
+        Estimate new model parameters
+
+        Parameters
+        ----------
+        w : array
+            w[t,s] = Prob(state[t]=s) given data and old model
+        y : list
+            y[0] is a sequence of vector observations
+
+        Returns
+        -------
+        None
+        """
+        self.center(w, y)
+        self.update(self.statistics(w, y))
+        return
+class Diag_Gauss(Gauss):
+    '''Multivariate Gaussian observation model with a diagonal
+    covariance for each state.
+
+    Parameters
+    ----------
+    pars : (mu, var) or (mu, var, a, b)
+    mu : array_like
+        mu.shape = (n_states, dim)
+    var : array_like
+        Variances of the components.  var.shape = (n_states, dim)
+    a, b : float
+        Prior for reestimation as in Gauss
+
+    '''
+    def set_cov(self, # Diag_Gauss instance
+                var):
+        '''Assign the variances and the quantities derived from them
+        '''
+        if not var.min() > 0:
+            raise RuntimeError('Variance %f is not positive'%var.min())
+        self.var = var
+        self.sigma = np.sqrt(var)
+        self.log_norm = -(self.dim*np.log(2*np.pi)/2 + np.log(
+            self.sigma).sum(axis=1))
+        self.bump_version()
+    def __str__(self):
+        return '    mu=\n%s\nvar=\n%s '%(self.mu, self.var)
+    def random_out(self, # Diag_Gauss instance
+                   s):
+        import random
+        z = np.array([random.gauss(0, 1) for i in range(self.dim)])
+        return (self.mu[s] + self.sigma[s]*z,)
+    def _log_P(self, # Diag_Gauss instance
+               y):
+        z = (np.asarray(y)[:, np.newaxis, :] - self.mu)/self.sigma
+        return self.log_norm - np.einsum('tsi,tsi->ts', z, z)/2
+    def statistics(self, # Diag_Gauss instance
+                   w, y):
+        r'''Like Gauss.statistics, but wdd[i] = \sum_t w[t,i]
+        d[t,i]*d[t,i] is only the diagonal.
+        '''
+        d = np.asarray(y[0], np.float64)[:, np.newaxis, :] - self.mu
+        return (w.sum(axis=0), np.einsum('ts,tsj->sj', w, d),
+                np.einsum('ts,tsj->sj', w, d*d))
+    def update(self, # Diag_Gauss instance
+               stats):
+        wsum, wd, wdd = stats
+        delta = self._shift(wsum, wd)
+        self.mu = self.mu + delta
+        S = wdd - wsum.reshape((-1, 1))*delta*delta
+        self.set_cov((self.b + S)/(self.a + wsum).reshape((-1, 1)))
+class GMM(Discrete_Observations):
+    '''Observation model with a mixture of Gaussians for each state.
+
+    P(y|s) = \\sum_m c[s,m] Normal(mu[s,m], Sigma[s,m])_y
+
+    Parameters
+    ----------
+    pars : (c, mu, Sigma) or (c, mu, Sigma, a, b)
+    c : array_like
+        Mixture weights.  c.shape = (n_states, n_mix)
+    mu : array_like
+        mu.shape = (n_states, n_mix, dim)
+    Sigma : array_like
+        Full covariances with Sigma.shape = (n_states, n_mix, dim,
+        dim), or variances of diagonal covariances with Sigma.shape =
+        (n_states, n_mix, dim)
+    a, b : float
+        Prior for reestimation of each component as in Gauss
+
+    '''
+    def __init__(self,  # GMM instance
+                 pars):
+        c, mu, Sigma = pars[:3]
+        prior = tuple(pars[3:])
+        self.c = np.array(c, np.float64)
+        self.n_states, self.n_mix = self.c.shape
+        mu = np.array(mu, np.float64)
+        Sigma = np.array(Sigma, np.float64)
+        dim = mu.shape[-1]
+        n_comp = self.n_states*self.n_mix
+        # All components in a single model indexed by s*n_mix + m
+        if Sigma.ndim == 3:
+            self.components = Diag_Gauss((mu.reshape((n_comp, dim)),
+                                          Sigma.reshape((n_comp, dim)))
+                                         + prior)
+        else:
+            self.components = Gauss((mu.reshape((n_comp, dim)),
+                                     Sigma.reshape((n_comp, dim, dim)))
+                                    + prior)
+        self.P_Y = None
+        self.dtype = [np.float64]
+        return
+    def __str__(self):
+        return 'c=\n%s\ncomponents:\n%s'%(self.c, self.components)
+    def random_out(self, # GMM instance
+                   s):
+        ''' For simulation, draw a random observation given state s
+        '''
+        import random
+        m = np.searchsorted(np.cumsum(self.c[s]), random.random())
+        return self.components.random_out(s*self.n_mix + min(
+            m, self.n_mix - 1))
+    def _log_joint(self, # GMM instance
+                   y):
+        '''Return log(c[s,m] P(y[t]|s,m)) with shape (n_y, n_states, n_mix)
+        '''
+        with np.errstate(divide='ignore'):
+            log_c = np.log(self.c)
+        return self.components._log_P(y).reshape(
+            (-1, self.n_states, self.n_mix)) + log_c
+    def _log_P(self, # GMM instance
+               y):
+        '''Return log P(y[t]|s) for all t and s
+        '''
+        lj = self._log_joint(y)
+        top = lj.max(axis=2)
+        top[~np.isfinite(top)] = 0
+        return top + np.log(np.exp(lj - top[:, :, np.newaxis]).sum(axis=2))
+    def calc(self, # GMM instance
+             y_, work=None):
+        """
+        Calculate and return likelihoods: self.P_Y[t,i] = P(y(t)|s(t)=i)
+        """
+        n_y = len(y_[0])
+        self.P_Y = initialize(self.P_Y, (n_y, self.n_states), np.float64,
+                              work, (id(self), 'P_Y'))
+        return self.calc_block(y_, 0, n_y, self.P_Y)
+    def calc_block(self, # GMM instance
+                   y, t0, t1, out):
+        """
+        Assign and return out[t-t0,i] = P(y(t)|s(t)=i) for t0 <= t < t1
+        """
+        np.exp(self._log_P(y[0][t0:t1]), out=out)
+        return out
+    log_calc = Gauss.log_calc
+    log_calc_block = Gauss.log_calc_block
+    def reestimate(self, # GMM instance
+                   w,    # Weights
+                   y):   # Observations
+        """
+        Estimate new model parameters.  The weight of component m of
+        state s at time t is w[t,s] times the posterior probability of
+        the component given y[t] and s.
+
+        Parameters
+        ----------
+        w : array
+            w[t,s] = Prob(state[t]=s) given data and old model
+        y : list
+            y[0] is a sequence of vector observations
+
+        Returns
+        -------
+        None
+        """
+        lj = self._log_joint(y[0])
+        r = np.exp(lj - lj.max(axis=2)[:, :, np.newaxis])
+        r *= (w/r.sum(axis=2))[:, :, np.newaxis]  # r[t,s,m]
+        r = r.reshape((len(r), -1))
+        self.components.center(r, y)
+        stats = self.components.statistics(r, y)
+        self.components.update(stats)
+        self.c = stats[0].reshape((self.n_states, self.n_mix))
+        self.c /= self.c.sum(axis=1).reshape((-1, 1))
+        self.bump_version()
+        return
+
+#--------------------------------
+# Local Variables:
+# mode: python
+# End:
@@ -0,0 +1,168 @@
+'''bank.py: Score many records with a bank of HMMs.
+
+Classifying records means evaluating each record with several models.
+Models in a bank often share observation models, eg, several
+ApOb.fudge_pow instances built on the same ApOb.Both, or models
+trained from the same initial model that still have identical
+components.  ModelBank runs the forward recursions of all of its
+models together, one block of times at a time, and evaluates each
+distinct observation model component only once per block.
+
+'''
+Copyright = '''
+Copyright 2013 Andrew M. Fraser and Los Alamos National Laboroatory
+
+This file is part of hmmds3.
+
+Hmmds3 is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+Hmmds3 is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+for more details.
+
+See the file gpl.txt in the root directory of the hmmds3 distribution
+or see <http://www.gnu.org/licenses/>.
+'''
+import hashlib
+import pickle
+import numpy as np
+
+_CACHES = ('P_Y', 'g', 'version', 'alias') # Attributes that aren't parameters
+def _is_y_mod(x):
+    return hasattr(x, 'calc_block') and not isinstance(x, type)
+def _params(y_mod):
+    '''Return the class and parameters of y_mod, including those of
+    its component observation models, without cached results.
+    '''
+    if isinstance(y_mod, _Shared):
+        y_mod = y_mod.y_mod
+    if not _is_y_mod(y_mod):
+        return y_mod
+    return (y_mod.__class__.__module__, y_mod.__class__.__qualname__,
+            tuple((key, _params(value)) for key, value in
+                  sorted(vars(y_mod).items()) if key not in _CACHES))
+def signature(y_mod):
+    '''Return a string that is the same for observation models with
+    the same class and parameters.
+
+    Parameters
+    ----------
+    y_mod : observation model instance
+
+    Returns
+    -------
+    sig : str
+    '''
+    return hashlib.sha1(pickle.dumps(_params(y_mod))).hexdigest()
+class _Shared:
+    '''Stands in for an observation model while a ModelBank scores
+    records.  calc_block and log_calc_block look up results in a cache
+    that the bank clears for each block.  Other attributes come from
+    the wrapped model.
+    '''
+    def __init__(self, y_mod, key, cache):
+        self.y_mod = y_mod
+        self.key = key
+        self.cache = cache
+    def __getattr__(self, name):
+        return getattr(self.y_mod, name)
+    def _cached(self, method, y, t0, t1, out):
+        key = (self.key, method, t0, t1) + tuple(id(z) for z in y)
+        P_Y = self.cache.get(key)
+        if P_Y is None:
+            getattr(self.y_mod, method)(y, t0, t1, out)
+            self.cache[key] = out.copy()
+        else:
+            out[:] = P_Y
+        return out
+    def calc_block(self, y, t0, t1, out):
+        return self._cached('calc_block', y, t0, t1, out)
+    def log_calc_block(self, y, t0, t1, out):
+        return self._cached('log_calc_block', y, t0, t1, out)
+class ModelBank:
+    '''A collection of HMMs that score the same records.
+
+    Parameters
+    ----------
+    models : list
+        HMM instances.  Each must accept the same observation
+        sequences.
+
+    '''
+    def __init__(self, # ModelBank instance
+                 models):
+        self.models = list(models)
+        self.cache = {}
+        self.n_distinct = 0 # Distinct observation models in last call
+    def _install(self):
+        '''Replace each observation model and each of its components
+        with a _Shared wrapper.  Return a list of (object, attribute,
+        original) for _restore.
+        '''
+        saved = []
+        wrappers = {} # id(y_mod) -> _Shared
+        def wrap(parent, name):
+            y_mod = getattr(parent, name)
+            if id(y_mod) not in wrappers:
+                for key, value in list(vars(y_mod).items()):
+                    if _is_y_mod(value):
+                        wrap(y_mod, key)
+                wrappers[id(y_mod)] = _Shared(
+                    y_mod, signature(y_mod), self.cache)
+            saved.append((parent, name, y_mod))
+            setattr(parent, name, wrappers[id(y_mod)])
+        for mod in self.models:
+            wrap(mod, 'y_mod')
+        self.n_distinct = len(set(w.key for w in wrappers.values()))
+        return saved
+    def _restore(self, saved):
+        for parent, name, y_mod in reversed(saved):
+            setattr(parent, name, y_mod)
+        self.cache.clear()
+    def log_likelihoods(self, # ModelBank instance
+                        ys, block=1024):
+        '''Calculate the log likelihood of each record for each model.
+
+        Parameters
+        ----------
+        ys : list
+            Records.  Each is a list of sequences of observation
+            components
+        block : int, optional
+            Number of times in each block
+
+        Returns
+        -------
+        LL : array
+            LL[i,j] is the log likelihood of ys[j] given self.models[i]
+
+        '''
+        LL = np.zeros((len(self.models), len(ys)))
+        saved = self._install()
+        try:
+            for j, y in enumerate(ys):
+                n_y = len(y[0])
+                lasts = [np.array(mod.P_S0.reshape(-1), np.float64)
+                         for mod in self.models]
+                P_Ys = [np.empty((min(block, n_y), mod.n_states), mod.dtype)
+                        for mod in self.models]
+                for t0 in range(0, n_y, block):
+                    t1 = min(t0 + block, n_y)
+                    self.cache.clear()
+                    for i, mod in enumerate(self.models):
+                        # _calc_block handles models with log_domain
+                        P_Y = P_Ys[i][:t1-t0]
+                        LL[i, j] += mod._calc_block(y, t0, t1, P_Y)
+                        LL[i, j] += mod._ll_block(P_Y, lasts[i])
+        finally:
+            self._restore(saved)
+        return LL
+
+#--------------------------------
+# Local Variables:
+# mode: python
+# End:
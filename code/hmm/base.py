@@ -23,7 +23,7 @@ or see <http://www.gnu.org/licenses/>.
 '''
 import numpy as np
 from hmm.Scalar import initialize, Prob, Discrete_Observations, Class_y
-from hmm.Scalar import make_prob
+from hmm.Scalar import make_prob, Workspace
 
 class HMM:
     '''A Hidden Markov Model implementation.
@@ -42,6 +42,19 @@ class HMM:
        Observation model created by: y_class(y_params)
     prob : function, optional
         Function to make conditional probability matrix
+    dtype : numpy dtype, optional
+        Storage type for the per-time arrays alpha, beta and P_Y.  With
+        np.float32 they take half the memory.  gamma, the log
+        likelihood and the sums for reestimation stay np.float64.
+    n_threads : int, optional
+        If more than 1, P_Y_calc evaluates the observation model on
+        chunks of the time axis in a pool of this many threads.
+    log_domain : bool, optional
+        If True, get log likelihoods from the observation model and
+        shift each time by its maximum before exponentiating.  The
+        shifts are in self.log_shift, and the log likelihoods that
+        forward and log_likelihood return include them.  That avoids
+        underflow of P_Y for outliers and extreme parameters.
 
     Examples
     --------
@@ -98,6 +111,14 @@ class HMM:
      [ 0.     0.726  0.274]
     
     '''
+    dtype = np.float64 # Default for instances pickled before dtype existed
+    work = None        # Instances pickled before work existed allocate
+    n_threads = 1
+    log_domain = False
+    log_shift = None   # log_shift[t] was subtracted from log P_Y[t]
+    c = None           # Class sequence for the gated methods
+    gates = None       # (index, sub) from _gates() for the gated methods
+    cache = None       # Optional Cache of results of P_Y_calc.  See set_cache
     def __init__(
         self,         # HMM instance
         P_S0,         # Initial distribution of states
@@ -105,10 +126,16 @@ class HMM:
         y_params,     # Parameters of observation model
         P_SS,         # P_SS[a,b] = Prob(s(1)=b|s(0)=a)
         y_class=Discrete_Observations,
-        prob=make_prob# Function to make conditional probability matrix
+        prob=make_prob,# Function to make conditional probability matrix
+        dtype=np.float64,# Storage type for alpha, beta and P_Y
+        n_threads=1,  # Number of threads for P_Y_calc
+        log_domain=False # Use log likelihoods from y_mod
         ):
         '''Builds a new Hidden Markov Model
         '''
+        self.dtype = dtype
+        self.n_threads = n_threads
+        self.log_domain = log_domain
         self.n_states = len(P_S0)
         self.P_S0 = np.array(P_S0)
         self.P_S0_ergodic = np.array(P_S0_ergodic)
@@ -118,26 +145,160 @@ class HMM:
         self.gamma = None
         self.beta = None
         self.n_y = None
+        self.work = Workspace() # Reusable arrays for alpha, beta, P_Y, etc
         return # End of __init__()
     def P_Y_calc(self, # HMM instance
-                 y):
+                 y, n_threads=None, chunk=None):
         '''Calculate the observation probabilities.
 
-        Also store result in self and assign self.n_y.
+        Also store result in self and assign self.n_y.  The result
+        lives in memory from self.work and is overwritten by the next
+        call.
+
+        With more than one thread, split the time axis into chunks
+        and have a ThreadPoolExecutor write the results of
+        self.y_mod.calc_block into slices of P_Y.  That helps when the
+        observation model spends its time in numpy operations that
+        release the GIL, eg, Gauss, Class_y and Heart_Rate.
 
         Parameters
         ----------
         y : list
             List of sequences of observation components.
+        n_threads : int, optional
+            Default self.n_threads
+        chunk : int, optional
+            Number of times in each chunk.  Default from chunk_size()
 
         Returns
         -------
         P_Y : array
             1-d numpy array of probabilities.
         '''
-        self.P_Y = self.y_mod.calc(y)
+        if n_threads is None:
+            n_threads = self.n_threads
+        key = self._cache_key('P_Y', y, self.y_mod)
+        if key is not None:
+            hit = self.cache.get(key)
+            if hit is not None:
+                self.P_Y, self.log_shift = hit
+                self.n_y = len(self.P_Y)
+                return self.P_Y
+            self._P_Y_calc(y, n_threads, chunk)
+            self.P_Y, self.log_shift = self.cache.put(
+                key, y, (self.P_Y, self.log_shift))
+            return self.P_Y
+        return self._P_Y_calc(y, n_threads, chunk)
+    def _P_Y_calc(self, # HMM instance
+                  y, n_threads, chunk):
+        '''P_Y_calc without the cache
+        '''
+        self.n_y = len(y[0])
+        self.log_shift = None
+        if chunk is None:
+            chunk = chunk_size(self.n_y, self.n_states, n_threads)
+        if self.log_domain:
+            return self._log_P_Y_calc(y, n_threads, chunk)
+        if n_threads > 1 and chunk < self.n_y:
+            import concurrent.futures
+            self.P_Y = initialize(None, (self.n_y, self.n_states),
+                                  self.dtype, self.work, 'P_Y')
+            with concurrent.futures.ThreadPoolExecutor(n_threads) as executor:
+                futures = [executor.submit(
+                    self.y_mod.calc_block, y, t0, min(t0+chunk, self.n_y),
+                    self.P_Y[t0:t0+chunk])
+                           for t0 in range(0, self.n_y, chunk)]
+                for future in futures:
+                    future.result() # Raise exceptions from workers
+            return self.P_Y
+        P_Y = self.y_mod.calc(y, self.work)
+        if P_Y.dtype != self.dtype:
+            self.P_Y = initialize(
+                None, P_Y.shape, self.dtype, self.work, 'P_Y')
+            self.P_Y[:] = P_Y
+        else:
+            self.P_Y = P_Y
         self.n_y = len(self.P_Y)
         return self.P_Y
+    def set_cache(self, # HMM instance
+                  max_bytes=2**28):
+        '''Keep results of P_Y_calc and class_decode for reuse.
+
+        Later calls with the same observation objects, ie, the same
+        python objects rather than equal values, and the same
+        parameters of the observation model get the stored arrays.
+        Parameters are identified by y_mod.param_version().  Decoding
+        the same records with several models, or again after training
+        other parts of a model, then costs a lookup.  Don't modify
+        observations in place while they are in the cache.  The cache
+        is off by default because scripts that evaluate each record
+        once with each set of parameters, eg, DoubleClassify,
+        StatePic and PFsurvey, never get a hit and would only hold
+        memory.
+
+        Parameters
+        ----------
+        max_bytes : int, optional
+            Limit on the size of the stored arrays.  The least
+            recently used are dropped first.  None or 0 turns the
+            cache off.
+        '''
+        self.cache = Cache(max_bytes) if max_bytes else None
+    def _cache_key(self, # HMM instance
+                   kind, y, y_mod):
+        '''Return the key for the cache, or None if there is no cache or
+        y_mod has no param_version method.
+        '''
+        if self.cache is None or not hasattr(y_mod, 'param_version'):
+            return None
+        return (kind, tuple(id(z) for z in y), y_mod.param_version(),
+                self.log_domain, np.dtype(self.dtype).str)
+    def _log_P_Y_calc(self, # HMM instance
+                      y, n_threads, chunk):
+        '''P_Y_calc for self.log_domain.  Get log likelihoods from
+        self.y_mod, subtract the maximum at each time and store it in
+        self.log_shift, and put the exponential in self.P_Y.
+        '''
+        if n_threads > 1 and chunk < self.n_y:
+            import concurrent.futures
+            log_P_Y = initialize(None, (self.n_y, self.n_states),
+                                 np.float64, self.work, 'log_P_Y')
+            with concurrent.futures.ThreadPoolExecutor(n_threads) as executor:
+                futures = [executor.submit(
+                    self.y_mod.log_calc_block, y, t0,
+                    min(t0+chunk, self.n_y), log_P_Y[t0:t0+chunk])
+                           for t0 in range(0, self.n_y, chunk)]
+                for future in futures:
+                    future.result()
+        else:
+            log_P_Y = self.y_mod.log_calc(y, self.work)
+        self.log_shift = _max_shift(log_P_Y)
+        self.P_Y = initialize(None, log_P_Y.shape, self.dtype, self.work,
+                              'P_Y')
+        np.exp(log_P_Y, out=self.P_Y, casting='same_kind')
+        return self.P_Y
+    def _calc_block(self, # HMM instance
+                    y, t0, t1, out):
+        '''Put observation probabilities for t0 <= t < t1 in out for the
+        fused and blockwise methods.  Return the sum of log_shift over
+        the block, which is zero unless self.log_domain.
+        '''
+        if not self.log_domain:
+            self.y_mod.calc_block(y, t0, t1, out)
+            return 0.0
+        log_P_Y = initialize(None, out.shape, np.float64, self.work,
+                             'log_P_Y_block')
+        self.y_mod.log_calc_block(y, t0, t1, log_P_Y)
+        shift = _max_shift(log_P_Y)
+        np.exp(log_P_Y, out=out, casting='same_kind')
+        return shift.sum()
+    def _shift_sum(self # HMM instance
+                   ):
+        '''Return the sum of self.log_shift, or 0 if it is None
+        '''
+        if self.log_shift is None:
+            return 0.0
+        return self.log_shift.sum()
     def forward(self # HMM instance
             ):
         '''
@@ -173,23 +334,95 @@ class HMM:
 
         On return:
 
-        * self.gamma[t] = Pr{y(t)=y(t)|y_0^{t-1}}
+        * self.gamma[t] = Pr{y(t)=y(t)|y_0^{t-1}}, divided by
+          exp(self.log_shift[t]) if self.log_domain
         * self.alpha[t,i] = Pr{s(t)=i|y_0^t}
         * return value is log likelihood of all data
 
         '''
 
         # Ensure allocation and size of alpha and gamma
-        self.alpha = initialize(self.alpha, (self.n_y, self.n_states))
-        self.gamma = initialize(self.gamma, (self.n_y,))
-        last = np.copy(self.P_S0.reshape(-1)) # Copy
-        for t in range(self.n_y):
-            last *= self.P_Y[t]              # Element-wise multiply
-            self.gamma[t] = last.sum()
-            last /= self.gamma[t]
-            self.alpha[t, :] = last
+        self.alpha = initialize(self.alpha, (self.n_y, self.n_states),
+                                self.dtype, self.work, 'alpha')
+        self.gamma = initialize(
+            self.gamma, (self.n_y,), np.float64, self.work, 'gamma')
+        last = np.array(self.P_S0.reshape(-1), np.float64) # Copy
+        self._forward_block(self.P_Y, last, self.alpha, self.gamma)
+        LL = (np.log(self.gamma)).sum() + self._shift_sum()
+        return LL # End of forward()
+    def _forward_block(self, # HMM instance
+                       P_Y, last, alpha, gamma):
+        '''Run the forward recursion over a block of times.  last is
+        the distribution of the state at the first time given earlier
+        observations.  On return it is the distribution for the time
+        after the block.  C.HMM overrides this method.
+        '''
+        for t in range(len(P_Y)):
+            last *= P_Y[t]                   # Element-wise multiply
+            gamma[t] = last.sum()
+            last /= gamma[t]
+            alpha[t, :] = last
             self.P_SS.step_forward(last)
-        return (np.log(self.gamma)).sum() # End of forward()
+        return last
+    def forward_parallel(self, # HMM instance
+                         n_blocks=None, executor=None):
+        '''Variant of forward() that splits the time axis into blocks and
+        uses several workers.
+
+        The work has three phases: 1. In parallel, calculate the
+        normalized transfer matrix, prod_t diag(P_Y[t])*P_SS, for each
+        block; 2. Combine the transfer matrices with a prefix scan to
+        get the state distribution at the start of each block; 3. In
+        parallel, run the ordinary forward recursion from each of those
+        distributions to fill in alpha and gamma.  Results match
+        forward().
+
+        Parameters
+        ----------
+        n_blocks : int, optional
+            Number of blocks.  Default is the number of cpus
+        executor : concurrent.futures.Executor, optional
+            Pool of workers.  Default is a ProcessPoolExecutor
+
+        Returns
+        -------
+        L : float
+            Log likelihood of all data
+
+        '''
+        import concurrent.futures
+        import os
+        if n_blocks is None:
+            n_blocks = os.cpu_count() or 1
+        n_blocks = max(1, min(n_blocks, self.n_y))
+        self.alpha = initialize(self.alpha, (self.n_y, self.n_states),
+                                self.dtype, self.work, 'alpha')
+        self.gamma = initialize(
+            self.gamma, (self.n_y,), np.float64, self.work, 'gamma')
+        bounds = np.linspace(0, self.n_y, n_blocks+1).astype(int)
+        P_SS = np.asarray(self.P_SS.values())
+        P_Ys = [self.P_Y[bounds[b]:bounds[b+1]] for b in range(n_blocks)]
+        own = executor is None
+        if own:
+            executor = concurrent.futures.ProcessPoolExecutor()
+        try:
+            transfers = list(executor.map(
+                _block_transfer, P_Ys[:-1], (n_blocks-1)*[P_SS]))
+            # Exclusive prefix scan of the first state distribution
+            # through the block transfer matrices
+            entries = [np.copy(self.P_S0.reshape(-1))]
+            for M in transfers:
+                last = np.dot(entries[-1], M)
+                entries.append(last/last.sum())
+            results = executor.map(
+                _block_forward, P_Ys, n_blocks*[P_SS], entries)
+            for b, (alpha, gamma) in enumerate(results):
+                self.alpha[bounds[b]:bounds[b+1]] = alpha
+                self.gamma[bounds[b]:bounds[b+1]] = gamma
+        finally:
+            if own:
+                executor.shutdown()
+        return (np.log(self.gamma)).sum() + self._shift_sum()
     def backward(self # HMM instance
     ):
         '''
@@ -225,17 +458,161 @@ class HMM:
 
         '''
         # Ensure allocation and size of beta
-        self.beta = initialize(self.beta, (self.n_y, self.n_states))
+        self.beta = initialize(self.beta, (self.n_y, self.n_states),
+                               self.dtype, self.work, 'beta')
         last = np.ones(self.n_states)
-        # iterate
-        for t in range(self.n_y-1, -1, -1):
-            self.beta[t, :] = last
-            last *= self.P_Y[t]
-            last /= self.gamma[t]
-            self.P_SS.step_back(last)
+        self._backward_block(self.P_Y, last, self.beta, self.gamma)
         return # End of backward()
+    def _backward_block(self, # HMM instance
+                        P_Y, last, beta, gamma):
+        '''Run the backward recursion over a block of times.  last is
+        beta for the last time in the block.  On return it is beta for
+        the time before the block.  C.HMM overrides this method.
+        '''
+        for t in range(len(P_Y)-1, -1, -1):
+            beta[t, :] = last
+            last *= P_Y[t]
+            last /= gamma[t]
+            self.P_SS.step_back(last)
+        return last
+    def forward_fused(self, # HMM instance
+                      y, block=1024):
+        '''Like P_Y_calc followed by forward, but get the observation
+        probabilities from self.y_mod.calc_block one block of times at
+        a time so that the full P_Y array is never stored.
+
+        Parameters
+        ----------
+        y : list
+            List of sequences of observation components
+        block : int, optional
+            Number of times in each block
+
+        Returns
+        -------
+        LL : float
+            Log likelihood of all data
+
+        '''
+        self.n_y = len(y[0])
+        self.P_Y = None
+        self.alpha = initialize(self.alpha, (self.n_y, self.n_states),
+                                self.dtype, self.work, 'alpha')
+        self.gamma = initialize(
+            self.gamma, (self.n_y,), np.float64, self.work, 'gamma')
+        P_Y = initialize(None, (min(block, self.n_y), self.n_states),
+                         self.dtype, self.work, 'P_Y_block')
+        last = np.array(self.P_S0.reshape(-1), np.float64) # Copy
+        LL = 0.0
+        for t0 in range(0, self.n_y, block):
+            t1 = min(t0 + block, self.n_y)
+            LL += self._calc_block(y, t0, t1, P_Y[:t1-t0])
+            last = self._forward_block(P_Y[:t1-t0], last,
+                                       self.alpha[t0:t1], self.gamma[t0:t1])
+        return (np.log(self.gamma)).sum() + LL
+    def log_likelihood(self, # HMM instance
+                       y, block=1024):
+        '''Calculate the log likelihood of y without storing alpha,
+        gamma or the full P_Y.
+
+        Runs the scaled forward recursion with O(n_states) state on
+        blocks of observation probabilities from y_mod.calc_block and
+        accumulates log(gamma[t]) as it goes.  Doesn't change self.
+
+        Parameters
+        ----------
+        y : list
+            List of sequences of observation components
+        block : int, optional
+            Number of times in each block
+
+        Returns
+        -------
+        LL : float
+            Log likelihood of all data
+
+        '''
+        n_y = len(y[0])
+        P_Y = initialize(None, (min(block, n_y), self.n_states),
+                         self.dtype, self.work, 'P_Y_block')
+        last = np.array(self.P_S0.reshape(-1), np.float64) # Copy
+        LL = 0.0
+        for t0 in range(0, n_y, block):
+            t1 = min(t0 + block, n_y)
+            LL += self._calc_block(y, t0, t1, P_Y[:t1-t0])
+            LL += self._ll_block(P_Y[:t1-t0], last)
+        return LL
+    def multi_log_likelihood(self, # HMM instance
+                             ys, block=1024):
+        '''Apply log_likelihood to each of a batch of sequences.
+
+        Parameters
+        ----------
+        ys : list
+            List of observation sequences, each like y in log_likelihood
+        block : int, optional
+            Number of times in each block
+
+        Returns
+        -------
+        LL : array
+            LL[i] is the log likelihood of ys[i]
+
+        '''
+        return np.array([self.log_likelihood(y, block) for y in ys])
+    def _ll_block(self, # HMM instance
+                  P_Y, last):
+        '''Like _forward_block, but only return the sum of log(gamma).
+        last is updated in place.  C.HMM and C.HMM_SPARSE override
+        this method.
+        '''
+        LL = 0.0
+        for t in range(len(P_Y)):
+            last *= P_Y[t]
+            gamma = last.sum()
+            last /= gamma
+            LL += np.log(gamma)
+            self.P_SS.step_forward(last)
+        return LL
+    def backward_fused(self, # HMM instance
+                       y, block=1024):
+        r'''Like backward, but recalculate the observation
+        probabilities block by block as in forward_fused.  Since
+        P_Y[t+1] is not available to reestimate, also accumulate and
+        return the sums for reestimating P_SS.
+
+        Parameters
+        ----------
+        y : list
+            List of sequences of observation components
+        block : int, optional
+            Number of times in each block
+
+        Returns
+        -------
+        u_sum : array
+            u_sum[i,j] = \sum_t alpha[t,i]*P_Y[t+1,j]*beta[t+1,j]/gamma[t+1]
+
+        '''
+        self.beta = initialize(self.beta, (self.n_y, self.n_states),
+                               self.dtype, self.work, 'beta')
+        P_Y = initialize(None, (min(block, self.n_y), self.n_states),
+                         self.dtype, self.work, 'P_Y_block')
+        u_sum = np.zeros((self.n_states, self.n_states), np.float64)
+        last = np.ones(self.n_states)
+        for t0 in range((self.n_y-1)//block*block, -1, -block):
+            t1 = min(t0 + block, self.n_y)
+            P = P_Y[:t1-t0]
+            self._calc_block(y, t0, t1, P) # Same shifts as forward_fused
+            last = self._backward_block(P, last, self.beta[t0:t1],
+                                        self.gamma[t0:t1])
+            P *= self.beta[t0:t1]
+            P /= self.gamma[t0:t1].reshape((-1, 1))
+            s0 = max(t0, 1) # alpha[t0-1] does not exist for t0 = 0
+            u_sum += np.dot(self.alpha[s0-1:t1-1].T, P[s0-t0:])
+        return u_sum
     def train(self,  # HMM instance
-              y, n_iter=1, display=True):
+              y, n_iter=1, display=True, block=None, gated=False):
         '''Based on observations y, do n_iter iterations of model reestimation
 
         Use Baum-Welch algorithm to search for maximum likelihood
@@ -250,6 +627,12 @@ class HMM:
         display : bool, optional
             If True, print the log likelihood per observation for each
             iteration
+        block : int, optional
+            If given, use forward_fused and backward_fused with blocks
+            of this length rather than storing all of P_Y
+        gated : bool, optional
+            If True, use forward_gated, backward_gated and
+            reestimate_gated.  Requires a Class_y observation model
 
         Returns
         -------
@@ -260,16 +643,29 @@ class HMM:
         # Do (n_iter) BaumWelch iterations
         LLL = []
         for it in range(n_iter):
-            self.P_Y_calc(y)
-            LLps = self.forward()/self.n_y # log likelihood per step
+            if gated:
+                LLps = self.forward_gated(y)/self.n_y
+            elif block is None:
+                self.P_Y_calc(y)
+                LLps = self.forward()/self.n_y # log likelihood per step
+                u_sum = None
+            else:
+                LLps = self.forward_fused(y, block)/self.n_y
             if display:
                 print("it= %d LLps= %7.3f"%(it, LLps))
             LLL.append(LLps)
-            self.backward()
-            self.reestimate(y)
+            if gated:
+                self.backward_gated()
+                self.reestimate_gated(y)
+                continue
+            if block is None:
+                self.backward()
+            else:
+                u_sum = self.backward_fused(y, block)
+            self.reestimate(y, u_sum)
         return LLL # End of train()
     def reestimate(self,  # HMM instance
-                   y):
+                   y, u_sum=None):
         '''Reestimate model parameters
 
         Code here updates state transition probabilities and initial
@@ -280,20 +676,24 @@ class HMM:
         ----------
         y : array
             Sequence of observations
+        u_sum : array, optional
+            Sums for reestimating P_SS from backward_fused.  If None,
+            calculate them from self.P_Y
 
         Returns
         -------
         None
 
         '''
-        u_sum = np.zeros((self.n_states, self.n_states), np.float64)
-        for t in np.where(self.gamma[1:]>0)[0]: # Skip segment boundaries
-            u_sum += np.outer(self.alpha[t]/self.gamma[t+1],
-                              self.P_Y[t+1]*self.beta[t+1, :])
+        if u_sum is None:
+            u_sum = np.zeros((self.n_states, self.n_states), np.float64)
+            for t in np.where(self.gamma[1:]>0)[0]: # Skip segment boundaries
+                u_sum += np.outer(self.alpha[t]/self.gamma[t+1],
+                                  self.P_Y[t+1]*self.beta[t+1, :])
         self.alpha *= self.beta
-        wsum = self.alpha.sum(axis=0)
+        wsum = self.alpha.sum(axis=0, dtype=np.float64)
         self.P_S0_ergodic = np.copy(wsum)
-        self.P_S0 = np.copy(self.alpha[0])
+        self.P_S0 = np.array(self.alpha[0], np.float64)
         for x in (self.P_S0_ergodic, self.P_S0):
             x /= x.sum()
         assert u_sum.shape == self.P_SS.shape
@@ -321,7 +721,8 @@ class HMM:
         '''
         if P_Y is None:
             P_Y = self.P_Y_calc(y)
-        pred = np.empty((self.n_y, self.n_states), np.int32) # Best predecessors
+        pred = initialize(None, (self.n_y, self.n_states), np.int32,
+                          self.work, 'pred') # Best predecessors
         ss = np.ones((self.n_y, 1), np.int32)       # State sequence
         nu = P_Y[0] * self.P_S0
         for t in range(1, self.n_y):
@@ -436,7 +837,18 @@ class HMM:
           1,   0,   0
 
         '''
-        P_Y = self.y_mod.y_mod.calc(y)
+        key = self._cache_key('class_decode', y, self.y_mod.y_mod)
+        P_Y = None if key is None else self.cache.get(key)
+        if P_Y is not None:
+            P_Y = P_Y[0]
+        elif self.log_domain: # Shifts don't change the best class sequence
+            P_Y = self.y_mod.y_mod.log_calc(y, self.work)
+            _max_shift(P_Y)
+            np.exp(P_Y, out=P_Y)
+        else:
+            P_Y = self.y_mod.y_mod.calc(y, self.work)
+        if key is not None:
+            P_Y = self.cache.put(key, y, (P_Y,))[0]
         old_set = set([ClassHistory(
             tuple(),            # Empty history
             self.P_S0_ergodic,  # phi, ie, conditional utility of states
@@ -476,7 +888,7 @@ class HMM:
         n_y = len(y[0])
         s1 = np.arange(self.n_states, dtype=np.int32) #Index for cs_cost -> phi
         c1 = self.y_mod.s2c[s1] # Index for cs_cost -> phi
-        P_Y = self.y_mod.y_mod.calc(y) # P_Y[t,s] = prob(Y=y[t]|state=s)
+        P_Y = self.y_mod.y_mod.calc(y, self.work) # P_Y[t,s] = prob(Y=y[t]|state=s)
 
         # Do partial first iteration before loop
         pred = np.empty((n_y,n_c),np.int32)
@@ -639,13 +1051,14 @@ P_SS =
             ys,           # List of observation sequences
             n_iter=1,
             boost_w=None, # Optional weight of each observation for reestimation
-            display=True
+            display=True,
+            gated=False   # Restrict work to the states of each class
         ):
         '''Train on multiple sequences of observations
 
         Parameters
         ----------
-        ys : list
+        ys : list or SequenceSet
             list of sequences of integer observations
         n_iter : int, optional
             Number of iterations
@@ -654,6 +1067,9 @@ P_SS =
         display : bool, optional
             If True, print the log likelihood per observation for each
             segment and each iteration
+        gated : bool, optional
+            If True, use multi_forward_backward_gated and
+            reestimate_gated.  Requires a Class_y observation model
 
         Returns
         -------
@@ -691,12 +1107,17 @@ P_SS =
         i=2: L[0]=-0.9112 L[1]=-0.9080 L[2]=-0.9249 avg=-0.9147362
 
         '''
+        if gated and boost_w is not None:
+            raise RuntimeError('multi_train does not support boost_w if gated')
         n_seg, t_seg, y_all = self.y_mod.join(ys)
         avgs = n_iter*[None] # Average log likelihood per step
         t_total = t_seg[-1]
-        alpha_all = initialize(self.alpha, (t_total, self.n_states))
-        beta_all = initialize(self.beta, (t_total, self.n_states))
-        gamma_all = initialize(self.gamma, (t_total,))
+        alpha_all = initialize(self.alpha, (t_total, self.n_states),
+                               self.dtype, self.work, 'alpha')
+        beta_all = initialize(self.beta, (t_total, self.n_states),
+                              self.dtype, self.work, 'beta')
+        gamma_all = initialize(
+            self.gamma, (t_total,), np.float64, self.work, 'gamma')
         P_S0_all = np.empty((n_seg, self.n_states))
         #P_S0_all are state probabilities at the beginning of each segment
         for seg in range(n_seg):
@@ -705,25 +1126,19 @@ P_SS =
             if display:
                 print('i=%d: '%i, end='')
             tot = 0.0
-            # Both forward() and backward() should operate on each
-            # training segment and put the results in the
-            # corresponding segement of the the alpha, beta and gamma
-            # arrays.
-            P_Y_all = self.P_Y_calc(y_all)
+            if gated:
+                LLs = self.multi_forward_backward_gated(
+                    y_all, t_seg, P_S0_all)
+            else:
+                P_Y_all = self.P_Y_calc(y_all)
+                LLs = self.multi_forward_backward(
+                    P_Y_all, t_seg, alpha_all, beta_all, gamma_all, P_S0_all)
             for seg in range(n_seg):
-                self.n_y = t_seg[seg+1] - t_seg[seg]
-                self.alpha = alpha_all[t_seg[seg]:t_seg[seg+1], :]
-                self.beta = beta_all[t_seg[seg]:t_seg[seg+1], :]
-                self.P_Y = P_Y_all[t_seg[seg]:t_seg[seg+1]]
-                self.gamma = gamma_all[t_seg[seg]:t_seg[seg+1]]
-                self.P_S0 = P_S0_all[seg, :]
-                LL = self.forward() #Log Likelihood
+                LL = LLs[seg] #Log Likelihood
                 if display:
-                    print('L[%d]=%7.4f '%(seg,LL/self.n_y), end='')
+                    print('L[%d]=%7.4f '%(
+                        seg, LL/(t_seg[seg+1] - t_seg[seg])), end='')
                 tot += LL
-                self.backward()
-                P_S0_all[seg, :] = self.alpha[0] * self.beta[0]
-                self.gamma[0] = -1 # Don't fit transitions between segments
             avgs[i] = tot/t_total
             if i>0 and avgs[i-1] >= avgs[i]:
                 print('''
@@ -731,20 +1146,375 @@ WARNING training is not monotonic: avg[%d]=%f and avg[%d]=%f
 '''%(i-1,avgs[i-1],i,avgs[i]))
             if display:
                 print('avg=%10.7f'% avgs[i])
+            if gated:
+                self.reestimate_gated(y_all)
+                continue
             # Associate all of the alpha and beta segments with the
             # states and reestimate()
             self.alpha = alpha_all
             self.beta = beta_all
             self.gamma = gamma_all
             self.P_Y = P_Y_all
-            if boost_w != None:
-                self.alpha *= BoostW
+            if boost_w is not None:
+                self.alpha *= np.reshape(boost_w, (t_total, -1))
             self.n_y = len(P_Y_all)
             self.reestimate(y_all)
         self.P_S0[:] = P_S0_all.sum(axis=0)
         self.P_S0 /= self.P_S0.sum()
         return avgs
+    def multi_forward_backward(
+            self,         # HMM instance
+            P_Y_all,      # Observation probabilities for all segments
+            t_seg,        # Segment boundaries in P_Y_all
+            alpha_all,    # Array for alpha of all segments
+            beta_all,     # Array for beta of all segments
+            gamma_all,    # Array for gamma of all segments
+            P_S0_all      # P_S0_all[seg] is initial distribution of seg
+        ):
+        '''Run forward() and backward() on each segment for multi_train
+
+        Each pass puts its results in the corresponding segment of
+        the alpha, beta and gamma arrays.  On return P_S0_all[seg] is
+        proportional to the distribution of the first state of segment
+        seg given all of the data in the segment, and gamma is -1 at
+        the first time of each segment so that reestimate() does not
+        fit transitions between segments.  Subclasses may override
+        this method to process the segments concurrently.
+
+        Returns
+        -------
+        LL : list
+            Log likelihood of each segment
+
+        '''
+        LL = []
+        log_shift = self.log_shift
+        for seg in range(len(t_seg)-1):
+            self.n_y = t_seg[seg+1] - t_seg[seg]
+            if log_shift is not None:
+                self.log_shift = log_shift[t_seg[seg]:t_seg[seg+1]]
+            self.alpha = alpha_all[t_seg[seg]:t_seg[seg+1], :]
+            self.beta = beta_all[t_seg[seg]:t_seg[seg+1], :]
+            self.P_Y = P_Y_all[t_seg[seg]:t_seg[seg+1]]
+            self.gamma = gamma_all[t_seg[seg]:t_seg[seg+1]]
+            self.P_S0 = P_S0_all[seg, :]
+            LL.append(self.forward())
+            self.backward()
+            P_S0_all[seg, :] = self.alpha[0] * self.beta[0]
+            self.gamma[0] = -1 # Don't fit transitions between segments
+        self.log_shift = log_shift
+        return LL
+    def _gates(self # HMM instance
+               ):
+        '''Return (index, sub) for the gated methods.  For the
+        observation model, a Class_y instance, index[c,j] is the jth
+        state of class c, and sub[a,b,i,j] is the probability of a
+        transition from index[a,i] to index[b,j].  Classes with fewer
+        states than the largest are padded with index n_states and
+        zero probabilities.
+        '''
+        states = self.y_mod.class_states()
+        n_class = len(states)
+        n = max(len(x) for x in states)
+        index = np.empty((n_class, n), np.int32)
+        index[:] = self.n_states
+        P_SS = np.asarray(self.P_SS.values(), np.float64)
+        sub = np.zeros((n_class, n_class, n, n))
+        for a in range(n_class):
+            index[a, :len(states[a])] = states[a]
+            for b in range(n_class):
+                sub[a, b, :len(states[a]), :len(states[b])] = P_SS[
+                    np.ix_(states[a], states[b])]
+        return index, sub
+    def P_Y_gated(self, # HMM instance
+                  cy):
+        '''Calculate the likelihoods of the states that the class
+        sequence cy[0] allows.  For models with observation model
+        Class_y, the gated methods restrict work at each time t to
+        the states of class c[t].  Each of the compact arrays P_Yc,
+        alpha_c and beta_c has a column for each state of the largest
+        class, and column j at time t is for state index[c[t],j].
+
+        Parameters
+        ----------
+        cy : list
+            Classes and observations for Class_y.calc
+
+        Returns
+        -------
+        P_Yc : array
+            Compact likelihoods.  P_Yc[t,j] = P(y(t)|s(t)=index[c[t],j])
+
+        Assigns self.gates = self._gates() for the other gated
+        methods, which use it until the next call.
+
+        '''
+        if self.log_domain:
+            raise RuntimeError('The gated methods do not support log_domain')
+        self.gates = self._gates()
+        index, sub = self.gates
+        self.c = np.asarray(cy[0], np.int32)
+        self.n_y = len(self.c)
+        self.log_shift = None
+        self.P_Yc = self.y_mod.calc_gated(cy, initialize(
+            None, (self.n_y, index.shape[1]), np.float64, self.work, 'P_Yc'))
+        return self.P_Yc
+    def forward_gated(self, # HMM instance
+                      cy):
+        '''Like P_Y_calc followed by forward, but the recursion runs
+        over only the states of class c[t] at each time t.  Assigns the
+        compact self.alpha_c and self.gamma.
+
+        Returns
+        -------
+        LL : float
+            Log likelihood of all data
+
+        '''
+        self.P_Y_gated(cy)
+        index, sub = self.gates
+        n = index.shape[1]
+        self.alpha_c = initialize(None, (self.n_y, n), np.float64,
+                                  self.work, 'alpha_c')
+        self.gamma = initialize(
+            self.gamma, (self.n_y,), np.float64, self.work, 'gamma')
+        last = np.append(self.P_S0.reshape(-1), 0)[index[self.c[0]]]
+        self._forward_gated_block(self.P_Yc, self.c, sub, last,
+                                  self.alpha_c, self.gamma)
+        return np.log(self.gamma).sum()
+    def _forward_gated_block(self, # HMM instance
+                             P_Yc, c, sub, last, alpha_c, gamma):
+        '''Run the gated forward recursion over a segment.  last is
+        the compact distribution of the first state given no
+        observations.  C.HMM overrides this method.
+        '''
+        for t in range(len(P_Yc)):
+            if t > 0:
+                last = np.dot(last, sub[c[t-1], c[t]])
+            last *= P_Yc[t]
+            gamma[t] = last.sum()
+            last /= gamma[t]
+            alpha_c[t] = last
+    def backward_gated(self # HMM instance
+                       ):
+        '''Like backward, but calculates the compact self.beta_c.
+        Requires forward_gated.
+        '''
+        self.beta_c = initialize(None, self.alpha_c.shape, np.float64,
+                                 self.work, 'beta_c')
+        index, sub = self.gates
+        self._backward_gated_block(self.P_Yc, self.c, sub, self.gamma,
+                                   self.beta_c)
+    def _backward_gated_block(self, # HMM instance
+                              P_Yc, c, sub, gamma, beta_c):
+        '''Run the gated backward recursion over a segment.  C.HMM
+        overrides this method.
+        '''
+        last = np.ones(P_Yc.shape[1])
+        for t in range(len(P_Yc)-1, -1, -1):
+            beta_c[t] = last
+            if t > 0:
+                last = np.dot(sub[c[t-1], c[t]], last*P_Yc[t]/gamma[t])
+    def reestimate_gated(self, # HMM instance
+                         cy):
+        '''Reestimate model parameters from the compact results of
+        forward_gated and backward_gated.  The sums for P_SS are
+        accumulated one pair of classes at a time, and the observation
+        model gets the compact state probabilities through
+        Class_y.reestimate_gated.
+        '''
+        index, sub = self.gates
+        c = self.c
+        P = self.P_Yc[1:]*self.beta_c[1:]/self.gamma[1:].reshape((-1, 1))
+        # Pad u_sum to collect the products for padded states
+        u_sum = np.zeros((self.n_states+1, self.n_states+1))
+        skip = self.gamma[1:] <= 0 # Segment boundaries
+        for a in range(len(index)):
+            for b in range(len(index)):
+                t = np.where((c[:-1] == a) & (c[1:] == b) & ~skip)[0]
+                if len(t) > 0:
+                    u_sum[np.ix_(index[a], index[b])] += np.dot(
+                        self.alpha_c[t].T, P[t])
+        w_c = self.alpha_c*self.beta_c # State probabilities given all data
+        self.P_S0_ergodic = np.bincount(
+            index[c].reshape(-1), weights=w_c.reshape(-1),
+            minlength=self.n_states+1)[:-1]
+        self.P_S0 = np.zeros(self.n_states+1)
+        self.P_S0[index[c[0]]] = w_c[0]
+        self.P_S0 = self.P_S0[:-1]
+        for x in (self.P_S0_ergodic, self.P_S0):
+            x /= x.sum()
+        self.P_SS.inplace_elementwise_multiply(u_sum[:-1, :-1])
+        self.P_SS.normalize()
+        self.y_mod.reestimate_gated(w_c, index, cy)
+    def multi_forward_backward_gated(
+            self,         # HMM instance
+            cy_all,       # Classes and observations for all segments
+            t_seg,        # Segment boundaries in cy_all
+            P_S0_all      # P_S0_all[seg] is initial distribution of seg
+        ):
+        '''Gated version of multi_forward_backward for multi_train.
+        Assigns the compact self.alpha_c, self.beta_c and self.gamma
+        for all of the segments.
 
+        Returns
+        -------
+        LL : list
+            Log likelihood of each segment
+
+        '''
+        self.P_Y_gated(cy_all)
+        index, sub = self.gates
+        self.alpha_c = initialize(None, self.P_Yc.shape, np.float64,
+                                  self.work, 'alpha_c')
+        self.beta_c = initialize(None, self.P_Yc.shape, np.float64,
+                                 self.work, 'beta_c')
+        self.gamma = initialize(
+            self.gamma, (self.n_y,), np.float64, self.work, 'gamma')
+        LL = []
+        full = np.zeros(self.n_states+1)
+        for seg in range(len(t_seg)-1):
+            t0, t1 = t_seg[seg], t_seg[seg+1]
+            c = self.c[t0:t1]
+            full[:-1] = P_S0_all[seg]
+            self._forward_gated_block(self.P_Yc[t0:t1], c, sub,
+                                      full[index[c[0]]],
+                                      self.alpha_c[t0:t1], self.gamma[t0:t1])
+            LL.append(np.log(self.gamma[t0:t1]).sum())
+            self._backward_gated_block(self.P_Yc[t0:t1], c, sub,
+                                       self.gamma[t0:t1], self.beta_c[t0:t1])
+            full[:] = 0
+            full[index[c[0]]] = self.alpha_c[t0]*self.beta_c[t0]
+            P_S0_all[seg] = full[:-1]
+            self.gamma[t0] = -1 # Don't fit transitions between segments
+        return LL
+    def decode_gated(self, # HMM instance
+                     cy):
+        '''Like decode, but the search at each time t considers only
+        the states of class c[t].
+
+        Returns
+        -------
+        ss : array
+            Maximum likelihood state sequence
+
+        '''
+        P_Yc = self.P_Y_gated(cy)
+        index, sub = self.gates
+        c = self.c
+        pred = initialize(None, P_Yc.shape, np.int32, self.work, 'pred')
+        nu = P_Yc[0]*np.append(self.P_S0.reshape(-1), 0)[index[c[0]]]
+        for t in range(1, self.n_y):
+            cost = sub[c[t-1], c[t]]*np.outer(nu, P_Yc[t])
+            pred[t] = cost.argmax(axis=0)  # Best predecessor
+            nu = cost.max(axis=0)          # Cost of best paths to each state
+            nu /= nu.max()                 # Prevent underflow
+        ss = np.empty(self.n_y, np.int32)
+        last = np.argmax(nu)
+        for t in range(self.n_y-1, -1, -1):
+            ss[t] = index[c[t], last]
+            last = pred[t, last]
+        return ss
+
+class Cache:
+    '''Memory bounded LRU store of arrays for HMM.set_cache.
+
+    Keys contain the ids of the observation sequences.  Each entry
+    keeps references to those sequences so that their ids can't be
+    reused while the entry exists.
+
+    Parameters
+    ----------
+    max_bytes : int
+        Limit on the total size of the stored arrays
+
+    '''
+    def __init__(self, # Cache instance
+                 max_bytes):
+        import collections
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict() # key -> (y, arrays, size)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+    def get(self, # Cache instance
+            key):
+        '''Return the tuple of arrays stored for key, or None
+        '''
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+    def put(self, # Cache instance
+            key, y, arrays):
+        '''Store copies of arrays (elements may be None) for key,
+        evicting the least recently used entries to stay within
+        max_bytes, and return the copies.  Entries bigger than
+        max_bytes are not stored.
+        '''
+        arrays = tuple(None if a is None else np.array(a) for a in arrays)
+        size = sum(a.nbytes for a in arrays if a is not None)
+        if key in self.entries:
+            self.nbytes -= self.entries.pop(key)[2]
+        if size > self.max_bytes:
+            return arrays
+        self.entries[key] = (tuple(y), arrays, size)
+        self.nbytes += size
+        while self.nbytes > self.max_bytes:
+            self.nbytes -= self.entries.popitem(last=False)[1][2]
+        return arrays
+    def clear(self # Cache instance
+    ):
+        self.entries.clear()
+        self.nbytes = 0
+    def __getstate__(self):
+        '''Don't pickle the stored arrays
+        '''
+        state = self.__dict__.copy()
+        state['entries'] = type(self.entries)()
+        state['nbytes'] = 0
+        return state
+def _max_shift(L):
+    '''Subtract the maximum of each row of L in place and return the
+    maxima.  Rows without a finite maximum are not shifted.
+
+    >>> L = np.log(np.array([[1e-300, 1e-310], [1e-5, 1e-3]]))
+    >>> shift = _max_shift(L)
+    >>> print(['%.1e'%x for x in np.exp(L).flat])
+    ['1.0e+00', '1.0e-10', '1.0e-02', '1.0e+00']
+    '''
+    with np.errstate(invalid='ignore'):
+        shift = L.max(axis=1)
+    shift[~np.isfinite(shift)] = 0
+    L -= shift.reshape((-1, 1))
+    return shift
+def _block_transfer(P_Y, P_SS):
+    '''For forward_parallel.  Return the normalized product of
+    diag(P_Y[t])*P_SS over the rows of P_Y.
+    '''
+    M = np.eye(len(P_SS))
+    for t in range(len(P_Y)):
+        M = np.dot(M*P_Y[t], P_SS)
+        M /= M.sum()
+    return M
+def _block_forward(P_Y, P_SS, last):
+    '''For forward_parallel.  Run the forward recursion on a block
+    starting from the distribution "last" and return (alpha, gamma).
+    '''
+    n_y = len(P_Y)
+    alpha = np.empty((n_y, len(P_SS)))
+    gamma = np.empty(n_y)
+    last = np.copy(last)
+    for t in range(n_y):
+        last *= P_Y[t]
+        gamma[t] = last.sum()
+        last /= gamma[t]
+        alpha[t, :] = last
+        last = np.dot(last, P_SS)
+    return alpha, gamma
 class ClassHistory:
     ''' For keeping track of good class histories
     To sort a list of histories: L.sort(key=lambda x: x.score)
@@ -774,6 +1544,20 @@ class ClassHistory:
                 score = s * self.score
                 yield ClassHistory(path, phi[c]/s, score, self.c2s, self.P_SS)
         return
+def chunk_size(n_y, n_states, n_threads):
+    '''Heuristic for the number of times in each chunk of parallel
+    P_Y_calc.  Make about 4 chunks per thread for load balance, but
+    keep at least 2**15 elements in each chunk so that the work per
+    task dominates the overhead of the pool.
+
+    >>> chunk_size(100000, 10, 4)
+    6250
+    >>> chunk_size(10000, 10, 4)
+    3277
+    '''
+    if n_threads <= 1:
+        return max(n_y, 1)
+    return max(-(-n_y//(4*n_threads)), -(-2**15//n_states), 1)
 def _test():
     import doctest
     doctest.testmod()
@@ -0,0 +1,72 @@
+'''bench.py: Timing of HMM.P_Y_calc with and without threads.
+
+python3 bench.py [n_y] [n_states]
+
+'''
+Copyright = '''
+Copyright 2013 Andrew M. Fraser and Los Alamos National Laboroatory
+
+This file is part of hmmds3.
+
+Hmmds3 is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+Hmmds3 is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+for more details.
+
+See the file gpl.txt in the root directory of the hmmds3 distribution
+or see <http://www.gnu.org/licenses/>.
+'''
+import sys
+import time
+import numpy as np
+from hmm.Scalar import Gauss, Class_y
+from hmm.base import HMM, chunk_size
+
+def best_time(f, n_rep=5):
+    '''Return the shortest of n_rep times for calling f()
+    '''
+    times = []
+    for i in range(n_rep):
+        t0 = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - t0)
+    return min(times)
+def P_Y_calc(mod, y, n_thread_list=(1, 2, 4, 8)):
+    '''Print time for mod.P_Y_calc(y) for each number of threads
+    '''
+    for n_threads in n_thread_list:
+        chunk = chunk_size(len(y[0]), mod.n_states, n_threads)
+        t = best_time(lambda: mod.P_Y_calc(y, n_threads))
+        print('  n_threads=%d chunk=%7d %8.4f seconds'%(n_threads, chunk, t))
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    n_y = int(argv[0]) if len(argv) > 0 else 200000
+    n_states = int(argv[1]) if len(argv) > 1 else 32
+    P_S0 = np.ones(n_states)/n_states
+    P_SS = np.ones((n_states, n_states))/n_states
+    mu = np.arange(n_states, dtype=np.float64)
+    var = np.ones(n_states)
+    y = [np.random.normal(0, n_states, n_y)]
+
+    print('Gauss with n_y=%d and n_states=%d'%(n_y, n_states))
+    P_Y_calc(HMM(P_S0, P_S0, (mu, var), P_SS, Gauss), y)
+
+    c2s = {0:list(range(n_states//2)), 1:list(range(n_states//2, n_states))}
+    c = (np.arange(n_y)//100%2).astype(np.int32)
+    print('Class_y(Gauss) with n_y=%d and n_states=%d'%(n_y, n_states))
+    P_Y_calc(HMM(P_S0, P_S0, (Gauss, (mu, var), c2s), P_SS, Class_y),
+             [c] + y)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
+#--------------------------------
+# Local Variables:
+# mode: python
+# End:
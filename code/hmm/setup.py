@@ -5,6 +5,8 @@ from Cython.Distutils import build_ext
 
 setup(
     cmdclass = {'build_ext': build_ext},
-    ext_modules = [Extension("C", ["C.pyx"])],
+    ext_modules = [Extension("C", ["C.pyx"],
+                             extra_compile_args=['-fopenmp'],
+                             extra_link_args=['-fopenmp'])],
     depends = ['Scalar.py']
 )
@@ -5,7 +5,7 @@ import numpy as np
 import Scalar
 import C as Sparse
 from numpy.testing import assert_, assert_allclose, assert_almost_equal
-from numpy.testing import run_module_suite, assert_equal
+from numpy.testing import run_module_suite, assert_equal, assert_raises
 from scipy.linalg import circulant
 import C
 
@@ -93,6 +93,110 @@ class TestScalar:
     def test_values(self):
         for M in (self.C, self.C_s):
             self.values(M)
+class TestKron:
+    def __init__(self):
+        self.factors = (Scalar.make_prob(A), Scalar.make_prob(B[:2]))
+        self.K = Scalar.make_kron_prob(self.factors)
+        self.K.normalize()
+        self.dense = np.kron(*self.K.factors)
+        self.v = np.arange(6, dtype=np.float64)
+    def test_shape(self):
+        assert_equal(self.K.shape, (6, 6))
+        assert_almost_equal(self.K.values(), self.dense)
+    def test_step_forward(self):
+        v = self.v.copy()
+        self.K.step_forward(v)
+        assert_almost_equal(v, np.dot(self.v, self.dense))
+    def test_step_back(self):
+        v = self.v.copy()
+        self.K.step_back(v)
+        assert_almost_equal(v, np.dot(self.dense, self.v))
+    def test_inplace_elementwise_multiply(self):
+        u = np.outer(self.v, self.v[::-1]) + 1
+        counts = (self.dense*u).reshape((3, 2, 3, 2))
+        self.K.inplace_elementwise_multiply(u)
+        assert_almost_equal(self.K.factors[0], counts.sum(axis=(1, 3)))
+        assert_almost_equal(self.K.factors[1], counts.sum(axis=(0, 2)))
+        self.K.normalize()
+        assert_almost_equal(self.K.values().sum(axis=1), np.ones(6))
+class TestWorkspace:
+    def __init__(self):
+        self.work = Scalar.Workspace()
+    def test_get(self):
+        x = self.work.get('x', (5, 3))
+        y = self.work.get('x', (2, 3))
+        assert_equal(y.shape, (2, 3))
+        assert_(np.shares_memory(x, y))
+        z = self.work.get('x', (6, 3))
+        assert_(not np.shares_memory(x, z))
+        assert_equal(self.work.nbytes(), 18*8)
+    def test_initialize(self):
+        x = Scalar.initialize(None, (4, 2), np.float32, self.work, 'x')
+        assert_equal(x.dtype, np.float32)
+        assert_(Scalar.initialize(x, (4, 2), np.float32) is x)
+        y = Scalar.initialize(x, (3, 2), np.float32, self.work, 'x')
+        assert_(np.shares_memory(x, y))
+class TestSequenceSet:
+    def __init__(self):
+        rng = np.random.RandomState(2)
+        self.records = [[rng.randint(0, 3, n), rng.normal(size=(n, 2))]
+                        for n in (5, 40, 1, 17)]
+        self.ys = Scalar.SequenceSet([np.int32, np.float64], capacity=4)
+        for record in self.records:
+            self.ys.append(record)
+    def test_append(self):
+        assert_equal(self.ys.offsets, [0, 5, 45, 46, 63])
+        assert_equal(self.ys[1].shape, (63, 2))
+        assert_equal(self.ys[0].dtype, np.int32)
+        for record, view in zip(self.records, self.ys.records()):
+            assert_equal(view[0], record[0])
+            assert_equal(view[1], record[1])
+            assert_(np.shares_memory(view[1], self.ys[1]))
+    def test_pickle(self):
+        import pickle
+        s = pickle.dumps(self.ys)
+        # The data are stored once
+        assert_(len(s) < 1.5*len(pickle.dumps(self.ys.components)))
+        ys = pickle.loads(s)
+        assert_equal(ys.offsets, self.ys.offsets)
+        for z, view in zip(self.ys, ys):
+            assert_equal(view, z)
+            assert_(np.shares_memory(view, ys.buffers[0]) or
+                    np.shares_memory(view, ys.buffers[1]))
+        ys.append(self.records[0])
+        assert_equal(ys.offsets, [0, 5, 45, 46, 63, 68])
+        assert_equal(ys.record(4)[1], self.records[0][1])
+    def test_join(self):
+        y_mod = Scalar.Discrete_Observations(np.ones((2, 3))/3)
+        n_seg, t_seg, y_all = y_mod.join(self.ys)
+        assert_(y_all is self.ys)
+        n_seg, t_seg, y_all = y_mod.join([r[:1] for r in self.records])
+        assert_equal(n_seg, 4)
+        assert_equal(y_all[0], self.ys[0])
+class TestLaggedContext:
+    def __init__(self):
+        self.x = np.random.RandomState(3).normal(size=(30, 2))
+    def dense(self, x, order):
+        c = np.empty((len(x), order, x.shape[1]))
+        for t in range(len(x)):
+            for k in range(order):
+                c[t, k] = x[max(t-k-1, 0)]
+        return c.reshape((len(x), -1))
+    def test_scalar(self):
+        c = Scalar.LaggedContext(self.x[:, 0], 4)
+        d = np.ones((30, 5))
+        d[:, 1:] = self.dense(self.x[:, :1], 4)
+        assert_equal(c.shape, (30, 5))
+        assert_equal(np.asarray(c), d)
+        assert_equal(np.asarray(c[10:20]), d[10:20])
+        assert_equal(c[[2, 7]], d[[2, 7]])
+        assert_equal(c[3], d[3])
+    def test_vector(self):
+        c = Scalar.LaggedContext(self.x, 2, bias='last')
+        assert_equal(np.asarray(c)[:, :-1], self.dense(self.x, 2))
+        assert_equal(np.asarray(c)[:, -1], 1)
+        c = Scalar.LaggedContext(self.x, 3, bias=None)
+        assert_equal(np.asarray(c), self.dense(self.x, 3))
 class Test_Discrete_Observations:
     def __init__(self):
         P_YS = Scalar.make_prob(B)
@@ -115,6 +219,13 @@ class Test_Discrete_Observations:
     def test_calc(self):
         for y_mod in (self.y_mod, self.y_mod_s):
             self.calc(y_mod)
+    def test_calc_work(self):
+        work = Scalar.Workspace()
+        for y_mod in (self.y_mod, self.y_mod_s):
+            y_mod.P_Y = None
+            PY = y_mod.calc(self.Y, work)
+            assert_almost_equal(PY[2:4], [[ 0, 0.5, 0.25],[ 1, 0.5, 0.75]])
+            assert_(np.shares_memory(PY, work.buffers[(id(y_mod), 'P_Y')]))
     def join(self, y_mod):
         n_seg, t_seg, y_all  = y_mod.join(self.Ys)
         assert_equal(n_seg, 3)
@@ -128,6 +239,49 @@ class Test_Discrete_Observations:
     def test_reestimate(self):
         for y_mod in (self.y_mod, self.y_mod_s):
             self.reestimate(y_mod)
+class Test_Sparse_Discrete_Observations:
+    def __init__(self):
+        rng = np.random.RandomState(5)
+        P_YS = rng.random_sample((4, 50))
+        P_YS[P_YS < .6] = 0
+        P_YS[np.arange(50)%4, np.arange(50)] += 1 # Every symbol possible
+        P_YS[:, 0] = 0 # Symbol 0 never occurs
+        P_YS /= P_YS.sum(axis=1).reshape((-1, 1))
+        self.dense = Scalar.Discrete_Observations(P_YS)
+        self.y_mod = Scalar.Sparse_Discrete_Observations(P_YS)
+        Y = rng.randint(1, 50, 300).astype(np.int32)
+        self.Y = [Y]
+        w = self.dense.calc(self.Y) * rng.random_sample(4)
+        self.w = w / w.sum(axis=1).reshape((-1, 1))
+    def test_values(self):
+        assert_almost_equal(self.y_mod.values(), self.dense.P_YS)
+        from scipy.sparse import csr_matrix
+        y_mod = Scalar.Sparse_Discrete_Observations(csr_matrix(
+            self.dense.P_YS))
+        assert_almost_equal(y_mod.values(), self.dense.P_YS)
+    def test_calc(self):
+        assert_almost_equal(self.y_mod.calc(self.Y), self.dense.calc(self.Y))
+        out = np.empty((20, 4))
+        assert_almost_equal(self.y_mod.calc_block(self.Y, 30, 50, out),
+                            self.dense.calc(self.Y)[30:50])
+    def test_reestimate(self):
+        self.dense.reestimate(self.w, self.Y)
+        self.y_mod.reestimate(self.w, self.Y)
+        assert_almost_equal(self.y_mod.values(), self.dense.P_YS)
+        # Entries for symbols that don't occur in Y are dropped
+        assert_(len(self.y_mod.probs) == (self.dense.P_YS > 0).sum())
+    def test_random_out(self):
+        import random
+        random.seed(7)
+        n = 20000
+        y = [self.y_mod.random_out(2)[0] for i in range(n)]
+        freq = np.bincount(y, minlength=50)/n
+        assert_allclose(freq, self.dense.P_YS[2], atol=0.015)
+        assert_equal(freq[self.dense.P_YS[2] == 0], 0)
+        P_YS = self.dense.P_YS.copy()
+        P_YS[1] = 0
+        y_mod = Scalar.Sparse_Discrete_Observations(P_YS)
+        assert_raises(RuntimeError, y_mod.random_out, 1)
 
 if __name__ == "__main__":
     run_module_suite()
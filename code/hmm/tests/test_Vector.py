@@ -0,0 +1,108 @@
+# Copyright (c) 2013 Andrew M. Fraser
+import numpy as np
+from hmm.Vector import Gauss, Diag_Gauss, GMM
+from hmm.base import HMM
+from numpy.testing import assert_, assert_allclose, assert_almost_equal
+from numpy.testing import run_module_suite
+from scipy.stats import multivariate_normal
+
+mu = np.array([[0, 0, 0], [3.0, 0, -1]])
+Sigma = np.array([[[1, .5, 0], [.5, 2, .3], [0, .3, 1]],
+                  [[2, 0, 0], [0, .5, 0], [0, 0, 1.0]]])
+P_S0 = np.ones(2)/2
+P_SS = np.array([[.9, .1], [.2, .8]])
+class TestGauss:
+    def __init__(self):
+        self.y_mod = Gauss((mu, Sigma))
+        rng = np.random.RandomState(3)
+        self.Y = [rng.normal(size=(200, 3))]
+    def test_calc(self):
+        P_Y = self.y_mod.calc(self.Y)
+        for s in range(2):
+            assert_allclose(P_Y[:, s], multivariate_normal(
+                mu[s], Sigma[s]).pdf(self.Y[0]))
+    def test_diag(self):
+        var = np.array([np.diag(S) for S in Sigma])
+        diag = Diag_Gauss((mu, var))
+        full = Gauss((mu, [np.diag(v) for v in var]))
+        assert_allclose(diag.calc(self.Y), full.calc(self.Y))
+        w = np.random.RandomState(4).random_sample((200, 2))
+        diag.reestimate(w, self.Y)
+        full.reestimate(w, self.Y)
+        assert_allclose(diag.mu, full.mu)
+        assert_allclose(diag.var, np.diagonal(full.Sigma, axis1=1, axis2=2))
+    def test_reestimate(self):
+        w = np.zeros((200, 2))
+        w[:120, 0] = 1
+        w[120:, 1] = 1
+        # Maximum likelihood without the prior
+        y_mod = Gauss((mu, Sigma, 0, 0))
+        diag = Diag_Gauss((mu, np.ones((2, 3)), 0, 0))
+        for offset in (0, 1e6):
+            Y = [self.Y[0] + offset]
+            y_mod.reestimate(w, Y)
+            diag.reestimate(w, Y)
+            for s, y in enumerate((Y[0][:120], Y[0][120:])):
+                cov = np.cov(self.Y[0][120*s:120 + 80*s].T, bias=True)
+                assert_allclose(y_mod.mu[s], y.mean(axis=0))
+                assert_allclose(y_mod.Sigma[s], cov, rtol=1e-6)
+                assert_allclose(diag.var[s], np.diag(cov), rtol=1e-6)
+    def test_collapse(self):
+        w = np.zeros((200, 2))
+        w[:, 0] = 1
+        w[7, :] = [0, 1] # State 1 explains a single observation
+        self.y_mod.reestimate(w, self.Y)
+        assert_allclose(self.y_mod.mu[1], self.Y[0][7])
+        assert_(np.all(np.linalg.eigvalsh(self.y_mod.Sigma[1]) > 0))
+        self.y_mod.reestimate(np.ones((200, 2))*[1, 0], self.Y)
+        assert_allclose(self.y_mod.mu[1], self.Y[0][7])
+    def test_train(self):
+        mod = HMM(P_S0, P_S0, (mu, Sigma), P_SS, Gauss)
+        S, Y = mod.simulate(500)
+        Y = [np.array(Y[0])]
+        assert_(Y[0].shape == (500, 3))
+        mod = HMM(P_S0, P_S0, (mu + .5, 2*Sigma), P_SS, Gauss)
+        LL = mod.train(Y, 10, display=False)
+        assert_(np.all(np.diff(LL) > -1e-8))
+class TestGMM:
+    def __init__(self):
+        rng = np.random.RandomState(5)
+        self.Y = [rng.normal(size=(300, 3))]
+        self.c = np.array([[.3, .7], [.5, .5]])
+        self.mu = np.array([mu, mu[::-1]])
+        self.Sigma = np.array([Sigma, Sigma[::-1]])
+    def test_calc(self):
+        y_mod = GMM((self.c, self.mu, self.Sigma))
+        P_Y = y_mod.calc(self.Y)
+        for s in range(2):
+            p = sum(self.c[s, m]*multivariate_normal(
+                self.mu[s, m], self.Sigma[s, m]).pdf(self.Y[0])
+                    for m in range(2))
+            assert_allclose(P_Y[:, s], p)
+    def test_one_component(self):
+        y_mod = GMM((np.ones((2, 1)), mu[:, np.newaxis],
+                     Sigma[:, np.newaxis]))
+        gauss = Gauss((mu, Sigma))
+        assert_allclose(y_mod.calc(self.Y), gauss.calc(self.Y))
+        w = np.random.RandomState(6).random_sample((300, 2))
+        y_mod.reestimate(w, self.Y)
+        gauss.reestimate(w, self.Y)
+        assert_allclose(y_mod.components.Sigma, gauss.Sigma)
+    def test_train(self):
+        var = np.array([[np.diag(S) for S in Sigma]]*2)
+        mod = HMM(P_S0, P_S0, (self.c, self.mu, var), P_SS, GMM)
+        S, Y = mod.simulate(500)
+        Y = [np.array(Y[0])]
+        mod = HMM(P_S0, P_S0, (np.ones((2, 2))/2, self.mu + .3, 2*var),
+                  P_SS, GMM)
+        LL = mod.train(Y, 10, display=False)
+        assert_(np.all(np.diff(LL) > -1e-8))
+        assert_almost_equal(mod.y_mod.c.sum(axis=1), [1, 1])
+
+if __name__ == "__main__":
+    run_module_suite()
+
+#--------------------------------
+# Local Variables:
+# mode: python
+# End:
@@ -0,0 +1,58 @@
+# Copyright (c) 2013 Andrew M. Fraser
+import copy
+import numpy as np
+from hmm.Scalar import Gauss, Class_y
+from hmm.base import HMM
+from hmm.bank import ModelBank, signature
+from numpy.testing import assert_, assert_allclose, assert_equal
+from numpy.testing import run_module_suite
+import C
+
+c2s = {0:[0,1], 1:[2]}
+P_S0 = np.ones(3)/3
+P_SS = np.array([[.8, .1, .1], [.1, .8, .1], [.1, .1, .8]])
+mu = np.array([-1.0, 0, 1])
+var = np.ones(3)
+class TestModelBank:
+    def __init__(self):
+        pars = (Gauss, (mu, var), c2s)
+        self.mod = HMM(P_S0, P_S0, pars, P_SS, Class_y)
+        self.same = C.HMM(P_S0, P_S0, copy.deepcopy(pars), P_SS.T.copy(),
+                          Class_y)
+        self.other = HMM(P_S0, P_S0, (Gauss, (mu, 2*var), c2s), P_SS,
+                         Class_y)
+        self.models = [self.mod, self.same, self.other]
+        self.bank = ModelBank(self.models)
+        self.ys = []
+        for T in (300, 1000, 50):
+            S, CY = self.mod.simulate(T)
+            self.ys.append([np.array(CY[0], np.int32), np.array(CY[1])])
+    def test_signature(self):
+        assert_equal(signature(self.mod.y_mod), signature(self.same.y_mod))
+        assert_(signature(self.mod.y_mod) != signature(self.other.y_mod))
+    def test_log_likelihoods(self):
+        LL = self.bank.log_likelihoods(self.ys, block=128)
+        assert_equal(LL.shape, (3, 3))
+        for i, mod in enumerate(self.models):
+            assert_allclose(LL[i], mod.multi_log_likelihood(self.ys))
+        # Class_y and Gauss for mod and same are shared
+        assert_equal(self.bank.n_distinct, 4)
+        assert_(self.mod.y_mod.__class__ is Class_y)
+    def test_log_domain(self):
+        # Without log_domain every P_Y[t] at y=25 underflows
+        y = [np.array([0, 50.0, 0, 25, 50])]
+        models = [cls(np.ones(2)/2, np.ones(2)/2, ([0, 50.0], [.01, .01]),
+                      np.ones((2, 2))/2, Gauss, log_domain=True)
+                  for cls in (HMM, C.HMM)]
+        LL = ModelBank(models).log_likelihoods([y], block=2)
+        for i, mod in enumerate(models):
+            assert_allclose(LL[i, 0], mod.log_likelihood(y))
+        assert_(np.isfinite(LL).all())
+
+if __name__ == "__main__":
+    run_module_suite()
+
+#--------------------------------
+# Local Variables:
+# mode: python
+# End:
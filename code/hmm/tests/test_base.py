@@ -63,6 +63,148 @@ class TestHMM:
     def test_multi_train(self):
         for mod in self.mods:
             self.multi_train(mod)
+    def test_train_fused(self):
+        import copy
+        for mod in self.mods:
+            mod_f = copy.deepcopy(mod)
+            L = mod.train(self.Y, n_iter=3, display=False)
+            L_f = mod_f.train(self.Y, n_iter=3, display=False, block=64)
+            assert_allclose(L_f, L)
+            assert_allclose(mod_f.P_SS.values(), mod.P_SS.values(), atol=1e-10)
+            assert_allclose(mod_f.y_mod.P_YS.values(), mod.y_mod.P_YS.values(),
+                            atol=1e-10)
+    def test_P_Y_calc_threads(self):
+        for mod in self.mods:
+            P_Y = mod.P_Y_calc(self.Y).copy()
+            assert_allclose(mod.P_Y_calc(self.Y, 3, 70), P_Y)
+    def test_log_likelihood(self):
+        ys = [[x[100*i:100*(i+3)] for x in self.Y] for i in range(3)]
+        for mod in self.mods:
+            mod.P_Y_calc(self.Y)
+            L = mod.forward()
+            assert_allclose(mod.log_likelihood(self.Y, 64), L)
+            Ls = []
+            for y in ys:
+                mod.P_Y_calc(y)
+                Ls.append(mod.forward())
+            assert_allclose(mod.multi_log_likelihood(ys), Ls)
+    def test_log_domain(self):
+        import copy
+        ys = [[x[200*i:200*(i+1)] for x in self.Y] for i in range(3)]
+        for mod in self.mods:
+            mod_m = copy.deepcopy(mod)
+            L_m = mod_m.multi_train(ys, n_iter=2, display=False)
+            mod_l = copy.deepcopy(mod)
+            mod_l.log_domain = True
+            mod_m = copy.deepcopy(mod_l)
+            assert_allclose(mod_m.multi_train(ys, n_iter=2, display=False),
+                            L_m)
+            L = mod.train(self.Y, n_iter=3, display=False)
+            assert_allclose(mod_l.train(self.Y, n_iter=3, display=False), L)
+            assert_allclose(mod_l.y_mod.P_YS.values(),
+                            mod.y_mod.P_YS.values(), atol=1e-10)
+            assert_allclose(mod_l.log_likelihood(self.Y, 64),
+                            mod.log_likelihood(self.Y, 64))
+        # An outlier makes every P_Y[t] underflow without log_domain
+        from hmm.Scalar import Gauss
+        mod = HMM(np.ones(2)/2, np.ones(2)/2, ([-1.0, 1], [1.0, 1]),
+                  np.ones((2, 2))/2, Gauss, log_domain=True)
+        y = [np.array([0, 50.0, 0])]
+        mod.P_Y_calc(y)
+        log_norm = -np.log(2*np.pi)/2
+        # P_SS makes the states independent
+        L = 2*(log_norm - 0.5) + log_norm - 49**2/2 + np.log(
+            (1 + np.exp(-100))/2)
+        assert_allclose(mod.forward(), L, rtol=1e-12)
+        assert_allclose(mod.log_likelihood(y), L, rtol=1e-12)
+    def test_cache(self):
+        for mod in self.mods:
+            P_Y = mod.P_Y_calc(self.Y).copy()
+            mod.set_cache(P_Y.nbytes*2)
+            version = mod.y_mod.param_version()
+            first = mod.P_Y_calc(self.Y)
+            assert_(mod.P_Y_calc(self.Y) is first)
+            assert_(mod.cache.hits == 1 and mod.cache.misses == 1)
+            assert_allclose(first, P_Y)
+            # Equal values in a different object are a different key
+            mod.P_Y_calc([self.Y[0].copy()])
+            assert_(mod.cache.misses == 2)
+            # Reestimation changes the version
+            mod.train(self.Y, n_iter=1, display=False)
+            assert_(mod.y_mod.param_version() != version)
+            P_Y = mod.P_Y_calc(self.Y)
+            assert_(P_Y is not first)
+            mod.cache.clear()
+            assert_allclose(mod.P_Y_calc(self.Y), P_Y)
+            # Three more results of half the size push out the first
+            for i in range(3):
+                mod.P_Y_calc([self.Y[0][:500].copy()])
+            assert_(len(mod.cache.entries) == 3)
+            assert_(mod.cache.nbytes <= mod.cache.max_bytes)
+            misses = mod.cache.misses
+            mod.P_Y_calc(self.Y)
+            assert_(mod.cache.misses == misses + 1)
+            mod.set_cache(None)
+    def test_forward_parallel(self):
+        from concurrent.futures import ThreadPoolExecutor
+        for mod in self.mods:
+            mod.P_Y_calc(self.Y)
+            L = mod.forward()
+            alpha = mod.alpha.copy()
+            with ThreadPoolExecutor(3) as executor:
+                L_p = mod.forward_parallel(7, executor)
+            assert_allclose(L_p, L)
+            assert_allclose(mod.alpha, alpha, atol=1e-10)
+class TestFloat32:
+    '''Compare float32 storage with the float64 path on the model in
+    the docstring of base.HMM.
+    '''
+    def __init__(self):
+        P_S0 = np.array([1./3., 1./3., 1./3.])
+        P_S0_ergodic = np.array([1./7., 4./7., 2./7.])
+        P_SS = np.array([
+            [0,   1,   0],
+            [0,  .5,  .5],
+            [.5, .5,   0]
+        ],np.float64)
+        P_YS = np.array([
+            [1, 0,     0],
+            [0, 1./3., 2./3.],
+            [0, 2./3., 1./3.]
+        ])
+        self.pairs = []
+        for H in (HMM, C.HMM):
+            self.pairs.append([H(P_S0.copy(), P_S0_ergodic.copy(),
+                                 P_YS.copy(), P_SS.copy(), dtype=dtype)
+                               for dtype in (np.float64, np.float32)])
+        S,Y = self.pairs[0][0].simulate(500)
+        self.Y = (np.array(Y[0], np.int32),)
+        self.ys = [[x[100*i:100*(i+1)] for x in self.Y] for i in range(5)]
+    def test_forward(self):
+        for mod64, mod32 in self.pairs:
+            mod64.P_Y_calc(self.Y)
+            mod32.P_Y_calc(self.Y)
+            L64 = mod64.forward()
+            L32 = mod32.forward()
+            assert_(mod32.alpha.dtype == np.float32)
+            assert_(mod32.gamma.dtype == np.float64)
+            assert_allclose(L32, L64, rtol=1e-6)
+            mod64.backward()
+            mod32.backward()
+            assert_allclose(mod32.beta, mod64.beta, rtol=1e-5)
+    def test_train(self):
+        for mod64, mod32 in self.pairs:
+            L64 = mod64.train(self.Y, n_iter=4, display=False)
+            L32 = mod32.train(self.Y, n_iter=4, display=False)
+            assert_allclose(L32, L64, rtol=1e-6)
+            assert_allclose(mod32.P_SS, mod64.P_SS, atol=1e-5)
+            assert_allclose(mod32.y_mod.P_YS, mod64.y_mod.P_YS, atol=1e-5)
+    def test_multi_train(self):
+        for mod64, mod32 in self.pairs:
+            L64 = mod64.multi_train(self.ys, n_iter=4, display=False)
+            L32 = mod32.multi_train(self.ys, n_iter=4, display=False)
+            assert_allclose(L32, L64, rtol=1e-6)
+            assert_allclose(mod32.P_SS, mod64.P_SS, atol=1e-5)
 class TestHMM_classy:
     def __init__(self):
         pars = (Discrete_Observations, P_YS, c2s)
@@ -83,6 +225,30 @@ class TestHMM_classy:
         D = self.mod.class_decode((self.CY[1],))
         E = np.where(D != self.CY[0])[0]
         assert_(len(E) < 150)
+    def test_gated(self):
+        pars = (Discrete_Observations, 0.7*P_YS + 0.3/6, c2s)
+        for cls in (HMM, C.HMM):
+            mods = [cls(P_S0, P_S0, pars, 0.7*P_SS + 0.3/6, Class_y, make_prob)
+                    for i in range(2)]
+            L = mods[0].train(self.CY, n_iter=3, display=False)
+            L_gated = mods[1].train(self.CY, n_iter=3, display=False,
+                                    gated=True)
+            assert_allclose(L_gated, L)
+            assert_allclose(mods[1].P_SS, mods[0].P_SS, atol=1e-12)
+            assert_allclose(mods[1].y_mod.y_mod.P_YS, mods[0].y_mod.y_mod.P_YS,
+                            atol=1e-12)
+            assert_(np.all(mods[1].decode_gated(self.CY) ==
+                           np.array(mods[0].decode(self.CY))))
+            mods = [cls(P_S0, P_S0, pars, 0.7*P_SS + 0.3/6, Class_y, make_prob)
+                    for i in range(2)]
+            ys = [[x[300*i:300*(i+1)] for x in self.CY] for i in range(3)]
+            L = mods[0].multi_train(ys, n_iter=2, display=False)
+            L_gated = mods[1].multi_train(ys, n_iter=2, display=False,
+                                          gated=True)
+            assert_allclose(L_gated, L)
+            assert_allclose(mods[1].P_S0, mods[0].P_S0, atol=1e-12)
+            assert_allclose(mods[1].y_mod.y_mod.P_YS, mods[0].y_mod.y_mod.P_YS,
+                            atol=1e-12)
 
 if __name__ == "__main__":
     run_module_suite()
@@ -3,14 +3,14 @@
 python class1.py pass1_report pass1.pdf
 """
 def read_data(data_file):
+    import ApFeatures # From code/applications/apnea
     rv = {}
-    for line in open(data_file, 'r'):
-        parts = line.split()
-        key = parts[0][0]
+    for record in ApFeatures.read_report(data_file):
+        key = record['record'][0]
         if key not in rv:
             rv[key] = {'llr':[], 'R':[]}
-        rv[key]['llr'].append(float(parts[6]))
-        rv[key]['R'].append(float(parts[8]))
+        rv[key]['llr'].append(record['llr'])
+        rv[key]['R'].append(record['R'])
     return rv
 
 import sys